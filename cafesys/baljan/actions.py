@@ -27,6 +27,8 @@ def categories_and_actions(request):
         name = upc.name
         action = Action(("Jobbsläpp %s") % name, "job_opening", args=(name,))
         upcoming_sem_actions.append(action)
+        action = Action(("Passmatchning %s") % name, "shift_matching", args=(name,))
+        upcoming_sem_actions.append(action)
 
     regulars_upcoming_sem_actions = []
 
@@ -76,6 +76,9 @@ class ProfileInline(admin.StackedInline):
         "balance_currency",
         "private_key",
         "card_cache",
+        "free_coffee",
+        "online_refill",
+        "staff_class",
     )
 
 
@@ -85,7 +88,7 @@ class UserAdminCustom(UserAdmin):
         "make_regular_worker",
     )
 
-    list_filter = UserAdmin.list_filter + ("boardpost__post",)
+    list_filter = UserAdmin.list_filter + ("boardpost__post", "profile__free_coffee")
     readonly_fields = ("user_permissions", "last_login", "date_joined")
     inlines = (ProfileInline, BoardPostInline, IncomingCallFallbackInline)
 
@@ -170,10 +173,11 @@ class FreeCoffeeListFilter(admin.SimpleListFilter):
     def queryset(self, request, queryset):
         if self.value() == "1":
             return queryset.filter(
+                permissions__content_type__app_label="baljan",
                 permissions__codename__in=[
                     "free_coffee_unlimited",
                     "free_coffee_with_cooldown",
-                ]
+                ],
             ).distinct()
 
 
@@ -8,5 +8,35 @@ class BaljanConfig(AppConfig):
     def ready(self):
         # This can only be imported AFTER the app is ready
         from cafesys.baljan.workdist.signals import semester_post_save
+        from cafesys.baljan.blipp import (
+            card_changed,
+            configuration_changed,
+            remember_card,
+        )
+        from cafesys.baljan.leaderboard import (
+            order_post_delete,
+            order_post_init,
+            order_post_save,
+        )
+        from cafesys.baljan import rollup, wrapped
 
         signals.post_save.connect(semester_post_save, sender="baljan.Semester")
+
+        for sender in ("baljan.BlippConfiguration", "baljan.Good", "baljan.GoodCost"):
+            signals.post_save.connect(configuration_changed, sender=sender)
+            signals.post_delete.connect(configuration_changed, sender=sender)
+
+        signals.post_init.connect(remember_card, sender="baljan.Profile")
+        signals.post_save.connect(card_changed, sender="baljan.Profile")
+        signals.post_delete.connect(card_changed, sender="baljan.Profile")
+
+        signals.post_init.connect(order_post_init, sender="baljan.Order")
+        signals.post_save.connect(order_post_save, sender="baljan.Order")
+        signals.post_delete.connect(order_post_delete, sender="baljan.Order")
+
+        signals.pre_save.connect(rollup.order_pre_save, sender="baljan.Order")
+        signals.post_save.connect(rollup.order_post_save, sender="baljan.Order")
+        signals.post_delete.connect(rollup.order_post_delete, sender="baljan.Order")
+
+        signals.post_save.connect(wrapped.wrapped_changed, sender="baljan.Wrapped")
+        signals.post_delete.connect(wrapped.wrapped_changed, sender="baljan.Wrapped")
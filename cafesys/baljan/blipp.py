@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+"""
+The blipp transaction path.
+
+Every tap on a card reader ends up in `perform_blipp`. It is the hot path of
+the whole system during the morning rush, so it is written to issue as few
+statements as possible: the balance check and the debit is a single
+conditional UPDATE, followed by one INSERT for the order and one for the
+order good, all inside one transaction.
+"""
+
+import uuid
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from functools import partial
+from logging import getLogger
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import OuterRef, Subquery, signals
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+import pytz
+
+from . import ratelimit
+from .models import BlippConfiguration, GoodCost, Order, OrderGood, Profile
+
+logger = getLogger(__name__)
+
+COOLDOWN_RESPONSES = [
+    "Jisses, tänk på hjärtat!",
+    "Oj, den slank ner snabbt!",
+    "Varannan vatten hörru!",
+    "Nån ska högt i topplistan!",
+]
+
+# The idempotency keys of offline blipps are stored with a prefix, see
+# `perform_blipp_batch`.
+BLIPP_KEY_MAX_LENGTH = 64
+
+BlippResult = namedtuple("BlippResult", ["order", "paid", "balance", "is_free"])
+
+
+class BlippError(Exception):
+    """A blipp that was refused. Carries what the reader should be told."""
+
+    def __init__(self, status_code, message, **kwargs):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.extra = kwargs
+
+
+def current_cost_subquery(good_ref="good", day=None):
+    """The current cost of the good referenced by `good_ref`, as a subquery.
+    Mirrors `Good.cost`."""
+    if day is None:
+        day = date.today()
+
+    return Subquery(
+        GoodCost.objects.filter(good=OuterRef(good_ref), from_date__lt=day)
+        .order_by("-from_date")
+        .values("cost")[:1]
+    )
+
+
+def load_configuration(token):
+    """Fetches the configuration for `token` together with its good and the
+    current price of the good (as `current_cost`) in a single query."""
+    try:
+        return (
+            BlippConfiguration.objects.select_related("good")
+            .annotate(current_cost=current_cost_subquery())
+            .get(token=token)
+        )
+    except BlippConfiguration.DoesNotExist:
+        return None
+
+
+class VersionedCache(ABC):
+    """Base for the per-process caches of the blipp. Every process compares
+    its version against a stamp in the shared cache on each lookup, and drops
+    everything it has if the stamp has changed."""
+
+    version_key = None
+
+    def __init__(self):
+        self.version = None
+        self.clear()
+
+    @abstractmethod
+    def clear(self):
+        """Drops everything cached."""
+
+    def sync(self):
+        """Returns False if the stamp could not be checked, in which case
+        nothing cached should be trusted."""
+        try:
+            version = cache.get(self.version_key)
+        except Exception as e:
+            logger.warning("could not check %s: %s" % (self.version_key, e))
+            return False
+
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+        return True
+
+    def renew(self):
+        cache.set(self.version_key, uuid.uuid4().hex, None)
+
+
+class ConfigurationCache(VersionedCache):
+    """Per-process cache of blipp configurations (with good and current price)
+    by token. Unknown tokens are not cached, as anyone can send any number of
+    them.
+
+    The stamp is renewed whenever a configuration, good or good cost is saved
+    or deleted. Entries are also dropped when the day changes, since that is
+    when a new good cost takes effect.
+    """
+
+    version_key = settings.BLIPP_CONFIGURATION_VERSION_KEY
+
+    def clear(self):
+        self.entries = {}
+
+    def get(self, token):
+        if not self.sync():
+            return load_configuration(token)
+
+        today = date.today()
+        entry = self.entries.get(token)
+        if entry is None or entry[0] != today:
+            config = load_configuration(token)
+            if config is None:
+                return None
+            entry = (today, config)
+            self.entries[token] = entry
+
+        return entry[1]
+
+
+configurations = ConfigurationCache()
+
+
+def get_configuration(token):
+    return configurations.get(token)
+
+
+def renew_configuration_version():
+    configurations.renew()
+
+
+def configuration_changed(sender, instance=None, **kwargs):
+    # Other processes must not reload before the change is visible to them.
+    transaction.on_commit(renew_configuration_version)
+
+
+class CardIndex(VersionedCache):
+    """Per-process map from card id to a two-tuple (user id, profile id) of
+    every profile with a card, so that cards nobody has can be turned away
+    without a query. It is loaded in one query on first use, and again when
+    the stamp is renewed, which it is whenever a card id is changed.
+    """
+
+    version_key = settings.BLIPP_CARD_INDEX_VERSION_KEY
+
+    def clear(self):
+        self.cards = None
+
+    def get(self, card_id):
+        """Returns (user id, profile id), None for unknown cards, or raises
+        LookupError if the index cannot be trusted right now."""
+        if not self.sync():
+            raise LookupError("card index unavailable")
+
+        if self.cards is None:
+            self.cards = {
+                card_id: (user_id, profile_id)
+                for card_id, user_id, profile_id in Profile.objects.filter(
+                    card_id__isnull=False
+                ).values_list("card_id", "user_id", "id")
+            }
+
+        return self.cards.get(card_id)
+
+
+cards = CardIndex()
+
+
+def renew_card_index_version():
+    cards.renew()
+
+
+def remember_card(sender, instance=None, **kwargs):
+    # Read from __dict__ to not load the field if it was deferred.
+    instance._loaded_card_id = instance.__dict__.get("card_id")
+
+
+def card_changed(sender, instance=None, signal=None, **kwargs):
+    if instance is None:
+        return
+
+    card_id = instance.__dict__.get("card_id")
+    if signal is signals.post_save:
+        if card_id == getattr(instance, "_loaded_card_id", None):
+            return
+        instance._loaded_card_id = card_id
+
+    transaction.on_commit(renew_card_index_version)
+
+
+def get_user(card_id):
+    if settings.BLIPP_CARD_INDEX:
+        try:
+            entry = cards.get(card_id)
+        except LookupError:
+            pass
+        else:
+            if entry is None:
+                return None
+            return User.objects.select_related("profile").filter(pk=entry[0]).first()
+
+    try:
+        return User.objects.select_related("profile").get(profile__card_id=card_id)
+    except User.DoesNotExist:
+        return None
+
+
+def get_cooldown_key(user):
+    return "%s.%d" % (settings.BLIPP_COOLDOWN_KEY, user.id)
+
+
+def last_order_at(user):
+    return (
+        Order.objects.filter(accepted=True, user=user)
+        .order_by("-put_at")
+        .values_list("put_at", flat=True)
+        .first()
+    )
+
+
+def check_cooldown(user):
+    """Starts the cooldown of `user`, or raises `BlippError` if it is already
+    running. The orders are only looked at when the cache has no cooldown for
+    the user."""
+    if ratelimit.acquire(
+        get_cooldown_key(user),
+        settings.WORKER_COOLDOWN_SECONDS,
+        partial(last_order_at, user),
+    ):
+        return
+
+    raise _cooldown_error()
+
+
+def check_cooldown_at(user, put_at):
+    """Like `check_cooldown`, for a blipp that was made at `put_at` and is
+    only recorded now. Any order within the cooldown on either side of it
+    counts, since offline blipps may arrive after later ones."""
+    cooldown = timedelta(seconds=settings.WORKER_COOLDOWN_SECONDS)
+    if Order.objects.filter(
+        accepted=True, user=user, put_at__range=(put_at - cooldown, put_at + cooldown)
+    ).exists():
+        raise _cooldown_error()
+
+
+def _cooldown_error():
+    current_time = datetime.now()
+    return BlippError(
+        402,
+        COOLDOWN_RESPONSES[current_time.second % len(COOLDOWN_RESPONSES)],
+        help_text="Vänta en stund innan du blippar igen",
+    )
+
+
+_DEBIT_SQL = (
+    "UPDATE {table} SET balance = balance - %s "
+    "WHERE user_id = %s AND balance > 0 "
+    "AND CASE WHEN balance < %s THEN balance ELSE %s END = %s "
+    "RETURNING balance"
+)
+
+
+def _debit(user_id, price, known_balance):
+    """Withdraws `price` from the balance, or whatever is left if the balance
+    does not cover it. Returns a two-tuple (paid, new balance).
+
+    The debit is guarded on the amount it is based on. If the balance was
+    changed by someone else since it was read the UPDATE matches nothing, in
+    which case the balance is read again and the debit retried once.
+    """
+    sql = _DEBIT_SQL.format(table=connection.ops.quote_name(Profile._meta.db_table))
+
+    balance = known_balance
+    for _ in range(2):
+        if balance <= 0:
+            break
+
+        debit = min(price, balance)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [debit, user_id, price, price, debit])
+            row = cursor.fetchone()
+
+        if row is not None:
+            return debit, row[0]
+
+        balance = Profile.objects.values_list("balance", flat=True).get(user_id=user_id)
+
+    raise BlippError(402, "Du har för lite pengar för att blippa")
+
+
+def perform_blipp(config, user, price=None, put_at=None, idempotency_key=None):
+    """Charges `user` for one of `config.good` and records the order.
+
+    `price` defaults to the `current_cost` annotated by `get_configuration`.
+    `put_at` is given for blipps that were made earlier, see
+    `perform_blipp_batch`. Raises `BlippError` if the blipp is refused.
+    """
+    if price is None:
+        price = config.current_cost
+    if price is None:
+        logger.error("%s has no price for %s" % (config.good, config.token))
+        raise BlippError(500, "Varan saknar pris")
+
+    is_coffee_free, has_cooldown = user.profile.has_free_blipp()
+    live = put_at is None
+
+    if has_cooldown:
+        if live:
+            check_cooldown(user)
+        else:
+            check_cooldown_at(user, put_at)
+
+    if live:
+        tz = pytz.timezone(settings.TIME_ZONE)
+        put_at = datetime.now(tz)
+
+    try:
+        with transaction.atomic():
+            if is_coffee_free:
+                paid, balance = 0, None
+            else:
+                paid, balance = _debit(user.id, price, user.profile.balance)
+                user.profile.balance = balance
+
+            order = Order.objects.create(
+                location=config.location,
+                put_at=put_at,
+                user=user,
+                paid=paid,
+                currency="SEK",
+                accepted=True,
+                idempotency_key=idempotency_key,
+            )
+            OrderGood.objects.create(order=order, good_id=config.good_id, count=1)
+    except Exception:
+        if has_cooldown and live:
+            ratelimit.release(get_cooldown_key(user))
+        raise
+
+    if has_cooldown and not live:
+        # Blocks live blipps too, for what is left of the cooldown.
+        transaction.on_commit(
+            partial(
+                ratelimit.hold,
+                get_cooldown_key(user),
+                put_at,
+                settings.WORKER_COOLDOWN_SECONDS,
+            )
+        )
+
+    return BlippResult(order=order, paid=paid, balance=balance, is_free=is_coffee_free)
+
+
+def describe(result):
+    """The balance and message to show the user after a blipp."""
+    if result.is_free:
+        return "unlimited", "Du har <b>∞ kr</b> kvar att blippa för"
+    return result.balance, "Du har <b>%s kr</b> kvar att blippa för" % result.balance
+
+
+def _tap_result(key, status_code, message, **kwargs):
+    return {**kwargs, "key": key, "status": status_code, "message": message}
+
+
+def _parse_tap(config, tap, now):
+    """Validates a tap of a batch. Returns a three-tuple (key, card id,
+    put_at), or raises `BlippError`."""
+    if not isinstance(tap, dict):
+        raise BlippError(400, "Felaktigt blipp")
+
+    key = tap.get("key")
+    if not isinstance(key, str) or not 0 < len(key) <= BLIPP_KEY_MAX_LENGTH:
+        raise BlippError(400, "Felaktig nyckel")
+
+    try:
+        card_id = config.get_standardised_reader_output(str(tap["id"]))
+    except (KeyError, ValueError):
+        raise BlippError(400, "Felaktigt användar-id")
+
+    put_at = now
+    if tap.get("at") is not None:
+        try:
+            put_at = parse_datetime(str(tap["at"]))
+        except ValueError:
+            put_at = None
+        if put_at is None:
+            raise BlippError(400, "Felaktig tidpunkt")
+        if timezone.is_naive(put_at):
+            put_at = timezone.make_aware(put_at, pytz.timezone(settings.TIME_ZONE))
+        # The clock of a reader is not to be trusted too far.
+        put_at = min(put_at, now)
+        if put_at < now - timedelta(seconds=settings.BLIPP_BATCH_MAX_AGE):
+            raise BlippError(400, "Blippet är för gammalt")
+
+    return key, card_id, put_at
+
+
+def perform_blipp_batch(config, taps):
+    """Records a batch of blipps that a reader has buffered, e.g. while it
+    was offline, with the same rules as when they are made one at a time.
+
+    Every tap is a dict with the reader output as `id`, a `key` that is
+    unique to the tap and optionally the time of the tap as an ISO 8601 `at`,
+    at most `settings.BLIPP_BATCH_MAX_AGE` seconds ago.
+    Taps whose key has been seen before are not charged again. Everything is
+    done in one transaction, but a refused tap does not affect the others.
+
+    Returns one result per tap, in the same order: a dict with the `key`, an
+    HTTP-like `status` and a `message`, plus `paid` and `balance` for the taps
+    that went through.
+    """
+    now = timezone.now()
+    results = [None] * len(taps)
+    parsed = []
+
+    for i, tap in enumerate(taps):
+        try:
+            parsed.append((i, *_parse_tap(config, tap, now)))
+        except BlippError as e:
+            key = tap.get("key") if isinstance(tap, dict) else None
+            results[i] = _tap_result(key, e.status_code, e.message)
+
+    # Stored keys are per configuration, as keys are only unique per reader.
+    def stored_key(key):
+        return "%d:%s" % (config.pk, key)
+
+    seen = dict(
+        Order.objects.filter(
+            idempotency_key__in=[stored_key(key) for _, key, _, _ in parsed]
+        ).values_list("idempotency_key", "paid")
+    )
+    users = {
+        user.profile.card_id: user
+        for user in User.objects.select_related("profile").filter(
+            profile__card_id__in={card_id for _, _, card_id, _ in parsed}
+        )
+    }
+    prices = {}
+
+    with transaction.atomic():
+        # Apply the taps in the order they were made, for cooldowns and
+        # balances to work out the same as if they had been made online.
+        for i, key, card_id, put_at in sorted(parsed, key=lambda tap: tap[3]):
+            if stored_key(key) in seen:
+                results[i] = _tap_result(
+                    key, 200, "Redan blippad", paid=seen[stored_key(key)]
+                )
+                continue
+
+            user = users.get(card_id)
+            if user is None:
+                results[i] = _tap_result(
+                    key, 404, "Blippkortet är inte kopplat till någon användare"
+                )
+                continue
+
+            day = put_at.astimezone(pytz.timezone(settings.TIME_ZONE)).date()
+            if day not in prices:
+                cost = config.good.cost(day)
+                prices[day] = None if cost is None else cost.cost
+            if prices[day] is None:
+                results[i] = _tap_result(key, 500, "Varan saknar pris")
+                continue
+
+            try:
+                result = perform_blipp(
+                    config,
+                    user,
+                    price=prices[day],
+                    put_at=put_at,
+                    idempotency_key=stored_key(key),
+                )
+            except BlippError as e:
+                results[i] = _tap_result(key, e.status_code, e.message, **e.extra)
+                continue
+            except IntegrityError:
+                # The same key was recorded by a concurrent request.
+                results[i] = _tap_result(key, 200, "Redan blippad")
+                continue
+
+            seen[stored_key(key)] = result.paid
+            balance, message = describe(result)
+            results[i] = _tap_result(
+                key, 200, message, paid=result.paid, balance=balance
+            )
+
+    return results
@@ -1,87 +1,162 @@
+"""
+The numbers of a year that the bookkeeping needs.
+
+Who has blipped when is read from the daily order counts and the sums from
+the order rollup, both by date. The balances of all accounts are sorted into
+buckets by when their users have blipped in one pass: every profile gets the
+first and last day it blipped and the number of days it blipped during the
+year, and one aggregate over those sums the balances of every bucket.
+
+Only accepted orders count as blipps, unlike in the report before the daily
+order counts: an account whose every blipp was rejected has never been used
+and is counted as never blipped.
+
+The sum of the blipps is only as current as the rollup, so for a year that
+is not over it can lag behind by up to `ORDER_ROLLUP_INTERVAL` plus
+`ORDER_ROLLUP_GRACE_SECONDS`, which the text of the report says.
+
+The balances are the current ones, so the report of a year changes as they
+do, even once the year is over. Reports of past years are cached for a while
+all the same, as nothing else about them changes.
+"""
+
 import datetime
+import math
+from collections import namedtuple
 
-from django.db.models import Sum, Count
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Min, Q, Sum
+from django.utils import timezone
 
-from .models import Profile, BalanceCode, Order
+from . import rollup
+from .models import BalanceCode, Profile
 
+# A line of the report: its number, None for the summary of the year, what it
+# is and how much in SEK.
+Line = namedtuple("Line", ["number", "text", "amount"])
 
-def get_bookkeep_data(year: int):
-    year_start = datetime.datetime(year, 1, 1)
-    year_end = datetime.datetime(year, 12, 31, 23, 59, 59)
-
-    balance_code_sum = BalanceCode.objects.filter(
-        used_at__range=(year_start, year_end)
-    ).aggregate(Sum("value"))
-    active_balance = (
-        Profile.objects.filter(user__order__put_at__range=(year_start, year_end))
-        .distinct()
-        .aggregate(Sum("balance"))
-    )
-    unused_balance_before = (
-        Profile.objects.filter(user__order__put_at__lt=year_start)
-        .exclude(user__order__put_at__range=(year_start, year_end))
-        .distinct()
-        .aggregate(Sum("balance"))
-    )
-    unused_balance_after = (
-        Profile.objects.filter(user__order__put_at__gt=year_end)
-        .exclude(user__order__put_at__range=(year_start, year_end))
-        .distinct()
-        .aggregate(Sum("balance"))
+
+def _key(year):
+    return "%s.%d" % (settings.BOOKKEEP_CACHE_KEY, year)
+
+
+def is_past(year):
+    return datetime.date(year + 1, 1, 1) <= timezone.localdate()
+
+
+def balances(first_day, last_day):
+    """The sums of the balances of every account, and of the accounts of
+    those who blipped from `first_day` through `last_day`, only before, only
+    after, both before and after but not during, and never."""
+    during = Q(user__daily_order_counts__date__range=(first_day, last_day))
+    profiles = Profile.objects.annotate(
+        first=Min("user__daily_order_counts__date"),
+        last=Max("user__daily_order_counts__date"),
+        days=Count("user__daily_order_counts", filter=during),
     )
-    unused_balance_dubble = (
-        Profile.objects.filter(user__order__put_at__lt=year_start)
-        .filter(user__order__put_at__gt=year_end)
-        .exclude(user__order__put_at__range=(year_start, year_end))
-        .distinct()
-        .aggregate(Sum("balance"))
+    sums = profiles.aggregate(
+        active=Sum("balance", filter=Q(days__gt=0)),
+        before=Sum("balance", filter=Q(days=0, first__lt=first_day)),
+        after=Sum("balance", filter=Q(days=0, last__gt=last_day)),
+        gap=Sum("balance", filter=Q(days=0, first__lt=first_day, last__gt=last_day)),
+        never=Sum("balance", filter=Q(first__isnull=True)),
+        total=Sum("balance"),
     )
-    unused_balance_never = (
-        Profile.objects.annotate(num_orders=Count("user__order"))
-        .filter(balance__gt=0, num_orders=0)
-        .order_by("user__date_joined", "user__last_login")
+    return {bucket: amount or 0 for bucket, amount in sums.items()}
+
+
+def _report(year):
+    first_day, last_day = datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+
+    refilled = (
+        BalanceCode.objects.filter(used_at__range=(first_day, last_day)).aggregate(
+            Sum("value")
+        )["value__sum"]
+        or 0
     )
+    paid = rollup.rows(first_day, last_day).aggregate(Sum("paid"))["paid__sum"] or 0
+    sums = balances(first_day, last_day)
 
-    for profile in unused_balance_never:
-        print(
-            f"{profile.user.username} har {profile.balance} kr (Gick med {profile.user.date_joined.strftime('%d/%m/%y')}, loggat in senast {profile.user.last_login.strftime('%d/%m/%y')})"
-        )
+    return [
+        Line(1, "Summan för aktiverade kaffekort under året", refilled),
+        Line(2, "Kontosumman för de som blippat under året", sums["active"]),
+        Line(
+            3,
+            "Kontosumman för de som blippat tidigare men inte under detta år",
+            sums["before"],
+        ),
+        Line(
+            4,
+            "Kontosumman för de som blippat efter men inte under detta år",
+            sums["after"],
+        ),
+        Line(
+            5,
+            "Kontosumman för de som finns med i både (3) och (4), "
+            "dvs. haft blippuppehåll",
+            sums["gap"],
+        ),
+        Line(6, "Kontosumman för de som aldrig någonsin blippat", sums["never"]),
+        Line(
+            7,
+            "Kontosumman för alla konton (2)+(3)+(4)-(5)+(6)=(7)",
+            sums["total"],
+        ),
+        Line(None, "Kaffekort aktiverade under året", refilled),
+        Line(None, "Summa på alla blipp under året", paid),
+        Line(None, "Balans (Insatt-uttaget)", refilled - paid),
+    ]
+
+
+def report(year):
+    """The `Line`s of the report of `year`."""
+    if not is_past(year):
+        return _report(year)
 
-    order_sum = Order.objects.filter(
-        put_at__range=(year_start, year_end), accepted=True
-    ).aggregate(Sum("paid"))
-    total_balance = Profile.objects.all().aggregate(Sum("balance"))
-
-    if balance_code_sum["value__sum"] is None:
-        balance_code_sum["value__sum"] = 0
-    if active_balance["balance__sum"] is None:
-        active_balance["balance__sum"] = 0
-    if unused_balance_before["balance__sum"] is None:
-        unused_balance_before["balance__sum"] = 0
-    if unused_balance_after["balance__sum"] is None:
-        unused_balance_after["balance__sum"] = 0
-    if unused_balance_dubble["balance__sum"] is None:
-        unused_balance_dubble["balance__sum"] = 0
-    # if unused_balance_never["balance__sum"] is None:
-    #     unused_balance_never["balance__sum"] = 0
-    if total_balance["balance__sum"] is None:
-        total_balance["balance__sum"] = 0
-    if order_sum["paid__sum"] is None:
-        order_sum["paid__sum"] = 0
-
-    res = ""
-    res += f"Bokföringsinformation för år {year}\n"
-    res += f"(1) Summan för aktiverade kaffekort under året: {balance_code_sum['value__sum']} SEK\n"
-    res += f"(2) Kontosumman för de som blippat under året: {active_balance['balance__sum']} SEK\n"
-    res += f"(3) Kontosumman för de som blippat tidigare men inte under detta år: {unused_balance_before['balance__sum']} SEK\n"
-    res += f"(4) Kontosumman för de som blippat efter men inte under detta år: {unused_balance_after['balance__sum']} SEK\n"
-    res += f"(5) Kontosumman för de som finns med i  både (3) och (4), dvs. haft blippuppehåll: {unused_balance_dubble['balance__sum']} SEK\n"
-    # res += f"(6) Kontosumman för de som aldrig någonsin blippat: {unused_balance_never['balance__sum']} SEK\n"
-    res += f"(7) Kontosumman för alla konton (2)+(3)+(4)-(5)+(6)=(7): {total_balance['balance__sum']} SEK\n"
-    res += "\n"
-    res += f"Kaffekort aktiverade under året: {balance_code_sum['value__sum']} SEK\n"
-    res += f"Summa på alla blipp under året: {order_sum['paid__sum']} SEK\n"
-    res += f"Balans {balance_code_sum['value__sum'] - order_sum['paid__sum']} SEK. (Insatt-uttaget)\n"
-    res += "\n"
+    lines = cache.get(_key(year))
+    if lines is None:
+        lines = _report(year)
+        cache.set(_key(year), lines, settings.BOOKKEEP_CACHE_TTL)
+    return lines
 
+
+def as_text(year, lines):
+    res = f"Bokföringsinformation för år {year}\n"
+    numbered = True
+    for line in lines:
+        if line.number is None and numbered:
+            # The summary of the year is set apart from the accounts.
+            res += "\n"
+            numbered = False
+        number = "" if line.number is None else f"({line.number}) "
+        res += f"{number}{line.text}: {line.amount} SEK\n"
+    if not is_past(year):
+        lag = settings.ORDER_ROLLUP_INTERVAL + settings.ORDER_ROLLUP_GRACE_SECONDS
+        res += (
+            f"\nSumman på alla blipp kan sakna de senaste {math.ceil(lag / 60)} "
+            "minuternas blipp.\n"
+        )
     return res
+
+
+def get_bookkeep_data(year: int):
+    return as_text(year, report(year))
+
+
+def as_rows(lines):
+    """The `lines` as CSV rows."""
+    return [
+        ("" if line.number is None else line.number, line.text, line.amount)
+        for line in lines
+    ]
+
+
+def never_blipped():
+    """The profiles with money left of users who have never blipped, the
+    ones that joined first first."""
+    return (
+        Profile.objects.filter(balance__gt=0, user__daily_order_counts__isnull=True)
+        .select_related("user")
+        .order_by("user__date_joined", "user__last_login")
+    )
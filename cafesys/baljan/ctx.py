@@ -11,10 +11,12 @@ def actions(request):
         "admin_semester",
         "bookkeep",
         "call_duty_week",
+        "export_orders",
         "job_opening",
         "search_person",
         "semester",
         "semester_shifts",
+        "shift_matching",
         "staff_homepage",
         "stats_active_blipp_users",
         "stats_blipp",
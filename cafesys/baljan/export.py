@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+CSV exports of any size in constant memory.
+
+Rows are read a chunk at a time with keyset pagination: every chunk starts
+after the last row of the one before it, by an indexed ordering, so that no
+chunk is slower than the first and nothing but the current chunk is kept in
+memory. The rows are written through the `csv` module, either to a file
+(like the stdout of a management command) or as a `StreamingHttpResponse`.
+"""
+
+import csv
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .models import Order
+
+CHUNK_SIZE = 2000
+
+# `format` turns a value of `field` into what is written, None to write it as
+# it is.
+Column = namedtuple("Column", ["header", "field", "format"], defaults=[None])
+
+
+def _local_time(value):
+    return timezone.localtime(value).strftime("%Y-%m-%d %H:%M:%S")
+
+
+ORDER_COLUMNS = (
+    Column("time", "put_at", _local_time),
+    Column("paid", "paid"),
+    Column("location", "location"),
+)
+
+
+def iterate(queryset, fields, order_by="pk", chunk_size=CHUNK_SIZE):
+    """Yields `values_list` rows of `fields` of `queryset`, ordered by
+    `order_by` and then the primary key, a chunk at a time."""
+    if order_by == "pk":
+        key_fields = ["pk"]
+    else:
+        key_fields = [order_by, "pk"]
+    queryset = queryset.order_by(*key_fields).values_list(*key_fields, *fields)
+    keys = len(key_fields)
+
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        for row in chunk:
+            yield row[keys:]
+        if len(chunk) < chunk_size:
+            return
+
+        last = chunk[-1]
+        if keys == 1:
+            after = Q(pk__gt=last[0])
+        else:
+            after = Q(**{order_by + "__gt": last[0]}) | Q(
+                **{order_by: last[0], "pk__gt": last[1]}
+            )
+        chunk = list(queryset.filter(after)[:chunk_size])
+
+
+def rows(queryset, columns, order_by="pk"):
+    """Yields the `columns` of `queryset` as lists, formatted."""
+    formats = [column.format for column in columns]
+    for row in iterate(queryset, [column.field for column in columns], order_by):
+        yield [value if fmt is None else fmt(value) for fmt, value in zip(formats, row)]
+
+
+def headers(columns):
+    return [column.header for column in columns]
+
+
+def write(file, rows, header=None, **fmtparams):
+    """Writes `rows` to `file` as CSV. Returns the number of rows written."""
+    writer = csv.writer(file, **fmtparams)
+    if header is not None:
+        writer.writerow(header)
+
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+class _Echo:
+    """A file that returns what is written to it, for `csv.writer` to format
+    rows without keeping them."""
+
+    def write(self, value):
+        return value
+
+
+def response(rows, filename, header=None):
+    """Returns a `StreamingHttpResponse` of `rows` as a CSV attachment."""
+    writer = csv.writer(_Echo())
+
+    def lines():
+        if header is not None:
+            yield writer.writerow(header)
+        for row in rows:
+            yield writer.writerow(row)
+
+    return StreamingHttpResponse(
+        lines(),
+        content_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": 'attachment; filename="%s"' % filename},
+    )
+
+
+def orders(start, end, locations=None):
+    """The orders from `start` through `end`, both dates in local time, at
+    `locations` (all by default), for `ORDER_COLUMNS`."""
+    start = timezone.make_aware(datetime.combine(start, time()))
+    end = timezone.make_aware(datetime.combine(end + timedelta(days=1), time()))
+
+    queryset = Order.objects.filter(put_at__gte=start, put_at__lt=end)
+    if locations is not None:
+        queryset = queryset.filter(location__in=locations)
+    return rows(queryset, ORDER_COLUMNS, order_by="put_at")
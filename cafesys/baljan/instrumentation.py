@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Per-view request statistics and query budgets.
+
+`RequestStatsMiddleware` counts the queries, database time, cache hits and
+misses and total time of every request, by view. Each request is logged as
+a JSON line, and the totals are kept in Redis for `get_request_stats`, which
+is shown to staff at /stats/requests.json. The totals are buffered in each
+process for a while before they are added to the ones in Redis.
+
+Views can be given a budget of queries in `settings.QUERY_BUDGETS`. Going
+over it is logged as a warning, and raises `QueryBudgetExceeded` when
+`settings.QUERY_BUDGET_RAISE` is set, which it is in tests (see
+`cafesys.baljan.testing.TestRunner`).
+"""
+
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from logging import getLogger
+
+from django.conf import settings
+from django.db import connection
+from django_redis import get_redis_connection
+from django_redis.cache import RedisCache
+
+logger = getLogger(__name__)
+
+FIELDS = (
+    "requests",
+    "queries",
+    "db_ms",
+    "cache_hits",
+    "cache_misses",
+    "total_ms",
+    "over_budget",
+)
+
+TRANSACTION_CONTROL = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+_recorder = ContextVar("request_stats_recorder", default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class Recorder(object):
+    """What has happened so far in one request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # Installed with `connection.execute_wrapper`.
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            # Savepoints depend on whether there is an outer transaction,
+            # like in tests, rather than on what the view does.
+            if not sql.startswith(TRANSACTION_CONTROL):
+                self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+
+def record_cache(hits, misses):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.cache_hits += hits
+        recorder.cache_misses += misses
+
+
+_missing = object()
+
+
+class InstrumentedRedisCache(RedisCache):
+    """The django-redis cache, counting hits and misses for the request."""
+
+    def get(self, key, default=None, version=None, client=None):
+        value = super().get(key, _missing, version=version, client=client)
+        if value is _missing:
+            record_cache(0, 1)
+            return default
+        record_cache(1, 0)
+        return value
+
+    def get_many(self, keys, version=None, client=None):
+        values = super().get_many(keys, version=version, client=client)
+        record_cache(len(values), len(keys) - len(values))
+        return values
+
+
+def get_view_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return None
+    return match.url_name or match.func.__qualname__
+
+
+class RequestStatsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = Recorder()
+        token = _recorder.set(recorder)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(recorder):
+                response = self.get_response(request)
+        finally:
+            _recorder.reset(token)
+        total_time = time.perf_counter() - start
+
+        view_name = get_view_name(request)
+        if view_name is not None:
+            self.record(request, response, view_name, recorder, total_time)
+
+        return response
+
+    def record(self, request, response, view_name, recorder, total_time):
+        budget = settings.QUERY_BUDGETS.get(view_name)
+        over_budget = budget is not None and recorder.queries > budget
+
+        stats = {
+            "view": view_name,
+            "method": request.method,
+            "status": response.status_code,
+            "queries": recorder.queries,
+            "db_ms": round(recorder.db_time * 1000, 2),
+            "cache_hits": recorder.cache_hits,
+            "cache_misses": recorder.cache_misses,
+            "total_ms": round(total_time * 1000, 2),
+        }
+
+        if over_budget:
+            logger.warning(json.dumps({**stats, "budget": budget}))
+        else:
+            logger.info(json.dumps(stats))
+
+        if settings.REQUEST_STATS_KEY:
+            buffer.add(stats, over_budget)
+
+        if over_budget and settings.QUERY_BUDGET_RAISE:
+            raise QueryBudgetExceeded(
+                "%s made %d queries, the budget is %d"
+                % (view_name, recorder.queries, budget)
+            )
+
+
+def _stats_key(view_name):
+    return "%s.%s" % (settings.REQUEST_STATS_KEY, view_name)
+
+
+class StatsBuffer(object):
+    """Per-process totals by view, added to the ones in Redis at most every
+    `settings.REQUEST_STATS_FLUSH_SECONDS`, so that requests do not have to
+    wait for Redis."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = defaultdict(Counter)
+        self.flushed_at = time.monotonic()
+
+    def add(self, stats, over_budget):
+        with self.lock:
+            totals = self.totals[stats["view"]]
+            totals["requests"] += 1
+            totals["over_budget"] += int(over_budget)
+            for field in ("queries", "db_ms", "cache_hits", "cache_misses", "total_ms"):
+                totals[field] += stats[field]
+
+            if (
+                time.monotonic() - self.flushed_at
+                < settings.REQUEST_STATS_FLUSH_SECONDS
+            ):
+                return
+
+            buffered, self.totals = self.totals, defaultdict(Counter)
+            self.flushed_at = time.monotonic()
+
+        try:
+            redis = get_redis_connection("default")
+            pipeline = redis.pipeline(transaction=False)
+            pipeline.sadd(settings.REQUEST_STATS_KEY, *buffered)
+            for view_name, totals in buffered.items():
+                key = _stats_key(view_name)
+                for field, value in totals.items():
+                    if isinstance(value, float):
+                        pipeline.hincrbyfloat(key, field, value)
+                    else:
+                        pipeline.hincrby(key, field, value)
+            pipeline.execute()
+        except Exception as e:
+            logger.warning("could not store request stats: %s" % e)
+
+
+buffer = StatsBuffer()
+
+
+def get_request_stats():
+    """Returns the totals and averages per view since the stats were last
+    reset, as a dict by view name."""
+    redis = get_redis_connection("default")
+    view_names = sorted(
+        name.decode() for name in redis.smembers(settings.REQUEST_STATS_KEY)
+    )
+
+    pipeline = redis.pipeline(transaction=False)
+    for view_name in view_names:
+        pipeline.hgetall(_stats_key(view_name))
+
+    result = {}
+    for view_name, values in zip(view_names, pipeline.execute()):
+        totals = {field: float(values.get(field.encode(), 0)) for field in FIELDS}
+        count = totals["requests"] or 1
+        result[view_name] = {
+            "requests": int(totals["requests"]),
+            "over_budget": int(totals["over_budget"]),
+            "budget": settings.QUERY_BUDGETS.get(view_name),
+            "avg_queries": round(totals["queries"] / count, 2),
+            "avg_db_ms": round(totals["db_ms"] / count, 2),
+            "avg_total_ms": round(totals["total_ms"] / count, 2),
+            "cache_hits": int(totals["cache_hits"]),
+            "cache_misses": int(totals["cache_misses"]),
+        }
+    return result
+
+
+def reset_request_stats():
+    with buffer.lock:
+        buffer.totals = defaultdict(Counter)
+
+    redis = get_redis_connection("default")
+    view_names = redis.smembers(settings.REQUEST_STATS_KEY)
+    redis.delete(
+        settings.REQUEST_STATS_KEY,
+        *[_stats_key(name.decode()) for name in view_names],
+    )
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+The high score, counted as orders are made.
+
+Every accepted order adds one to the `DailyOrderCount` of its user, location
+and day, in the same transaction as the order itself. A ranking for any
+interval is then a sum over at most one row per user and day, instead of a
+count over all orders. Which list a user is ranked in follows
+`Profile.staff_class`, which is kept up to date as groups and shifts change.
+
+The counts follow orders that are saved or deleted one by one. Anything that
+bypasses the signals, like `QuerySet.update` or `bulk_create` of orders,
+needs a `rebuild` afterwards (see the rebuild_leaderboard command).
+"""
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum, Window
+from django.db.models.functions import DenseRank, TruncDate
+
+from .models import DailyOrderCount, Order, Profile
+from .util import local_date
+
+STAFF_CLASSES = (
+    Profile.STAFF_CLASS_NONE,
+    Profile.STAFF_CLASS_OLD_WORKER,
+    Profile.STAFF_CLASS_STAFF,
+)
+
+_KEY_FIELDS = ("put_at", "location", "user_id", "accepted")
+
+# The key of an order that was loaded without all of `_KEY_FIELDS`.
+_UNKNOWN = object()
+
+
+def order_key(order):
+    """The (date, location, user id) that `order` is counted under, or None
+    if it is not counted."""
+    fields = order.__dict__
+    if not fields.get("accepted") or fields.get("user_id") is None:
+        return None
+
+    return (local_date(fields["put_at"]), fields["location"], fields["user_id"])
+
+
+def _quoted(*names):
+    return [connection.ops.quote_name(name) for name in names]
+
+
+def add(key):
+    table, date, location, user_id, count = _quoted(
+        DailyOrderCount._meta.db_table, "date", "location", "user_id", "count"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO {table} ({date}, {location}, {user_id}, {count}) "
+            "VALUES (%s, %s, %s, 1) "
+            "ON CONFLICT ({date}, {location}, {user_id}) "
+            "DO UPDATE SET {count} = {table}.{count} + 1".format(
+                table=table, date=date, location=location, user_id=user_id, count=count
+            ),
+            list(key),
+        )
+
+
+def remove(key):
+    day, location, user_id = key
+    counts = DailyOrderCount.objects.filter(date=day, location=location, user=user_id)
+    # The last order of the day removes the row, and the order of the two
+    # matters: a row that was just decremented to 1 is not to be deleted.
+    if not counts.filter(count__lte=1).delete()[0]:
+        counts.update(count=F("count") - 1)
+
+
+def order_post_init(sender, instance=None, **kwargs):
+    if all(field in instance.__dict__ for field in _KEY_FIELDS):
+        instance._leaderboard_key = order_key(instance)
+    else:
+        instance._leaderboard_key = _UNKNOWN
+
+
+def order_post_save(sender, instance=None, created=False, raw=False, **kwargs):
+    if instance is None or raw:
+        return
+
+    old_key = None if created else instance._leaderboard_key
+    if old_key is _UNKNOWN:
+        return
+
+    new_key = order_key(instance)
+    if new_key == old_key:
+        return
+
+    if old_key is not None:
+        remove(old_key)
+    if new_key is not None:
+        add(new_key)
+    instance._leaderboard_key = new_key
+
+
+def order_post_delete(sender, instance=None, **kwargs):
+    if instance is None:
+        return
+
+    key = instance._leaderboard_key
+    if key is _UNKNOWN:
+        key = order_key(instance)
+    if key is not None:
+        remove(key)
+
+
+def rebuild():
+    """Counts all orders again."""
+    counts = (
+        Order.objects.filter(accepted=True)
+        .annotate(date=TruncDate("put_at"))
+        .values("date", "location", "user")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+
+    with transaction.atomic():
+        DailyOrderCount.objects.all().delete()
+        DailyOrderCount.objects.bulk_create(
+            (
+                DailyOrderCount(
+                    date=row["date"],
+                    location=row["location"],
+                    user_id=row["user"],
+                    count=row["count"],
+                )
+                for row in counts.iterator()
+            ),
+            batch_size=1000,
+        )
+
+
+def get_counts(dates=None, location=None):
+    """The daily counts within `dates`, a two-tuple (first day, last day)."""
+    counts = DailyOrderCount.objects.all()
+    if dates is not None:
+        counts = counts.filter(date__range=dates)
+    if location is not None:
+        counts = counts.filter(location=location)
+    return counts
+
+
+def get_top_users(staff_classes, dates=None, location=None, limit=15, public_only=True):
+    """The users in `staff_classes` by their number of orders within `dates`,
+    with `num_orders` and `rank` annotated, best first."""
+    filter_args = {"daily_order_counts__count__gt": 0}
+    if dates is not None:
+        filter_args["daily_order_counts__date__range"] = dates
+    if location is not None:
+        filter_args["daily_order_counts__location"] = location
+
+    top = User.objects.filter(**filter_args).filter(
+        profile__staff_class__in=staff_classes
+    )
+    if public_only:
+        top = top.filter(profile__show_profile=True)
+
+    top = (
+        top.annotate(
+            num_orders=Sum("daily_order_counts__count"),
+            rank=Window(expression=DenseRank(), order_by=F("num_orders").desc()),
+        )
+        .select_related("profile")
+        .order_by("-num_orders")
+    )
+
+    if limit is not None:
+        top = top[:limit]
+
+    return list(top)
+
+
+def get_rank(user, staff_classes, dates=None, location=None):
+    """Returns a two-tuple (rank, number of orders) of `user` among the users
+    in `staff_classes`."""
+    counts = get_counts(dates, location)
+    score = counts.filter(user=user).aggregate(score=Sum("count"))["score"] or 0
+
+    rank = (
+        counts.filter(user__profile__staff_class__in=staff_classes)
+        .values("user")
+        .annotate(num_orders=Sum("count"))
+        .filter(num_orders__gt=score)
+        .values("num_orders")
+        .distinct()
+        .count()
+        + 1
+    )
+
+    return rank, score
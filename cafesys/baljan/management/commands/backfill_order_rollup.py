@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import rollup
+from ...util import date_range
+
+
+class Command(BaseCommand):
+    """
+    The order rollup is counted again as a whole whenever its watermark is
+    missing, and day by day as orders are made. This counts it again right
+    away, e.g. after orders have been imported or changed with `QuerySet`
+    methods that do not send signals.
+    """
+
+    help = "Count the order rollup of all orders, or of some days, again."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="start", type=date.fromisoformat)
+        parser.add_argument("--to", dest="end", type=date.fromisoformat)
+
+    def handle(self, *args, **options):
+        start, end = options["start"], options["end"]
+        if start is None and end is None:
+            rollup.backfill()
+            self.stdout.write("Counted all orders.")
+            return
+
+        if start is None or end is None or end < start:
+            raise CommandError("give both --from and --to, in order")
+
+        rollup.backfill(list(date_range(start, end)))
+        self.stdout.write("Counted the orders from %s to %s." % (start, end))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+import pytz
+
+from cafesys.baljan import views
+from ...models import BlippConfiguration, Good, GoodCost, Order, OrderGood
+
+USERNAME_PREFIX = "benchmark-blipp-"
+CARD_ID_OFFSET = 9_000_000_000
+
+
+@transaction.atomic
+def legacy_blipp(request):
+    """The blipp as it was before `cafesys.baljan.blipp`, one ORM round-trip
+    per step. Only kept here to have something to compare against."""
+    token = request.headers["authorization"].split()[1]
+    config = BlippConfiguration.objects.select_related("good").get(token=token)
+    rfid_int = config.get_standardised_reader_output(request.POST["id"])
+    user = User.objects.select_related("profile").get(profile__card_id=rfid_int)
+
+    price = config.good.current_cost().cost
+    free_with_cooldown = user.has_perm("baljan.free_coffee_with_cooldown")
+    free_unlimited = user.has_perm("baljan.free_coffee_unlimited")
+    is_coffee_free = free_unlimited or free_with_cooldown
+    has_cooldown = free_with_cooldown and not free_unlimited
+
+    if has_cooldown:
+        try:
+            Order.objects.filter(accepted=True, user=user).latest("put_at")
+        except Order.DoesNotExist:
+            pass
+
+    tz = pytz.timezone(settings.TIME_ZONE)
+
+    balance = user.profile.balance
+    new_balance = balance
+    if not is_coffee_free:
+        new_balance = max(balance - price, 0)
+        user.profile.balance = new_balance
+        user.profile.save()
+
+    order = Order()
+    order.location = config.location
+    order.put_at = datetime.now(tz)
+    order.user = user
+    order.paid = 0 if is_coffee_free else balance - new_balance
+    order.currency = "SEK"
+    order.accepted = True
+    order.save()
+
+    order_good = OrderGood()
+    order_good.order = order
+    order_good.good = config.good
+    order_good.count = 1
+    order_good.save()
+
+
+class Command(BaseCommand):
+    """
+    Seeds users and a blipp configuration, taps their cards as fast as possible
+    and reports blipps per second and queries per blipp, once for the blipp as
+    it used to be and once for the current one. Everything that is created is
+    removed afterwards.
+
+    Run this against a local Postgres (see DJANGO_DATABASE_URL), never against
+    production. Requests go straight to the view, so middleware is not
+    included in the numbers.
+    """
+
+    help = "Benchmark the blipp against the configured database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("-n", "--taps", type=int, default=2000)
+        parser.add_argument("-u", "--users", type=int, default=200)
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError("refusing to benchmark with DEBUG off")
+
+        taps = options["taps"]
+        user_count = options["users"]
+
+        token = "benchmark-%d" % random.randint(0, 2**31)
+        good = Good.objects.create(title="Benchmark")
+        GoodCost.objects.create(
+            good=good, cost=9, from_date=date.today() - timedelta(days=1)
+        )
+        BlippConfiguration.objects.create(token=token, good=good)
+
+        try:
+            users = [
+                User.objects.create(username="%s%d" % (USERNAME_PREFIX, i))
+                for i in range(user_count)
+            ]
+            for i, user in enumerate(users):
+                user.profile.card_id = CARD_ID_OFFSET + i
+                user.profile.balance = taps * 10
+                user.profile.save()
+
+            factory = RequestFactory()
+            card_ids = [
+                str(CARD_ID_OFFSET + random.randrange(user_count)) for _ in range(taps)
+            ]
+            requests = [
+                factory.post(
+                    "/do-blipp",
+                    {"id": card_id},
+                    HTTP_AUTHORIZATION="Token %s" % token,
+                )
+                for card_id in card_ids
+            ]
+
+            self.stdout.write("%d taps over %d users" % (taps, user_count))
+            self.stdout.write("path, blipps/s, queries/blipp")
+            for name, view in (("legacy", legacy_blipp), ("service", views.do_blipp)):
+                self.run(name, view, requests)
+        finally:
+            User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+            good.delete()
+            BlippConfiguration.objects.filter(token=token).delete()
+
+    def run(self, name, view, requests):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for request in requests:
+                view(request)
+            elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            "%s, %.1f, %.2f"
+            % (name, len(requests) / elapsed, len(queries) / len(requests))
+        )
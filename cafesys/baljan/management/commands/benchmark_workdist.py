@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import math
+import random
+import time
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+from io import StringIO
+
+from django.core.management.base import BaseCommand
+
+from ...workdist.available_shift import AvailableShift
+from ...workdist.shift_assigner import ShiftAssigner
+
+# Weeks of alternating exam period and not, as in a fall semester.
+SEMESTER_WEEKS = [(True, 2), (False, 7), (True, 2), (False, 7)]
+
+
+class LegacyShiftCombination:
+    def __init__(self, index):
+        self.index = index
+        self.shifts = []
+
+    def number_of_shifts_in_exam_period(self):
+        return len([x for x in self.shifts if x.exam_period])
+
+    def contains_shift_of_kind(self, other_shift):
+        for shift in self.shifts:
+            if shift.is_same_kind(other_shift):
+                return True
+
+        return False
+
+    def contains_shift_at_same_day(self, other_shift):
+        for shift in self.shifts:
+            if shift.date == other_shift.date:
+                return True
+
+        return False
+
+
+class LegacyShiftAssigner:
+    """The shift assigner as it was before it kept indexes of the
+    combinations, searching through all of them for every shift. Only kept
+    here to have something to compare against."""
+
+    def __init__(self, shifts_per_combination=4):
+        self.all_shifts = []
+        self.shift_combinations = []
+        self.shifts_per_combination = shifts_per_combination
+
+    def assign_to_best_combination(self, shift):
+        used_combinations = self.select_from_smallest_number_of(
+            self.shift_combinations, lambda x: len(x.shifts)
+        )
+
+        if shift.exam_period:
+            used_combinations = self.select_from_smallest_number_of(
+                used_combinations, lambda x: x.number_of_shifts_in_exam_period()
+            )
+
+        for comb in used_combinations:
+            if not comb.contains_shift_of_kind(shift):
+                self.assign_shift_to_combination(shift, comb)
+                return
+
+        for comb in used_combinations:
+            if not comb.contains_shift_at_same_day(shift):
+                self.assign_shift_to_combination(shift, comb)
+                print("Assigned sub-optimal shift (" + str(id(comb)) + ")")
+                return
+
+        raise Exception(
+            "Impossible to assign shifts without assigning two shifts at the same day"
+        )
+
+    def assign_shift_to_combination(self, shift, comb):
+        self.shift_combinations.remove(comb)
+        self.shift_combinations.append(comb)
+
+        comb.shifts.append(shift)
+
+    def select_from_smallest_number_of(self, collection, f):
+        segments = {}
+        for item in collection:
+            segments.setdefault(f(item), []).append(item)
+
+        return segments[min(segments.keys())]
+
+    def assign(self):
+        num_combinations = math.ceil(len(self.all_shifts) / self.shifts_per_combination)
+
+        for i in range(num_combinations):
+            self.shift_combinations.append(LegacyShiftCombination(i))
+
+        for shift in self.all_shifts:
+            self.assign_to_best_combination(shift)
+
+
+def synthetic_shifts(years, rng, disabled=0.0):
+    """The worker shifts of a semester that is `years` years long, in the
+    order `WorkdistAdapter.load_from_db` reads them. A share `disabled` of
+    them are left out, like shifts that have been disabled."""
+    shifts = []
+    day = date(2019, 8, 19)
+    for _ in range(years * 2):
+        for exam_period, weeks in SEMESTER_WEEKS:
+            for _ in range(weeks * 7):
+                if day.weekday() < 5:
+                    for span in (0, 2):
+                        for location in (0, 1):
+                            if rng.random() >= disabled:
+                                shifts.append(
+                                    AvailableShift(
+                                        date=day,
+                                        location=location,
+                                        span=span,
+                                        exam_period=exam_period,
+                                        database_id=len(shifts),
+                                    )
+                                )
+                day += timedelta(days=1)
+
+    shifts.sort(key=lambda s: (not s.exam_period, s.date, s.span, s.location))
+    return shifts
+
+
+def assignment(assigner):
+    """What an assigner has come to, to compare assigners with."""
+    return [
+        (comb.index, [shift.database_id for shift in comb.shifts])
+        for comb in assigner.shift_combinations
+    ]
+
+
+class Command(BaseCommand):
+    """
+    Assigns the shifts of synthetic semesters that are several years long to
+    combinations, once with the shift assigner as it used to be and once with
+    the current one, and reports the time each took and whether they came to
+    the same combinations.
+    """
+
+    help = "Benchmark the shift assigner of the work distribution."
+
+    def add_arguments(self, parser):
+        parser.add_argument("-y", "--years", type=int, nargs="+", default=[1, 2, 4])
+        parser.add_argument("--disabled", type=float, default=0.05)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write("years, shifts, legacy s, indexed s, speedup, identical")
+        for years in options["years"]:
+            shifts = synthetic_shifts(
+                years, random.Random(options["seed"]), options["disabled"]
+            )
+
+            results = []
+            for assigner in (LegacyShiftAssigner(), ShiftAssigner()):
+                assigner.all_shifts = list(shifts)
+                start = time.perf_counter()
+                # Sub-optimal assignments are printed.
+                with redirect_stdout(StringIO()):
+                    assigner.assign()
+                results.append((time.perf_counter() - start, assignment(assigner)))
+
+            (legacy, expected), (indexed, actual) = results
+            self.stdout.write(
+                "%d, %d, %.3f, %.3f, %.1fx, %s"
+                % (
+                    years,
+                    len(shifts),
+                    legacy,
+                    indexed,
+                    legacy / indexed,
+                    "yes" if actual == expected else "NO",
+                )
+            )
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from django.core.management.base import BaseCommand
 
-from ...bookkeep import get_bookkeep_data
+from ...bookkeep import get_bookkeep_data, never_blipped
 
 
 class Command(BaseCommand):
@@ -10,7 +10,19 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         # Positional arguments
         parser.add_argument("year", type=int)
+        parser.add_argument(
+            "--never",
+            action="store_true",
+            help="Also list who has money left but has never blipped.",
+        )
 
     def handle(self, *args, **options):
         year = options["year"]
         print(get_bookkeep_data(year))
+
+        if options["never"]:
+            for profile in never_blipped():
+                last_login = profile.user.last_login
+                print(
+                    f"{profile.user.username} har {profile.balance} kr (Gick med {profile.user.date_joined.strftime('%d/%m/%y')}, loggat in senast {last_login.strftime('%d/%m/%y') if last_login else 'aldrig'})"
+                )
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
-from datetime import date
-
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
 
-from ...models import Order
+from ... import export, rollup
 
 
 class Command(BaseCommand):
@@ -15,35 +15,21 @@ class Command(BaseCommand):
         if not valid:
             raise CommandError("invalid config")
 
-        def datetime_to_month(dt):
-            return date(dt.year, dt.month, 1)
-
-        orders = Order.objects.all().order_by("put_at")
-        current_day = None
-        dates = []
-        for o in orders:
-            this_date = datetime_to_month(o.put_at)
-            if current_day == this_date:
-                pass
-            else:
-                current_day = this_date
-                dates.append(this_date)
-
-        years = sorted(set([d.year for d in dates]))
-        months = sorted(set([d.month for d in dates]))
-
-        order_counts = []
-        for m in months:
-            counts = []
-            for y in years:
-                counts.append(
-                    Order.objects.filter(
-                        put_at__year=y,
-                        put_at__month=m,
-                    ).count()
-                )
-            order_counts.append((m, counts))
-
-        print("month, %s" % ", ".join([str(y) for y in years]))
-        for m, year_counts in reversed(order_counts):
-            print("%d, %s" % (m, ", ".join([str(yc) for yc in year_counts])))
+        counts = {
+            (row["year"], row["month"]): row["count"]
+            for row in rollup.rows()
+            .annotate(year=ExtractYear("date"), month=ExtractMonth("date"))
+            .values("year", "month")
+            .annotate(count=Sum("count"))
+            .order_by()
+        }
+
+        years = sorted(set([y for y, _ in counts]))
+        months = sorted(set([m for _, m in counts]))
+
+        export.write(
+            self.stdout,
+            ([m] + [counts.get((y, m), 0) for y in years] for m in reversed(months)),
+            header=["month"] + years,
+            lineterminator="\n",
+        )
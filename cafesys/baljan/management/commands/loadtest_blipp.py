@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+import logging
+import random
+import statistics
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+import requests
+
+from ... import blipp, stats
+from ...models import BlippConfiguration, Good, GoodCost, Located, Profile
+
+USERNAME_PREFIX = "loadtest-blipp-"
+TOKEN_PREFIX = "loadtest-blipp-"
+CARD_ID_OFFSET = 8_000_000_000
+
+
+class Command(BaseCommand):
+    """
+    Seeds users with cards and balances and a blipp configuration per
+    location, replays a day of taps against the blipp and then loads the high
+    score with a cold and a warm cache. Reports latency percentiles,
+    throughput and queries per request for each kind of request. Everything
+    that is created is removed afterwards.
+
+    The taps come in bursts, like the queue in the morning rush. Popular
+    users tap more often than others, some taps are repeated right away (and
+    hit the cooldown for users with free coffee with cooldown) and some are
+    from cards that nobody has.
+
+    By default the requests go through the test client, in process, with all
+    middleware. With --url they are sent to a running server instead, in
+    which case the queries cannot be counted. The users are always seeded in
+    the configured database, so the server must use the same one. Never run
+    this against production.
+    """
+
+    help = "Load test the blipp and the high score against the configured database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("-n", "--taps", type=int, default=5000)
+        parser.add_argument("-u", "--users", type=int, default=500)
+        parser.add_argument(
+            "--cooldown",
+            type=float,
+            default=0.1,
+            help="share of users with free coffee with cooldown",
+        )
+        parser.add_argument(
+            "--repeat", type=float, default=0.05, help="share of taps repeated at once"
+        )
+        parser.add_argument(
+            "--unknown", type=float, default=0.02, help="share of taps by unknown cards"
+        )
+        parser.add_argument(
+            "--burst", type=int, default=30, help="the average number of taps in a row"
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="seconds between bursts, 0 to go as fast as possible",
+        )
+        parser.add_argument("--high-score", type=int, default=50)
+        parser.add_argument("--url", help="e.g. http://localhost:8000")
+        parser.add_argument("--seed", type=int, help="for a reproducible run")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError("refusing to load test with DEBUG off")
+
+        self.random = random.Random(options["seed"])
+        self.url = options["url"]
+        if self.url:
+            self.session = requests.Session()
+        else:
+            self.client = Client(raise_request_exception=False)
+
+        # Refused blipps and views over their query budget are logged as
+        # warnings, which would drown the report.
+        quiet_loggers = [
+            logging.getLogger(name)
+            for name in ("django.request", "cafesys.baljan.instrumentation")
+        ]
+        levels = [logger.level for logger in quiet_loggers]
+        if options["verbosity"] < 2:
+            for logger in quiet_loggers:
+                logger.setLevel(logging.ERROR)
+
+        good = Good.objects.create(title="Load test")
+        GoodCost.objects.create(
+            good=good, cost=9, from_date=date.today() - timedelta(days=1)
+        )
+
+        try:
+            tokens = self.seed(good, options)
+            taps = self.schedule(tokens, options)
+
+            self.stdout.write(
+                "%d taps over %d users and %d readers"
+                % (len(taps), options["users"], len(tokens))
+            )
+            self.stdout.write(
+                "request, count, errors, p50 ms, p95 ms, p99 ms, requests/s, queries/request"
+            )
+
+            self.replay(taps, options["burst"], options["pause"])
+            self.load_high_score(options["high_score"])
+        finally:
+            User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+            BlippConfiguration.objects.filter(token__startswith=TOKEN_PREFIX).delete()
+            good.delete()
+            for logger, level in zip(quiet_loggers, levels):
+                logger.setLevel(level)
+
+    def seed(self, good, options):
+        User.objects.bulk_create(
+            User(username="%s%d" % (USERNAME_PREFIX, i))
+            for i in range(options["users"])
+        )
+        # bulk_create does not send post_save, so the profiles are made here.
+        users = list(
+            User.objects.filter(username__startswith=USERNAME_PREFIX).order_by("id")
+        )
+        Profile.objects.bulk_create(
+            Profile(user=user, card_id=CARD_ID_OFFSET + i, balance=options["taps"] * 10)
+            for i, user in enumerate(users)
+        )
+        # Nor does it tell the card index about the new cards.
+        blipp.renew_card_index_version()
+
+        cooldown = Permission.objects.get(
+            content_type__app_label="baljan", codename="free_coffee_with_cooldown"
+        )
+        for user in self.random.sample(users, int(len(users) * options["cooldown"])):
+            user.user_permissions.add(cooldown)
+
+        tokens = []
+        for location, _ in Located.LOCATION_CHOICES:
+            token = "%s%d" % (TOKEN_PREFIX, self.random.randint(0, 2**31))
+            BlippConfiguration.objects.create(token=token, good=good, location=location)
+            tokens.append(token)
+
+        return tokens
+
+    def schedule(self, tokens, options):
+        """Returns a list of (kind, card id, token)."""
+        user_count = options["users"]
+        # Roughly Zipf: a few users blipp a lot, most now and then.
+        weights = [1 / (rank + 1) for rank in range(user_count)]
+
+        taps = []
+        while len(taps) < options["taps"]:
+            token = self.random.choice(tokens)
+            if self.random.random() < options["unknown"]:
+                card_id = CARD_ID_OFFSET + user_count + self.random.randrange(10**6)
+                taps.append(("unknown", card_id, token))
+                continue
+
+            user = self.random.choices(range(user_count), weights)[0]
+            taps.append(("tap", CARD_ID_OFFSET + user, token))
+            if self.random.random() < options["repeat"]:
+                taps.append(("repeat", CARD_ID_OFFSET + user, token))
+
+        return taps[: options["taps"]]
+
+    def request(self, method, path, **kwargs):
+        """Returns a three-tuple (status code, seconds, queries)."""
+        if self.url:
+            start = time.perf_counter()
+            response = self.session.request(method, self.url + path, **kwargs)
+            return response.status_code, time.perf_counter() - start, None
+
+        headers = {
+            "HTTP_" + key.upper().replace("-", "_"): value
+            for key, value in kwargs.get("headers", {}).items()
+        }
+        # The query log is capped, which would throw off the count after a while.
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            if method == "POST":
+                response = self.client.post(path, kwargs.get("data"), **headers)
+            else:
+                response = self.client.get(path, **headers)
+            elapsed = time.perf_counter() - start
+
+        return response.status_code, elapsed, len(queries)
+
+    def replay(self, taps, burst, pause):
+        samples = defaultdict(list)
+
+        start = time.perf_counter()
+        remaining_in_burst = 0
+        for kind, card_id, token in taps:
+            if remaining_in_burst == 0:
+                remaining_in_burst = max(1, int(self.random.expovariate(1 / burst)))
+                if pause:
+                    time.sleep(self.random.uniform(0, 2 * pause))
+            remaining_in_burst -= 1
+
+            samples[kind].append(
+                self.request(
+                    "POST",
+                    "/do-blipp",
+                    data={"id": str(card_id)},
+                    headers={"Authorization": "Token %s" % token},
+                )
+            )
+        elapsed = time.perf_counter() - start
+
+        for kind, kind_samples in samples.items():
+            self.report("blipp (%s)" % kind, kind_samples)
+        self.report("blipp", sum(samples.values(), []), elapsed)
+
+    def load_high_score(self, count):
+        if count <= 0:
+            return
+
+        locations = [None] + [location for location, _ in Located.LOCATION_CHOICES]
+        paths = ["/high-score"] + [
+            "/high-score/%d" % location for location in locations[1:]
+        ]
+
+        cache.delete_many([stats.get_cache_key(location) for location in locations])
+        self.report("high score (cold)", [self.request("GET", paths[0])])
+
+        samples = [self.request("GET", self.random.choice(paths)) for _ in range(count)]
+        self.report("high score", samples)
+
+    def report(self, name, samples, elapsed=None):
+        statuses = [status for status, _, _ in samples]
+        latencies = sorted(seconds * 1000 for _, seconds, _ in samples)
+        queries = [count for _, _, count in samples if count is not None]
+
+        if len(latencies) > 1:
+            percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+            p50, p95, p99 = percentiles[49], percentiles[94], percentiles[98]
+        else:
+            p50 = p95 = p99 = latencies[0]
+
+        if elapsed is None:
+            elapsed = sum(latencies) / 1000
+
+        self.stdout.write(
+            "%s, %d, %d, %.1f, %.1f, %.1f, %.1f, %s"
+            % (
+                name,
+                len(samples),
+                sum(1 for status in statuses if status >= 500),
+                p50,
+                p95,
+                p99,
+                len(samples) / elapsed,
+                "%.2f" % (sum(queries) / len(queries)) if queries else "-",
+            )
+        )
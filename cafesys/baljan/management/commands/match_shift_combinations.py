@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cafesys.baljan.models import Semester, User
+from cafesys.baljan.workdist import matching
+
+
+class Command(BaseCommand):
+    help = (
+        "Match the workers of the semester given to the shift combinations "
+        "they have listed, by their preferences"
+    )
+    missing_args_message = "no semester name given."
+
+    def add_arguments(self, parser):
+        parser.add_argument("semester", type=str)
+        parser.add_argument(
+            "--save",
+            action="store_true",
+            help="sign the workers up for the shifts of their combinations",
+        )
+
+    def handle(self, *args, **options):
+        semester_name = options["semester"]
+        try:
+            semester = Semester.objects.get(name=semester_name)
+        except Semester.DoesNotExist:
+            raise CommandError("could not find semester named %s" % semester_name)
+
+        start_time = time.time()
+        result = matching.match(semester)
+        elapsed = time.time() - start_time
+
+        usernames = dict(
+            User.objects.filter(
+                id__in=[m.user_id for m in result.matches] + result.unmatched
+            ).values_list("id", "username")
+        )
+        for m in result.matches:
+            self.stdout.write(
+                "%s %s (priority %d)"
+                % (m.combination, usernames[m.user_id], m.priority)
+            )
+        for user_id in result.unmatched:
+            self.stdout.write("unmatched: %s" % usernames[user_id])
+
+        self.stdout.write(
+            "Matched %d workers with a total priority of %d in %f secs"
+            % (len(result.matches), result.cost, elapsed)
+        )
+
+        if options["save"]:
+            signups = matching.save(semester, result.matches)
+            self.stdout.write("Created %d shift sign-ups" % len(signups))
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from ... import leaderboard
+from ...models import Profile, update_staff_classes
+
+
+class Command(BaseCommand):
+    """
+    The high score is counted as orders are made. Orders that are created or
+    changed without signals, like with `bulk_create` or `QuerySet.update`, are
+    not counted until this is run.
+    """
+
+    help = "Count the orders and staff classes of the high score again."
+
+    def handle(self, *args, **options):
+        update_staff_classes(Profile.objects.values_list("user", flat=True))
+        leaderboard.rebuild()
+        self.stdout.write(
+            "Counted the orders of %d days."
+            % leaderboard.get_counts().values("date").distinct().count()
+        )
@@ -1,56 +1,26 @@
 # -*- coding: utf-8 -*-
-from datetime import datetime, timedelta
-
-import sys
-from time import sleep
+from datetime import date
 
 from django.core.management.base import BaseCommand
 
+from ... import export
 from ...models import Order
 
-import gc
-
-
-def queryset_iterator(queryset, chunksize=1000):
-    """
-    Iterate over a Django Queryset ordered by the primary key
-
-    This method loads a maximum of chunksize (default: 1000) rows in it's
-    memory at the same time while django normally would load all rows in it's
-    memory. Using the iterator() method only causes it to not preload all the
-    classes.
-
-    Note that the implementation of the iterator does not support ordered query sets.
-    """
-    if not queryset:
-        return
-
-    pk = 0
-    last_pk = queryset.order_by("-pk")[0].pk
-    queryset = queryset.order_by("pk")
-    while pk < last_pk:
-        for row in queryset.filter(pk__gt=pk)[:chunksize]:
-            pk = row.pk
-            yield row
-        gc.collect()
-
 
 class Command(BaseCommand):
     """
     Iterates through all orders between (and including) the two specified dates,
     printing the time of the blipp as well as how much was paid for the coffee.
 
-    You might not want to run this command during working hours because of the
-    performance implications.
+    The orders are read a chunk at a time (see `cafesys.baljan.export`), so
+    any number of them can be dumped in constant memory.
     """
 
     help = "Dump all blipps between two dates in CSV format."
 
     def add_arguments(self, parser):
-        parser.add_argument(
-            "date_from", type=lambda d: datetime.strptime(d, "%Y-%m-%d")
-        )
-        parser.add_argument("date_to", type=lambda d: datetime.strptime(d, "%Y-%m-%d"))
+        parser.add_argument("date_from", type=date.fromisoformat)
+        parser.add_argument("date_to", type=date.fromisoformat)
 
         location_choices = [
             location_choice[0] for location_choice in Order.LOCATION_CHOICES
@@ -75,29 +45,11 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
-        date_from = options["date_from"]
-        date_to = options["date_to"] + timedelta(hours=23, minutes=59, seconds=59)
-        location = options["location"]
-
-        orders = Order.objects.filter(
-            put_at__range=(date_from, date_to), location__in=location
+        export.write(
+            self.stdout,
+            export.orders(
+                options["date_from"], options["date_to"], options["location"]
+            ),
+            header=export.headers(export.ORDER_COLUMNS),
+            lineterminator="\n",
         )
-        orders_queryset = queryset_iterator(orders)
-        print("time, paid, location")
-
-        iterations_since_sleep = 0
-        for order in orders_queryset:
-            print(
-                "%s, %d, %d"
-                % (
-                    order.put_at.strftime("%Y-%m-%d %H:%M:%S"),
-                    order.paid,
-                    order.location,
-                )
-            )
-            iterations_since_sleep += 1
-
-            if iterations_since_sleep >= 1000:
-                iterations_since_sleep = 0
-                sys.stdout.flush()
-                sleep(0.05)
@@ -0,0 +1,81 @@
+# Generated by Django 5.2.1 on 2026-10-18 20:20
+
+from django.db import migrations, models
+
+
+ENTITLEMENT_PERMISSIONS = (
+    "free_coffee_unlimited",
+    "free_coffee_with_cooldown",
+    "online_refill",
+)
+
+
+def compute_entitlements(apps, schema_editor):
+    User = apps.get_model("auth", "User")
+    Profile = apps.get_model("baljan", "Profile")
+    Permission = apps.get_model("auth", "Permission")
+
+    perms = Permission.objects.filter(
+        content_type__app_label="baljan", codename__in=ENTITLEMENT_PERMISSIONS
+    )
+
+    granted = {}
+    for user_id, codename in perms.filter(group__user__isnull=False).values_list(
+        "group__user", "codename"
+    ):
+        granted.setdefault(user_id, set()).add(codename)
+    for user_id, codename in perms.filter(user__isnull=False).values_list(
+        "user", "codename"
+    ):
+        granted.setdefault(user_id, set()).add(codename)
+
+    superusers = set(
+        User.objects.filter(is_active=True, is_superuser=True).values_list(
+            "id", flat=True
+        )
+    )
+    active = set(User.objects.filter(is_active=True).values_list("id", flat=True))
+
+    entitlements = {}
+    for user_id in active & (set(granted) | superusers):
+        if user_id in superusers:
+            codenames = set(ENTITLEMENT_PERMISSIONS)
+        else:
+            codenames = granted[user_id]
+
+        if "free_coffee_unlimited" in codenames:
+            free_coffee = 2
+        elif "free_coffee_with_cooldown" in codenames:
+            free_coffee = 1
+        else:
+            free_coffee = 0
+
+        key = (free_coffee, "online_refill" in codenames)
+        entitlements.setdefault(key, []).append(user_id)
+
+    for (free_coffee, online_refill), ids in entitlements.items():
+        Profile.objects.filter(user_id__in=ids).update(
+            free_coffee=free_coffee, online_refill=online_refill
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('baljan', '0028_alter_semester_options_alter_legalconsent_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='free_coffee',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'no free coffee'), (1, 'free coffee with cooldown'), (2, 'unlimited free coffee')], default=0, editable=False, verbose_name='free coffee'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='online_refill',
+            field=models.BooleanField(default=False, editable=False, verbose_name='online refill'),
+        ),
+        migrations.RunPython(compute_entitlements, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baljan', '0029_profile_entitlements'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=80, null=True, unique=True, verbose_name='idempotency key'),
+        ),
+    ]
@@ -0,0 +1,104 @@
+# Generated by Django 5.2.1 on 2026-10-18 21:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+
+def compute_leaderboard(apps, schema_editor):
+    Profile = apps.get_model("baljan", "Profile")
+    Order = apps.get_model("baljan", "Order")
+    ShiftSignup = apps.get_model("baljan", "ShiftSignup")
+    DailyOrderCount = apps.get_model("baljan", "DailyOrderCount")
+
+    staff_groups = [settings.BOARD_GROUP, settings.OLDIE_GROUP, settings.WORKER_GROUP]
+    Profile.objects.filter(user__in=ShiftSignup.objects.values("user")).update(
+        staff_class=1
+    )
+    Profile.objects.filter(user__groups__name__in=staff_groups).update(staff_class=2)
+
+    counts = (
+        Order.objects.filter(accepted=True)
+        .annotate(date=TruncDate("put_at"))
+        .values("date", "location", "user")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    DailyOrderCount.objects.bulk_create(
+        (
+            DailyOrderCount(
+                date=row["date"],
+                location=row["location"],
+                user_id=row["user"],
+                count=row["count"],
+            )
+            for row in counts.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('baljan', '0030_order_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='staff_class',
+            field=models.PositiveSmallIntegerField(
+                choices=[(0, 'normal user'), (1, 'old worker'), (2, 'staff')],
+                default=0,
+                editable=False,
+                verbose_name='staff class',
+            ),
+        ),
+        migrations.CreateModel(
+            name='DailyOrderCount',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('date', models.DateField(verbose_name='date')),
+                (
+                    'location',
+                    models.PositiveSmallIntegerField(
+                        choices=[(0, 'Kårallen'), (1, 'Studenthus Valla')],
+                        verbose_name='Plats',
+                    ),
+                ),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='count')),
+                (
+                    'user',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='daily_order_counts',
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name='user',
+                    ),
+                ),
+            ],
+            options={
+                'verbose_name': 'daily order count',
+                'verbose_name_plural': 'daily order counts',
+                'constraints': [
+                    models.UniqueConstraint(
+                        fields=('date', 'location', 'user'),
+                        name='unique_daily_order_count',
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(compute_leaderboard, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.1 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baljan', '0031_leaderboard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='date')),
+                ('hour', models.PositiveSmallIntegerField(verbose_name='hour')),
+                ('quarter', models.PositiveSmallIntegerField(verbose_name='quarter')),
+                ('location', models.PositiveSmallIntegerField(choices=[(0, 'Kårallen'), (1, 'Studenthus Valla')], verbose_name='Plats')),
+                ('staff_class', models.PositiveSmallIntegerField(choices=[(0, 'normal user'), (1, 'old worker'), (2, 'staff')], verbose_name='staff class')),
+                ('count', models.PositiveIntegerField(verbose_name='count')),
+                ('paid', models.PositiveIntegerField(verbose_name='paid')),
+                ('users', models.PositiveIntegerField(verbose_name='distinct users')),
+            ],
+            options={
+                'verbose_name': 'order rollup',
+                'verbose_name_plural': 'order rollups',
+                'constraints': [models.UniqueConstraint(fields=('date', 'hour', 'quarter', 'location', 'staff_class'), name='unique_order_rollup')],
+            },
+        ),
+    ]
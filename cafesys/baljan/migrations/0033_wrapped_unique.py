@@ -0,0 +1,33 @@
+# Generated by Django 5.2.1 on 2026-10-18 22:20
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remove_duplicates(apps, schema_editor):
+    # Only the latest Wrapped of a user and semester is kept.
+    Wrapped = apps.get_model("baljan", "Wrapped")
+    latest = (
+        Wrapped.objects.filter(user__isnull=False)
+        .values("user", "semester")
+        .annotate(latest=Max("id"))
+        .values("latest")
+    )
+    Wrapped.objects.filter(user__isnull=False).exclude(id__in=latest).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('baljan', '0032_orderrollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='wrapped',
+            constraint=models.UniqueConstraint(fields=('user', 'semester'), name='unique_wrapped'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.1 on 2026-10-18 23:05
+
+import gzip
+import hashlib
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import migrations, models
+
+
+def serialize_payloads(apps, schema_editor):
+    Wrapped = apps.get_model("baljan", "Wrapped")
+    for wrapped in Wrapped.objects.all().iterator():
+        content = json.dumps(
+            wrapped.data, cls=DjangoJSONEncoder, separators=(",", ":")
+        ).encode()
+        wrapped.payload = gzip.compress(content, mtime=0)
+        wrapped.payload_hash = hashlib.sha256(content).hexdigest()
+        wrapped.save(update_fields=["payload", "payload_hash"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baljan', '0033_wrapped_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wrapped',
+            name='payload',
+            field=models.BinaryField(default=b'', editable=False),
+        ),
+        migrations.AddField(
+            model_name='wrapped',
+            name='payload_hash',
+            field=models.CharField(default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(serialize_payloads, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.1 on 2026-10-18 23:40
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remove_duplicates(apps, schema_editor):
+    # Only the latest preference of a user for a combination is kept.
+    WorkableShift = apps.get_model("baljan", "WorkableShift")
+    latest = (
+        WorkableShift.objects.values("user", "semester", "combination")
+        .annotate(latest=Max("id"))
+        .values("latest")
+    )
+    WorkableShift.objects.exclude(id__in=latest).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('baljan', '0034_wrapped_payload'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='workableshift',
+            constraint=models.UniqueConstraint(fields=('user', 'semester', 'combination'), name='unique_workable_shift'),
+        ),
+    ]
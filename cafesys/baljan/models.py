@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from collections import defaultdict
 from datetime import date, datetime
 from django.utils import timezone
 from logging import getLogger
@@ -8,12 +9,13 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import RegexValidator
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group, Permission, User
 from django.urls import reverse
 from django.db import models, transaction
 from django.db.models import Q
 from django.db.models import signals
 from django.utils.encoding import smart_str
+from django.utils.functional import cached_property
 from django.utils.text import format_lazy
 from django.utils.translation import gettext as _nl
 from django.utils.translation import gettext_lazy as _
@@ -21,7 +23,6 @@ from django.utils.translation import gettext_lazy as _
 
 from functools import partial
 
-import stripe
 
 from cafesys.baljan.templatetags.baljan_extras import display_name
 from . import notifications, util
@@ -70,6 +71,33 @@ def generate_private_key():
 
 
 class Profile(Made):
+    FREE_COFFEE_NONE = 0
+    FREE_COFFEE_WITH_COOLDOWN = 1
+    FREE_COFFEE_UNLIMITED = 2
+
+    FREE_COFFEE_CHOICES = (
+        (FREE_COFFEE_NONE, _("no free coffee")),
+        (FREE_COFFEE_WITH_COOLDOWN, _("free coffee with cooldown")),
+        (FREE_COFFEE_UNLIMITED, _("unlimited free coffee")),
+    )
+
+    STAFF_CLASS_NONE = 0
+    STAFF_CLASS_OLD_WORKER = 1
+    STAFF_CLASS_STAFF = 2
+
+    STAFF_CLASS_CHOICES = (
+        (STAFF_CLASS_NONE, _("normal user")),
+        (STAFF_CLASS_OLD_WORKER, _("old worker")),
+        (STAFF_CLASS_STAFF, _("staff")),
+    )
+
+    # Permissions that make up the entitlements, see `update_entitlements`.
+    ENTITLEMENT_PERMISSIONS = (
+        "free_coffee_unlimited",
+        "free_coffee_with_cooldown",
+        "online_refill",
+    )
+
     user = models.OneToOneField(
         settings.AUTH_USER_MODEL,
         related_name="profile",
@@ -112,6 +140,27 @@ class Profile(Made):
 
     has_seen_consent = models.BooleanField(default=False)
 
+    # Derived from the permissions of the user, so that the blipp does not
+    # have to load them. Kept up to date by `update_entitlements`.
+    free_coffee = models.PositiveSmallIntegerField(
+        _("free coffee"),
+        default=FREE_COFFEE_NONE,
+        choices=FREE_COFFEE_CHOICES,
+        editable=False,
+    )
+    online_refill = models.BooleanField(
+        _("online refill"), default=False, editable=False
+    )
+    # Which list of the high score the user is in, kept up to date by
+    # `update_staff_classes`. Board members, old board members and workers
+    # are staff, and anyone who has ever worked a shift is an old worker.
+    staff_class = models.PositiveSmallIntegerField(
+        _("staff class"),
+        default=STAFF_CLASS_NONE,
+        choices=STAFF_CLASS_CHOICES,
+        editable=False,
+    )
+
     # We use a separate field for card_id and card_cache. This is due to functional differences
     # and differences in how we process the data.
     # TODO: seems like nobody has this field set, remove
@@ -124,16 +173,13 @@ class Profile(Made):
         return str(self.card_id).zfill(10) if self.card_id is not None else None
 
     def has_free_blipp(self):
-        free_with_cooldown = self.user.has_perm("baljan.free_coffee_with_cooldown")
-        free_unlimited = self.user.has_perm("baljan.free_coffee_unlimited")
-
         return (
-            free_unlimited or free_with_cooldown,
-            free_with_cooldown and not free_unlimited,
+            self.free_coffee != Profile.FREE_COFFEE_NONE,
+            self.free_coffee == Profile.FREE_COFFEE_WITH_COOLDOWN,
         )
 
     def can_refill_online(self):
-        return self.user.has_perm("baljan.online_refill")
+        return self.online_refill
 
     def get_absolute_url(self):
         return self.user.get_absolute_url()
@@ -169,6 +215,190 @@ def profile_post_save(sender, instance=None, **kwargs):
 signals.post_save.connect(profile_post_save, sender=Profile)
 
 
+def update_entitlements(user_ids):
+    """Recomputes `Profile.free_coffee` and `Profile.online_refill` for the
+    users. Follows the same rules as `User.has_perm` with the model backend:
+    inactive users have no permissions and active superusers have all."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    perms = Permission.objects.filter(
+        content_type__app_label="baljan",
+        codename__in=Profile.ENTITLEMENT_PERMISSIONS,
+    )
+
+    granted = defaultdict(set)
+    for user_id, codename in perms.filter(group__user__in=user_ids).values_list(
+        "group__user", "codename"
+    ):
+        granted[user_id].add(codename)
+    for user_id, codename in perms.filter(user__in=user_ids).values_list(
+        "user", "codename"
+    ):
+        granted[user_id].add(codename)
+
+    entitlements = defaultdict(list)
+    for user_id, is_active, is_superuser in User.objects.filter(
+        id__in=user_ids
+    ).values_list("id", "is_active", "is_superuser"):
+        if not is_active:
+            codenames = set()
+        elif is_superuser:
+            codenames = set(Profile.ENTITLEMENT_PERMISSIONS)
+        else:
+            codenames = granted[user_id]
+
+        if "free_coffee_unlimited" in codenames:
+            free_coffee = Profile.FREE_COFFEE_UNLIMITED
+        elif "free_coffee_with_cooldown" in codenames:
+            free_coffee = Profile.FREE_COFFEE_WITH_COOLDOWN
+        else:
+            free_coffee = Profile.FREE_COFFEE_NONE
+
+        entitlements[(free_coffee, "online_refill" in codenames)].append(user_id)
+
+    for (free_coffee, online_refill), ids in entitlements.items():
+        Profile.objects.filter(user_id__in=ids).update(
+            free_coffee=free_coffee, online_refill=online_refill
+        )
+
+
+def update_staff_classes(user_ids):
+    """Recomputes `Profile.staff_class` for the users."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    staff = set(
+        User.objects.filter(
+            id__in=user_ids,
+            groups__name__in=[
+                settings.BOARD_GROUP,
+                settings.OLDIE_GROUP,
+                settings.WORKER_GROUP,
+            ],
+        ).values_list("id", flat=True)
+    )
+    old_workers = set(
+        ShiftSignup.objects.filter(user__in=user_ids - staff).values_list(
+            "user", flat=True
+        )
+    )
+
+    for staff_class, ids in (
+        (Profile.STAFF_CLASS_STAFF, staff),
+        (Profile.STAFF_CLASS_OLD_WORKER, old_workers),
+        (Profile.STAFF_CLASS_NONE, user_ids - staff - old_workers),
+    ):
+        if ids:
+            Profile.objects.filter(user_id__in=ids).update(staff_class=staff_class)
+
+
+def user_entitlements_post_save(sender, instance=None, update_fields=None, **kwargs):
+    if instance is None:
+        return
+
+    # Logging in only touches last_login, which does not affect permissions.
+    if update_fields is not None and not {"is_active", "is_superuser"} & set(
+        update_fields
+    ):
+        return
+
+    update_entitlements([instance.pk])
+
+
+signals.post_save.connect(user_entitlements_post_save, sender=User)
+
+
+def _entitled_user_ids(sender, instance, reverse, pk_set):
+    """The users affected by an m2m change of groups or permissions. A clear
+    from the reverse side has no `pk_set`, and affects everything related to
+    `instance`."""
+    if sender is Group.permissions.through:
+        if not reverse:
+            groups = [instance.pk]
+        elif pk_set is None:
+            groups = instance.group_set.all()
+        else:
+            groups = pk_set
+        return User.objects.filter(groups__in=groups).values_list("id", flat=True)
+
+    if reverse:
+        if sender is User.groups.through or pk_set is None:
+            return instance.user_set.values_list("id", flat=True)
+        return pk_set
+
+    return [instance.pk]
+
+
+def entitlements_m2m_changed(
+    sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs
+):
+    if instance is None:
+        return
+
+    if action == "pre_clear":
+        # The relations are gone after the clear, remember who had them.
+        instance._entitled_user_ids = list(
+            _entitled_user_ids(sender, instance, reverse, pk_set)
+        )
+        return
+
+    if action == "post_clear":
+        user_ids = getattr(instance, "_entitled_user_ids", [])
+    elif action in ("post_add", "post_remove"):
+        if reverse and sender is User.groups.through:
+            # A group gained or lost the users in pk_set.
+            user_ids = pk_set
+        else:
+            user_ids = list(_entitled_user_ids(sender, instance, reverse, pk_set))
+    else:
+        return
+
+    update_entitlements(user_ids)
+    if sender is User.groups.through:
+        update_staff_classes(user_ids)
+
+
+for through in (
+    User.groups.through,
+    User.user_permissions.through,
+    Group.permissions.through,
+):
+    signals.m2m_changed.connect(entitlements_m2m_changed, sender=through)
+
+
+def group_pre_delete(sender, instance=None, **kwargs):
+    if instance is None:
+        return
+
+    # The memberships are deleted along with the group without m2m_changed.
+    instance._entitled_user_ids = list(instance.user_set.values_list("id", flat=True))
+
+
+def group_post_delete(sender, instance=None, **kwargs):
+    if instance is None:
+        return
+
+    user_ids = getattr(instance, "_entitled_user_ids", [])
+    update_entitlements(user_ids)
+    update_staff_classes(user_ids)
+
+
+def group_post_save(sender, instance=None, created=False, **kwargs):
+    if instance is None or created:
+        return
+
+    # The staff groups are known by name, so a rename may change who is staff.
+    update_staff_classes(instance.user_set.values_list("id", flat=True))
+
+
+signals.pre_delete.connect(group_pre_delete, sender=Group)
+signals.post_delete.connect(group_post_delete, sender=Group)
+signals.post_save.connect(group_post_save, sender=Group)
+
+
 class TradeRequest(Made):
     """Trade sign-up requests. To make synchronization easier, sign-ups are
     deleted and new ones are created when trades are confirmed.
@@ -725,6 +955,17 @@ def signup_pre_delete(sender, instance=None, **kwargs):
 signals.pre_delete.connect(signup_pre_delete, sender=ShiftSignup)
 
 
+def signup_staff_class_changed(sender, instance=None, **kwargs):
+    if instance is None:
+        return
+
+    update_staff_classes([instance.user_id])
+
+
+signals.post_save.connect(signup_staff_class_changed, sender=ShiftSignup)
+signals.post_delete.connect(signup_staff_class_changed, sender=ShiftSignup)
+
+
 class OnCallDuty(Made):
     shift = models.ForeignKey(Shift, verbose_name=_("shift"), on_delete=models.CASCADE)
     user = models.ForeignKey(
@@ -896,6 +1137,16 @@ class Order(Located):
     paid = models.PositiveIntegerField(_("paid"))
     currency = models.CharField(_("currency"), max_length=5, default="SEK")
     accepted = models.BooleanField(_("accepted"), default=True)
+    # Set for orders from batches of offline blipps, so that a batch that is
+    # sent again does not charge twice. Prefixed with the configuration id.
+    idempotency_key = models.CharField(
+        _("idempotency key"),
+        max_length=80,
+        null=True,
+        blank=True,
+        unique=True,
+        editable=False,
+    )
 
     def paid_costcur(self):
         return self.paid, self.currency
@@ -924,6 +1175,77 @@ class Order(Located):
         return "order by %s" % self.user.username
 
 
+class DailyOrderCount(models.Model):
+    """The number of accepted orders of a user at a location on a day (local
+    time). Kept up to date by `cafesys.baljan.leaderboard` as orders are
+    made, for the high score to not have to count orders."""
+
+    date = models.DateField(_("date"))
+    location = models.PositiveSmallIntegerField(
+        "Plats", choices=Located.LOCATION_CHOICES
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        verbose_name=_("user"),
+        related_name="daily_order_counts",
+        on_delete=models.CASCADE,
+    )
+    count = models.PositiveIntegerField(_("count"), default=0)
+
+    class Meta:
+        verbose_name = _("daily order count")
+        verbose_name_plural = _("daily order counts")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["date", "location", "user"],
+                name="unique_daily_order_count",
+            ),
+        ]
+
+    def __str__(self):
+        return "%s %s %s: %d" % (self.date, self.location, self.user, self.count)
+
+
+class OrderRollup(models.Model):
+    """The accepted orders in a quarter of an hour (local time) at a location
+    by users of a staff class. Kept up to date by `cafesys.baljan.rollup`, for
+    statistics to not have to go through every order."""
+
+    date = models.DateField(_("date"))
+    hour = models.PositiveSmallIntegerField(_("hour"))
+    # The minute the quarter starts at: 0, 15, 30 or 45.
+    quarter = models.PositiveSmallIntegerField(_("quarter"))
+    location = models.PositiveSmallIntegerField(
+        "Plats", choices=Located.LOCATION_CHOICES
+    )
+    # Of the users when the day was last counted.
+    staff_class = models.PositiveSmallIntegerField(
+        _("staff class"), choices=Profile.STAFF_CLASS_CHOICES
+    )
+    count = models.PositiveIntegerField(_("count"))
+    paid = models.PositiveIntegerField(_("paid"))
+    users = models.PositiveIntegerField(_("distinct users"))
+
+    class Meta:
+        verbose_name = _("order rollup")
+        verbose_name_plural = _("order rollups")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["date", "hour", "quarter", "location", "staff_class"],
+                name="unique_order_rollup",
+            ),
+        ]
+
+    def __str__(self):
+        return "%s %02d:%02d %s: %d" % (
+            self.date,
+            self.hour,
+            self.quarter,
+            self.location,
+            self.count,
+        )
+
+
 class OrderGood(Made):
     order = models.ForeignKey(Order, verbose_name=_("order"), on_delete=models.CASCADE)
     good = models.ForeignKey(Good, verbose_name=_("good"), on_delete=models.CASCADE)
@@ -1265,6 +1587,61 @@ class WorkableShift(models.Model):
         Semester, verbose_name=_("semester"), on_delete=models.CASCADE
     )
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "semester", "combination"],
+                name="unique_workable_shift",
+            ),
+        ]
+
+
+class ReaderDecoder(object):
+    """Decodes card reader output for one radix and byte order setting.
+
+    The output is the card number as read by the reader, in `radix`. Card
+    numbers of up to four bytes are in `short_endianess` and longer ones in
+    `long_endianess`. They are stored little endian, so only big endian
+    numbers need their bytes reversed. Everything that does not depend on
+    the output is worked out once, here.
+    """
+
+    # Leading zeros and a trailing newline is all the slack a reader gets.
+    MAX_OUTPUT_LENGTH = 32
+
+    DIGITS = {
+        10: "0123456789",
+        16: "0123456789abcdefABCDEF",
+    }
+
+    def __init__(self, radix, short_endianess, long_endianess):
+        self.radix = radix
+        self.digits = frozenset(self.DIGITS[radix])
+        self.swap_short = short_endianess == BlippConfiguration.BIG_ENDIAN
+        self.swap_long = long_endianess == BlippConfiguration.BIG_ENDIAN
+        # Card ids are stored in a signed 64 bit column.
+        self.max_card_id = 2**63 - 1
+
+    def __call__(self, reader_output):
+        if len(reader_output) > self.MAX_OUTPUT_LENGTH:
+            raise ValueError("reader output too long")
+
+        reader_output = reader_output.strip()
+        if not reader_output or not self.digits.issuperset(reader_output):
+            raise ValueError("invalid reader output %r" % reader_output)
+
+        card_id = int(reader_output, self.radix)
+        bit_length = card_id.bit_length()
+        if self.swap_long if bit_length > 32 else self.swap_short:
+            card_id = int.from_bytes(
+                card_id.to_bytes((bit_length + 7) // 8, "big"), "little"
+            )
+
+        if card_id > self.max_card_id:
+            raise ValueError("card id out of range")
+
+        return card_id
+
 
 class BlippConfiguration(Located):
     RADIX_DEC = 10
@@ -1322,21 +1699,18 @@ class BlippConfiguration(Located):
         ),
     )
 
-    def get_standardised_reader_output(self, reader_output):
-        standardised_reader_output = int(reader_output, self.card_reader_radix)
-        is_long_output = standardised_reader_output.bit_length() / 8 > 4
-        endian = (
-            self.card_reader_long_endianess
-            if is_long_output
-            else self.card_reader_short_endianess
-        )
-        output_bytes = standardised_reader_output.to_bytes(
-            (standardised_reader_output.bit_length() + 7) // 8, endian
+    @cached_property
+    def reader_decoder(self):
+        return ReaderDecoder(
+            self.card_reader_radix,
+            self.card_reader_short_endianess,
+            self.card_reader_long_endianess,
         )
-        standardised_reader_output = int.from_bytes(
-            output_bytes, BlippConfiguration.LITTLE_ENDIAN
-        )
-        return standardised_reader_output
+
+    def get_standardised_reader_output(self, reader_output):
+        """Turns what the card reader sends into a card id, see
+        `ReaderDecoder`. Raises ValueError for anything that cannot be one."""
+        return self.reader_decoder(reader_output)
 
     class Meta:
         verbose_name = "Blipp-konfiguration"
@@ -1390,7 +1764,11 @@ class Product(models.Model):
         return self.name
 
     def sync(self):
-        product = stripe.Product.retrieve(self.product_id, expand=["default_price"])
+        from .payments import get_stripe
+
+        product = get_stripe().Product.retrieve(
+            self.product_id, expand=["default_price"]
+        )
 
         self.name = product.name
         self.price = product.default_price.unit_amount / 100
@@ -1401,9 +1779,11 @@ class Product(models.Model):
         return self
 
     def clean(self):
+        from .payments import get_stripe
+
         try:
             self.sync()
-        except stripe.InvalidRequestError:
+        except get_stripe().InvalidRequestError:
             raise ValidationError({"product_id": _("Product ID was not found")})
 
     class Meta:
@@ -1466,6 +1846,25 @@ class Wrapped(Made):
     semester = models.ForeignKey(
         Semester, verbose_name=_("semester"), on_delete=models.CASCADE
     )
+    # `data` as it is served: gzipped JSON, and the SHA-256 of the JSON. Set
+    # on every save, and by `cafesys.baljan.wrapped.save` for the bulk writes.
+    payload = models.BinaryField(editable=False, default=b"")
+    payload_hash = models.CharField(max_length=64, editable=False, default="")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "semester"], name="unique_wrapped"),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Imported here, as cafesys.baljan.wrapped imports the models.
+        from .wrapped import serialize
+
+        self.payload, self.payload_hash = serialize(self.data)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "data" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "payload", "payload_hash"}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return _("Stats for %(user)s during %(semester)s") % {
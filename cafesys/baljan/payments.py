@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.decorators import login_required
+from django.core.exceptions import BadRequest
+from django.http import HttpRequest, HttpResponse
+from django.shortcuts import redirect
+from django.urls import reverse
+from django.utils.translation import gettext as _
+from django.views.decorators.csrf import csrf_exempt
+
+from . import credits, models
+
+
+def get_stripe():
+    """The Stripe library, set up with the API key. It takes long to import,
+    and is only needed when something is paid for, so it is imported here
+    instead of when the app starts."""
+    import stripe
+
+    stripe.api_key = settings.STRIPE_API_KEY
+    return stripe
+
+
+class Stripe:
+    @login_required
+    def create_checkout(request: HttpRequest):
+        if request.method != "POST":
+            return redirect(reverse("credits"))
+
+        product_id = request.POST.get("product_id", None)
+        if product_id is None:
+            raise BadRequest(_("Product ID was not provided"))
+
+        product = models.Product.objects.filter(product_id__exact=product_id).first()
+        if product is None:
+            raise BadRequest(_("Product does not exist"))
+
+        args = {}
+
+        if request.user.email:
+            args["customer_email"] = request.user.email
+
+        checkout_session = get_stripe().checkout.Session.create(
+            line_items=[
+                {
+                    "price": product.price_id,
+                    "quantity": 1,
+                },
+            ],
+            mode="payment",
+            success_url=request.build_absolute_uri(
+                reverse("checkout-success"),
+            )
+            + "?session_id={CHECKOUT_SESSION_ID}",
+            cancel_url=request.build_absolute_uri(
+                reverse("checkout-cancel"),
+            ),
+            client_reference_id=request.user.id,
+            metadata={"product_id": product.id},
+            consent_collection={"terms_of_service": "required"},
+            custom_text={
+                "terms_of_service_acceptance": {
+                    "message": "Jag godkänner [regler och villkor för internetköp](https://www.baljan.org/static/internetkopspolicy.pdf)",
+                },
+            },
+            **args,
+        )
+
+        return redirect(to=checkout_session.url, permanent=False)
+
+    @login_required
+    def success_checkout(request: HttpRequest):
+        if request.method != "GET":
+            return HttpResponse(status=405)
+        if "session_id" not in request.GET:
+            return HttpResponse(status=400)
+
+        session_id = request.GET["session_id"]
+
+        credits_redirect = redirect(reverse("credits"))
+
+        if checkout := get_stripe().checkout.Session.retrieve(session_id):
+            messages.add_message(
+                request,
+                messages.SUCCESS,
+                _(
+                    "Thank you for your purchase! You've refilled your card with %(amount)d %(currency)s"
+                )
+                % {
+                    "amount": checkout.amount_total / 100,
+                    "currency": checkout.currency.upper(),
+                },
+            )
+
+        return credits_redirect
+
+    @login_required
+    def cancel_checkout(request: HttpRequest):
+        messages.add_message(
+            request,
+            messages.ERROR,
+            _("Your purchase was cancelled."),
+            extra_tags="danger",
+        )
+
+        # TODO: maybe we need to cancel the paymentintent here, but maybe not.
+        # They get cancelled within 24 hours
+        # https://stackoverflow.com/questions/70264115/stripe-cancel-url-does-not-cancel-the-payment-so-stripe-does-not-send-a-cancels
+
+        return redirect(reverse("credits"))
+
+    @csrf_exempt
+    def events(request: HttpRequest):
+        payload = request.body
+        sig_header = request.META["HTTP_STRIPE_SIGNATURE"]
+        event = None
+        stripe = get_stripe()
+
+        try:
+            event = stripe.Webhook.construct_event(
+                payload, sig_header, settings.STRIPE_ENDPOINT_SECRET
+            )
+        except ValueError:
+            return HttpResponse(status=400)
+        except stripe.SignatureVerificationError:
+            return HttpResponse(status=400)
+
+        if event.type == "checkout.session.completed":
+            checkout_session = event.data.object
+
+            purchase = models.Purchase.objects.create(
+                product_id=checkout_session["metadata"]["product_id"],
+                user_id=checkout_session["client_reference_id"],
+                session_id=checkout_session["id"],
+                value=checkout_session["amount_total"] / 100,
+                currency=checkout_session["currency"].upper(),
+            )
+
+            credits.digital_refill(purchase)
+        elif event.type == "product.updated":
+            prev = event.data.previous_attributes
+            obj = event.data.object
+
+            if product := models.Product.objects.filter(product_id=obj["id"]).first():
+                updated_fields = {
+                    field.name
+                    for field in models.Product._meta.get_fields()
+                    if field.concrete
+                }
+                matching = prev.keys() & updated_fields
+
+                for key in matching:
+                    setattr(product, key, obj[key])
+
+                product.save()
+
+        return HttpResponse(status=200)
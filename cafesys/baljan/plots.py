@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+The statistics views that are plots.
+
+The pages only read the data of their plot, which is a handful of aggregated
+rows. The plot itself is drawn by the render_plot task and cached as a PNG,
+which the page links to as an image of its own. The image is keyed by the
+kind of plot, the filter and a digest of the data, so a plot is drawn once
+for as long as its data stays the same, and the key is also its ETag. If the
+task has not drawn it yet when the image is requested, it is drawn then.
+
+The plotting libraries take long to import and use a lot of memory, and only
+drawing needs them, so they are imported when a plot is first drawn rather
+than with the rest of the views.
+"""
+
+import json
+from datetime import date, time
+from hashlib import sha256
+from io import BytesIO
+from logging import getLogger
+
+import django_filters
+from django.conf import settings
+from django.contrib.auth.decorators import permission_required
+from django.core.cache import cache
+from django.db.models import Count, F, Sum, Value
+from django.db.models.functions import ExtractIsoWeekDay
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import render
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views.decorators.http import require_GET
+from kombu.exceptions import OperationalError
+
+from . import leaderboard, rollup, series
+from .tasks import render_plot
+
+logger = getLogger(__name__)
+
+WEEKDAYS = ["Måndag", "Tisdag", "Onsdag", "Torsdag", "Fredag"]
+
+# The hours of the heatmap, from the first through the one before the last.
+HEATMAP_HOURS = (8, 17)
+
+# How long a request for a plot waits before it is queued to be drawn again.
+PENDING_TIMEOUT = 60  # seconds
+
+
+def _plotting():
+    """seaborn, pyplot and pandas' `DataFrame`."""
+    import matplotlib
+
+    # Nothing is shown, only saved, so there is no need for a GUI backend.
+    matplotlib.use("Agg")
+
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from pandas import DataFrame
+
+    return sns, plt, DataFrame
+
+
+def _key(name):
+    return "%s.%s" % (settings.PLOT_CACHE_KEY, name)
+
+
+def plot_key(kind, params, data):
+    """The key of the plot of `kind` for the filter `params` and its data."""
+    watermark = sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    content = json.dumps([kind, sorted(params.items()), watermark])
+    return sha256(content.encode()).hexdigest()[:32]
+
+
+def _png(figure):
+    buffer = BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+def draw_heatmap(data):
+    sns, plt, DataFrame = _plotting()
+
+    frame = DataFrame(data["counts"], index=data["weekdays"], columns=data["times"])
+    sns.set_theme()
+    figure = plt.figure(figsize=(16, 9))
+    plot = sns.heatmap(frame, mask=frame == 0, cbar=False, cmap="YlGnBu")
+    plot.figure.autofmt_xdate()
+    try:
+        return _png(figure)
+    finally:
+        plt.close(figure)
+
+
+def draw_blipp(data):
+    sns, plt, DataFrame = _plotting()
+
+    frames = {}
+    for name, points in data.items():
+        frames[name] = DataFrame(
+            index=[date.fromisoformat(day) for day, _ in points],
+            data={"count": [cumsum for _, cumsum in points]},
+        )
+
+    sns.set_theme()
+    plot = sns.relplot(
+        data={
+            "Kaffekort använda": frames["balance_codes"].loc[:, "count"],
+            "Blippat för": frames["orders"].loc[:, "count"],
+        },
+        kind="line",
+    )
+    plot.figure.autofmt_xdate()
+    plot.set_axis_labels("", "SEK")
+    try:
+        return _png(plot.figure)
+    finally:
+        plt.close(plot.figure)
+
+
+def draw_active_users(data):
+    sns, plt, DataFrame = _plotting()
+
+    sns.set_theme()
+    plot = sns.catplot(data=DataFrame(data=data), y="when", x="num_users", kind="bar")
+    plot.set_axis_labels("Antal användare", "När (Antal köp per användare)")
+    try:
+        return _png(plot.figure)
+    finally:
+        plt.close(plot.figure)
+
+
+DRAW = {
+    "heatmap": draw_heatmap,
+    "blipp": draw_blipp,
+    "active_users": draw_active_users,
+}
+
+
+def get_png(key):
+    """The PNG of the plot with `key`, drawn if it has not been already, or
+    None if there is no such plot."""
+    png = cache.get(_key(key + ".png"))
+    if png is not None:
+        return png
+
+    spec = cache.get(_key(key + ".spec"))
+    if spec is None:
+        return None
+
+    kind, data = spec
+    png = DRAW[kind](data)
+    cache.set(_key(key + ".png"), png, settings.PLOT_CACHE_TTL)
+    return png
+
+
+def image_url(kind, params, data):
+    """The URL of the image of the plot of `kind` with `data`. The plot is
+    queued to be drawn unless it has been already."""
+    key = plot_key(kind, params, data)
+    cache.set(_key(key + ".spec"), (kind, data), settings.PLOT_CACHE_TTL)
+    if cache.get(_key(key + ".png")) is None and cache.add(
+        _key(key + ".pending"), True, PENDING_TIMEOUT
+    ):
+        try:
+            render_plot.delay(key)
+        except OperationalError:
+            # The image is drawn when it is requested instead.
+            logger.exception("could not queue plot %s" % key)
+    return reverse("stats_plot", args=(key,))
+
+
+def _params(f):
+    """The filter of `f` as strings, to key plots by."""
+    if not f.form.is_valid():
+        return {name: f.form.data.get(name, "") for name in f.filters}
+    return {
+        name: value.isoformat() if isinstance(value, date) else str(value)
+        for name, value in f.form.cleaned_data.items()
+        if value is not None
+    }
+
+
+def heatmap(rows):
+    """The number of orders of `rows`, of the rollup or orders counted once,
+    by weekday and quarter of an hour, as the weekdays, the times of the
+    quarters and a matrix of counts with a row per weekday and a column per
+    quarter."""
+    import numpy as np
+
+    first, end = HEATMAP_HOURS
+    cells = (
+        rows.annotate(
+            weekday=ExtractIsoWeekDay("date"),
+            column=(F("hour") - first) * 4 + F("quarter") / 15,
+        )
+        .filter(weekday__lt=6, hour__gte=first, hour__lt=end)
+        .values("weekday", "column")
+        .annotate(orders=Sum("count"))
+        .order_by()
+        .values_list("weekday", "column", "orders")
+    )
+    cells = np.array(list(cells), dtype=np.int64).reshape(-1, 3)
+
+    counts = np.zeros((len(WEEKDAYS), (end - first) * 4), dtype=np.int64)
+    counts[cells[:, 0] - 1, cells[:, 1]] = cells[:, 2]
+
+    return {
+        "weekdays": WEEKDAYS,
+        "times": [
+            time(hour, minute).strftime("%H:%M")
+            for hour in range(first, end)
+            for minute in range(0, 60, 15)
+        ],
+        "counts": counts.tolist(),
+    }
+
+
+class OrderFilter(django_filters.FilterSet):
+    # By date, for the order rollup and the daily order counts as well as for
+    # orders annotated with their date. put_at__gt includes the day itself, as
+    # it did when it compared put_at with the start of the day.
+    put_at__gt = django_filters.DateFilter(field_name="date", lookup_expr="gte")
+    put_at__lt = django_filters.DateFilter(field_name="date", lookup_expr="lt")
+    # Only single orders have what was paid for them, see `_filter`.
+    paid = django_filters.NumberFilter()
+    paid__gt = django_filters.NumberFilter(field_name="paid", lookup_expr="gt")
+    paid__lt = django_filters.NumberFilter(field_name="paid", lookup_expr="lt")
+
+    PAID = ("paid", "paid__gt", "paid__lt")
+
+    def by_paid(self):
+        return self.form.is_valid() and any(
+            self.form.cleaned_data[name] is not None for name in self.PAID
+        )
+
+
+def _filter(request, queryset):
+    """The `OrderFilter` of `request` over `queryset`, or over the orders
+    themselves, each counted once, if it filters by what was paid."""
+    f = OrderFilter(request.GET, queryset=queryset)
+    if f.by_paid():
+        f = OrderFilter(request.GET, queryset=rollup.orders().annotate(count=Value(1)))
+    return f
+
+
+@require_GET
+@permission_required("baljan.view_order")
+def plot_image(request, key):
+    etag = '"%s"' % key
+    # The key changes with the data, so a plot with the same key is the same.
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        png = get_png(key)
+        if png is None:
+            raise Http404("Grafen finns inte")
+        response = HttpResponse(png, content_type="image/png")
+
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, max_age=settings.PLOT_CACHE_TTL)
+    return response
+
+
+@require_GET
+@permission_required("baljan.view_order")
+def stats_order_heatmap(request):
+    f = _filter(request, rollup.rows())
+    data = heatmap(f.qs)
+
+    tpl = {
+        "image_url": image_url("heatmap", _params(f), data),
+        "filter": f,
+    }
+    return render(request, "baljan/stat_plot.html", tpl)
+
+
+@require_GET
+@permission_required("baljan.view_order")
+def stats_order_heatmap_json(request):
+    f = _filter(request, rollup.rows())
+    return JsonResponse(heatmap(f.qs))
+
+
+@require_GET
+@permission_required("baljan.view_order")
+def stats_blipp(request):
+    try:
+        from_year = int(request.GET.get("from_year", 2022))  # TODO: improve filtering
+    except ValueError:
+        raise Http404("Året finns inte")
+
+    start = date(from_year, 1, 1)
+    data = {
+        "balance_codes": [
+            [period.isoformat(), total]
+            for period, _, total in series.refills(start=start)
+        ],
+        "orders": [
+            [period.isoformat(), total]
+            for period, _, total in series.orders(start=start)
+        ],
+    }
+    tpl = {"image_url": image_url("blipp", {"from_year": from_year}, data)}
+    return render(request, "baljan/stat_plot.html", tpl)
+
+
+@require_GET
+@permission_required("baljan.view_order")
+def stats_active_blipp_users(request):
+    f = _filter(request, leaderboard.get_counts())
+
+    orders = (
+        f.qs.annotate(week=F("date__week"), year=F("date__year"))
+        .order_by("year", "week")
+        .values("week", "year")
+        .annotate(num_users=Count("user_id", distinct=True))
+        .annotate(num_purchases=Sum("count"))
+    )
+
+    orders_data = []
+    for data in orders:
+        orders_data.append(
+            {
+                "when": f"{data['week']}-{data['year']} ({round(data['num_purchases'] / data['num_users'], 1)})",
+                "num_users": data["num_users"],
+                "num_purchases": data["num_purchases"],
+                "avg_purchases": data["num_purchases"] / data["num_users"],
+            }
+        )
+
+    tpl = {
+        "image_url": image_url("active_users", _params(f), orders_data),
+        "filter": f,
+    }
+    return render(request, "baljan/stat_plot.html", tpl)
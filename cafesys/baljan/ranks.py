@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+The rank of every user in the high score, one user at a time.
+
+The top lists of the high score only have the best users. For anybody else
+`build` puts the scores of all users in Redis when the snapshot of the high
+score is built, in two sorted sets for each interval and group (normal users
+and staff): one with the score of every user and one with every distinct
+score. The score of a user is then a ZSCORE, and the dense rank of a score
+one more than the number of distinct scores above it, a ZCOUNT. Both take
+O(log n), and `get_ranks` does all intervals in two round trips.
+
+Every build is a generation of its own, which the snapshot refers to, so
+that ranks are always from the same time as the top lists. Building a new
+generation for a location removes the one before it. A generation that is
+gone, e.g. after the cache was cleared, makes `get_ranks` return None.
+"""
+
+import uuid
+
+from django.conf import settings
+from django.db.models import Sum
+from django_redis import get_redis_connection
+
+from . import leaderboard
+
+# How many scores are added to Redis at a time.
+CHUNK_SIZE = 1000
+
+
+def _key(*parts):
+    return ".".join([settings.RANKS_KEY] + [str(part) for part in parts])
+
+
+def _set_keys(generation, interval_key, group):
+    """The keys of the scores of users and of the distinct scores."""
+    return (
+        _key(generation, interval_key, group, "users"),
+        _key(generation, interval_key, group, "scores"),
+    )
+
+
+def build(location, intervals):
+    """Puts the scores of all users at `location` (None for all) in Redis.
+    `intervals` is a list of three-tuples (interval key, dates, groups), where
+    `dates` is a two-tuple (first day, last day) or None for all time and
+    `groups` the staff classes of normal users and of staff. Returns the
+    generation."""
+    generation = uuid.uuid4().hex
+    ttl = settings.STATS_CACHE_TTL + 60 * 60
+    keys = []
+
+    redis = get_redis_connection("default")
+    pipeline = redis.pipeline(transaction=False)
+    for interval_key, dates, groups in intervals:
+        scores = [{} for _ in groups]
+        rows = (
+            leaderboard.get_counts(dates, location)
+            .values("user", "user__profile__staff_class")
+            .annotate(score=Sum("count"))
+            .order_by()
+        )
+        for row in rows.iterator():
+            for group, staff_classes in enumerate(groups):
+                if row["user__profile__staff_class"] in staff_classes:
+                    scores[group][row["user"]] = row["score"]
+
+        for group, user_scores in enumerate(scores):
+            if not user_scores:
+                continue
+
+            users_key, scores_key = _set_keys(generation, interval_key, group)
+            items = list(user_scores.items())
+            for i in range(0, len(items), CHUNK_SIZE):
+                pipeline.zadd(users_key, dict(items[i : i + CHUNK_SIZE]))
+            distinct = sorted(set(user_scores.values()))
+            for i in range(0, len(distinct), CHUNK_SIZE):
+                pipeline.zadd(
+                    scores_key,
+                    {score: score for score in distinct[i : i + CHUNK_SIZE]},
+                )
+            pipeline.expire(users_key, ttl)
+            pipeline.expire(scores_key, ttl)
+            keys += [users_key, scores_key]
+
+    # The generation itself lists its keys, so that it can be removed.
+    pipeline.sadd(_key(generation), "", *keys)
+    pipeline.expire(_key(generation), ttl)
+    pipeline.getset(_key("location", location), generation)
+    pipeline.expire(_key("location", location), ttl)
+    previous = pipeline.execute()[-2]
+
+    if previous is not None:
+        remove(previous.decode())
+
+    return generation
+
+
+def remove(generation):
+    redis = get_redis_connection("default")
+    keys = [key for key in redis.smembers(_key(generation)) if key]
+    redis.delete(_key(generation), *keys)
+
+
+def get_ranks(generation, intervals, user):
+    """Returns a dict of three-tuples (rank, score, is staff) of `user` by
+    interval key, or None if `generation` is gone. `intervals` is a list of
+    two-tuples (interval key, groups), with `groups` as for `build`."""
+    redis = get_redis_connection("default")
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.exists(_key(generation))
+    for interval_key, groups in intervals:
+        for group in range(len(groups)):
+            pipeline.zscore(_set_keys(generation, interval_key, group)[0], user.id)
+    found, *scores = pipeline.execute()
+    if not found:
+        return None
+
+    ranks = {}
+    for i, (interval_key, groups) in enumerate(intervals):
+        user_scores = scores[i * len(groups) : (i + 1) * len(groups)]
+        for group, score in enumerate(user_scores):
+            if score is not None:
+                ranks[interval_key] = (group, int(score))
+                break
+        else:
+            # No orders in the interval, so in the group of the staff class
+            # the user has now.
+            group = next(
+                group
+                for group, staff_classes in enumerate(groups)
+                if user.profile.staff_class in staff_classes
+            )
+            ranks[interval_key] = (group, 0)
+
+    for interval_key, (group, score) in ranks.items():
+        pipeline.zcount(
+            _set_keys(generation, interval_key, group)[1], "(%d" % score, "+inf"
+        )
+    above = pipeline.execute()
+
+    return {
+        interval_key: (higher + 1, score, group == 1)
+        for (interval_key, (group, score)), higher in zip(ranks.items(), above)
+    }
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Cooldowns kept in the shared cache.
+
+A cooldown is a key that lives for as long as the cooldown does. Starting one
+is a single atomic SET NX EX, so two processes can never both start the same
+cooldown. Since the cache may have been flushed or restarted, the caller can
+pass a function returning when the limited action last happened according to
+the database. It is only called while cooldowns may have been lost, which is
+when the cache is unavailable or was emptied less than a cooldown ago (as
+told by a key that never expires), and otherwise the key is trusted.
+
+    if not ratelimit.acquire("sms.%d" % user.id, 600, last_sms_sent_at):
+        raise ...
+"""
+
+import math
+import time
+from logging import getLogger
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = getLogger(__name__)
+
+
+def _warm_since(now):
+    """When the cache was last found without the warm key, i.e. emptied."""
+    since = cache.get(settings.RATELIMIT_WARM_KEY)
+    if since is None:
+        cache.add(settings.RATELIMIT_WARM_KEY, now, None)
+        since = now
+    return since
+
+
+def acquire(key, seconds, last_used=None):
+    """Starts a cooldown of `seconds` for `key`. Returns True if it was
+    started, False if a cooldown is already running.
+
+    `last_used` is an optional callable returning the aware datetime at which
+    the limited action last happened, or None. If the cache is unavailable,
+    it is all the decision is based on.
+    """
+    now = time.time()
+
+    try:
+        if not cache.add(key, now, seconds):
+            return False
+        cached = True
+        trusted = now - _warm_since(now) >= seconds
+    except Exception as e:
+        logger.warning("could not start cooldown %s: %s" % (key, e))
+        cached = trusted = False
+
+    if last_used is None or trusted:
+        return True
+
+    used_at = last_used()
+    if used_at is None:
+        return True
+
+    remaining = used_at.timestamp() + seconds - now
+    if remaining < 0:
+        return True
+
+    if cached:
+        # Keep the key for what is left of the cooldown we did not know about.
+        try:
+            cache.set(key, used_at.timestamp(), max(1, math.ceil(remaining)))
+        except Exception as e:
+            logger.warning("could not restore cooldown %s: %s" % (key, e))
+
+    return False
+
+
+def hold(key, since, seconds):
+    """Makes sure that a cooldown of `seconds` from the aware datetime `since`
+    is running for `key`, for actions that are recorded after they happened.
+    """
+    remaining = since.timestamp() + seconds - time.time()
+    if remaining <= 0:
+        return
+
+    try:
+        started = cache.get(key)
+        if started is None or started < since.timestamp():
+            cache.set(key, since.timestamp(), max(1, math.ceil(remaining)))
+    except Exception as e:
+        logger.warning("could not hold cooldown %s: %s" % (key, e))
+
+
+def release(key):
+    """Ends the cooldown for `key`, e.g. when the action it was started for
+    did not happen after all."""
+    try:
+        cache.delete(key)
+    except Exception as e:
+        logger.warning("could not release cooldown %s: %s" % (key, e))
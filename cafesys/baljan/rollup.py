@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Orders rolled up by quarter of an hour, for statistics.
+
+`OrderRollup` has one row per date, hour, quarter, location and staff class
+with the number of accepted orders, what was paid for them and by how many
+users. Statistics that do not need single orders read from it, so that they
+go through a few rows per day instead of every order.
+
+The rollup is kept up to date by `refresh`, which is run by the
+update_order_rollup task on the beat schedule, so statistics may lag behind
+the orders by as much. It counts every day with orders after a watermark
+again, as a whole, which keeps the number of distinct users right. Orders
+that are changed or deleted mark their days to be counted again. Without a
+watermark, like the first time or after the cache has been cleared,
+everything is counted again (see the backfill_order_rollup command).
+"""
+
+from datetime import date, datetime, time, timedelta
+from logging import getLogger
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, IntegerField, Max, Sum, Value
+from django.db.models.functions import (
+    Cast,
+    Coalesce,
+    ExtractHour,
+    ExtractMinute,
+    TruncDate,
+)
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .models import Order, OrderRollup, Profile
+from .util import local_date
+
+logger = getLogger(__name__)
+
+# The first minute of the quarter of an hour, by integer division. PostgreSQL
+# extracts the minute as a numeric, so it is made an integer first.
+QUARTER = Cast("minute", IntegerField()) / 15 * 15
+
+# How long a refresh may hold the lock before someone else may start one.
+LOCK_TIMEOUT = 10 * 60  # seconds
+
+
+def _key(name):
+    return "%s.%s" % (settings.ORDER_ROLLUP_KEY, name)
+
+
+def _day_range(day):
+    start = datetime.combine(day, time())
+    if settings.USE_TZ:
+        start = timezone.make_aware(start)
+    return start, start + timedelta(days=1)
+
+
+def orders():
+    """The accepted orders, with the date, hour and quarter of the rollup."""
+    return (
+        Order.objects.filter(accepted=True)
+        .annotate(
+            date=TruncDate("put_at"),
+            hour=ExtractHour("put_at"),
+            minute=ExtractMinute("put_at"),
+        )
+        .annotate(quarter=QUARTER)
+    )
+
+
+def count(days=None):
+    """Returns the rollup of the orders on `days`, or of all orders, as
+    unsaved `OrderRollup`s."""
+    rows = orders()
+    if days is not None:
+        # The range is for the index on put_at, the dates for the gaps.
+        days = sorted(days)
+        rows = rows.filter(
+            put_at__gte=_day_range(days[0])[0],
+            put_at__lt=_day_range(days[-1])[1],
+            date__in=days,
+        )
+
+    rows = (
+        rows.annotate(
+            staff_class=Coalesce(
+                "user__profile__staff_class", Value(Profile.STAFF_CLASS_NONE)
+            ),
+        )
+        .values("date", "hour", "quarter", "location", "staff_class")
+        .annotate(
+            count=Count("id"),
+            paid=Sum("paid"),
+            users=Count("user", distinct=True),
+        )
+        .order_by()
+    )
+
+    return (OrderRollup(**row) for row in rows.iterator())
+
+
+def _replace(days=None):
+    with transaction.atomic():
+        if days is None:
+            OrderRollup.objects.all().delete()
+        else:
+            OrderRollup.objects.filter(date__in=days).delete()
+        OrderRollup.objects.bulk_create(count(days), batch_size=1000)
+
+
+def backfill(days=None):
+    """Counts `days`, or everything, again. Without `days` the watermark is
+    reset too."""
+    if days is not None:
+        _replace(days)
+        return
+
+    redis = get_redis_connection("default")
+    watermark = _settled_watermark()
+    dirty = redis.smembers(_key("dirty"))
+    _replace()
+    if dirty:
+        # Days marked while counting are left to be counted again.
+        redis.srem(_key("dirty"), *dirty)
+    redis.set(_key("watermark"), watermark)
+
+
+def _settled_watermark():
+    """The highest order id that no earlier transaction can still be
+    committing orders below."""
+    settled = timezone.now() - timedelta(seconds=settings.ORDER_ROLLUP_GRACE_SECONDS)
+    return Order.objects.filter(made__lt=settled).aggregate(Max("id"))["id__max"] or 0
+
+
+def refresh():
+    """Counts the days with new, changed or deleted orders again. Returns
+    False if another refresh was already running."""
+    if not cache.add(_key("lock"), True, LOCK_TIMEOUT):
+        return False
+
+    redis = get_redis_connection("default")
+
+    try:
+        watermark = redis.get(_key("watermark"))
+        if watermark is None:
+            logger.info("no order rollup watermark, counting everything")
+            backfill()
+            return True
+
+        new_watermark = _settled_watermark()
+        days = set(
+            Order.objects.filter(id__gt=int(watermark))
+            .annotate(date=TruncDate("put_at"))
+            .values_list("date", flat=True)
+            .order_by()
+            .distinct()
+        )
+        # The marked days are only removed once they have been counted, so
+        # that they are not lost if counting fails.
+        dirty = redis.smembers(_key("dirty"))
+        days.update(date.fromisoformat(day.decode()) for day in dirty)
+
+        if days:
+            _replace(sorted(days))
+        if dirty:
+            redis.srem(_key("dirty"), *dirty)
+        redis.set(_key("watermark"), max(new_watermark, int(watermark)))
+        return True
+    finally:
+        cache.delete(_key("lock"))
+
+
+def rows(start=None, end=None):
+    """The rollup from `start` through `end`, both dates, as of the last
+    refresh."""
+    rollup = OrderRollup.objects.all()
+    if start is not None:
+        rollup = rollup.filter(date__gte=start)
+    if end is not None:
+        rollup = rollup.filter(date__lte=end)
+    return rollup
+
+
+def mark(*days):
+    """Marks `days` to be counted again by the first refresh after the
+    current transaction has been committed."""
+    days = {day.isoformat() for day in days if day is not None}
+    if days:
+        transaction.on_commit(lambda: _mark(days))
+
+
+def _mark(days):
+    # The order is already saved, so it is not failed for the rollup.
+    try:
+        get_redis_connection("default").sadd(_key("dirty"), *days)
+    except RedisError:
+        logger.exception(
+            "could not mark %s to be counted again in the order rollup"
+            % ", ".join(sorted(days))
+        )
+
+
+def order_pre_save(sender, instance=None, raw=False, **kwargs):
+    # New orders are found by the watermark. An order that is changed is
+    # counted again on the day it is moved from as well as on its new day.
+    if instance is None or raw or instance._state.adding:
+        return
+
+    put_at = (
+        Order.objects.filter(pk=instance.pk).values_list("put_at", flat=True).first()
+    )
+    if put_at is not None:
+        mark(local_date(put_at))
+
+
+def order_post_save(sender, instance=None, created=False, raw=False, **kwargs):
+    if instance is None or raw or created:
+        return
+    mark(local_date(instance.put_at))
+
+
+def order_post_delete(sender, instance=None, **kwargs):
+    if instance is None:
+        return
+    mark(local_date(instance.put_at))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Time series of what has been paid for orders and refilled with balance codes.
+
+A series has a row per day, week or month with the sum of the period and the
+running total through it, both summed by the database with window functions:
+one partitioned by the period and one ordered by it, whose frame is every row
+up to and including the period. What was paid is read from the order
+rollup, so locations can be filtered, while refills are not by location.
+
+Series are streamed as JSON, a row at a time, so that a series of every day
+since the start is never held in memory as a whole.
+"""
+
+import json
+
+from django.db.models import DateField, F, Sum, Window
+from django.db.models.functions import TruncMonth, TruncWeek
+from django.http import StreamingHttpResponse
+
+from . import rollup
+from .models import BalanceCode
+
+# How a date is truncated to its period, None to keep the day.
+GRANULARITIES = {
+    "day": None,
+    "week": TruncWeek,
+    "month": TruncMonth,
+}
+
+
+def _period(granularity, field):
+    trunc = GRANULARITIES[granularity]
+    if trunc is None:
+        return F(field)
+    return trunc(field, output_field=DateField())
+
+
+def _running(queryset, period, value):
+    return (
+        queryset.annotate(period=period)
+        .annotate(
+            amount=Window(Sum(value), partition_by=F("period")),
+            total=Window(Sum(value), order_by=F("period").asc()),
+        )
+        .values_list("period", "amount", "total")
+        .distinct()
+        .order_by("period")
+    )
+
+
+def orders(granularity="day", start=None, end=None, locations=None):
+    """(period, paid, total paid) of the orders from `start` through `end`,
+    at any of `locations`."""
+    rows = rollup.rows(start, end)
+    if locations:
+        rows = rows.filter(location__in=locations)
+    return _running(rows, _period(granularity, "date"), "paid")
+
+
+def refills(granularity="day", start=None, end=None):
+    """(period, refilled, total refilled) of the balance codes used from
+    `start` through `end`."""
+    codes = BalanceCode.objects.filter(used_at__isnull=False)
+    if start is not None:
+        codes = codes.filter(used_at__gte=start)
+    if end is not None:
+        codes = codes.filter(used_at__lte=end)
+    return _running(codes, _period(granularity, "used_at"), "value")
+
+
+def stream(series, **extra):
+    """Yields a JSON object of `extra` and every series in `series`, by name,
+    as lists of [period, amount, total]."""
+    yield json.dumps(extra)[:-1]
+    for i, (name, rows) in enumerate(series.items()):
+        yield "%s%s: [" % (", " if extra or i else "", json.dumps(name))
+        for j, (period, amount, total) in enumerate(rows.iterator()):
+            yield "%s[%s, %d, %d]" % (
+                ", " if j else "",
+                json.dumps(period.isoformat()),
+                amount,
+                total,
+            )
+        yield "]"
+    yield "}"
+
+
+def response(series, **extra):
+    return StreamingHttpResponse(
+        stream(series, **extra), content_type="application/json"
+    )
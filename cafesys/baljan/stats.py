@@ -1,21 +1,17 @@
 # -*- coding: utf-8 -*-
-from datetime import date, datetime, timedelta
+import json
+from datetime import date, timedelta
 from logging import getLogger
 
 from django.conf import settings
-from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.db.models import (
-    Count,
-    F,
-    Window,
-)
-from django.db.models.functions import DenseRank
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from cafesys.baljan.templatetags.baljan_extras import display_name
 
-from .models import Semester, Order
+from . import leaderboard, ranks
+from .models import Profile, Semester
 from .util import adjacent_weeks, week_dates, year_and_week
 
 log = getLogger(__name__)
@@ -31,15 +27,27 @@ ALL_INTERVALS = (
 )
 ALL_LOCATIONS = [None, 0, 1]
 
+# Of the snapshots of the high score in the cache. Bump it when their format
+# changes, and old ones are built again when they are read.
+SNAPSHOT_VERSION = 2
+
 
 def top_consumers(start=None, end=None, simple=False, location=None):
     """`start` and `end` are dates. Returns top consumers in the interval with
     order counts annotated (num_orders). If `simple` is true the returned list
-    consists of serializable data types only."""
+    consists of serializable data types only, which is cached for a while."""
     if start is None:
-        start = datetime(1970, 1, 1, 0, 0)
+        start = date(1970, 1, 1)
     if end is None:
-        end = datetime(2999, 1, 1, 0, 0)
+        end = date(2999, 1, 1)
+
+    def get_top():
+        return leaderboard.get_top_users(
+            leaderboard.STAFF_CLASSES, (start, end), location, limit=None
+        )
+
+    if not simple:
+        return get_top()
 
     fmt = "%Y-%m-%d"
     key = "baljan.stats.start-%s.end-%s.location-%s" % (
@@ -47,40 +55,19 @@ def top_consumers(start=None, end=None, simple=False, location=None):
         end.strftime(fmt),
         location,
     )
-    top = cache.get(key)
-    if top is None:
-        filter_args = {
-            "profile__show_profile": True,
-            "order__put_at__gte": start,
-            "order__put_at__lte": end,
-        }
-
-        if location is not None:
-            filter_args["order__location"] = location
-
-        top = (
-            User.objects.filter(**filter_args)
-            .annotate(
-                num_orders=Count("order"),
-            )
-            .order_by("-num_orders")
-        )
-
+    simple_top = cache.get(key)
+    if simple_top is None:
+        simple_top = [
+            {
+                "full_name": display_name(u),
+                "username": u.username,
+                "blipped": u.num_orders,
+            }
+            for u in get_top()
+        ]
         quarter = 60 * 15  # seconds
-        cache.set(key, top, quarter)
-
-    if simple:
-        simple_top = []
-        for u in top:
-            simple_top.append(
-                {
-                    "full_name": display_name(u),
-                    "username": u.username,
-                    "blipped": u.num_orders,
-                }
-            )
-        return simple_top
-    return top
+        cache.set(key, simple_top, quarter)
+    return simple_top
 
 
 def compute_stats(interval=None, **kwargs):
@@ -96,67 +83,180 @@ def compute_stats(interval=None, **kwargs):
 
 def compute_stats_for_location(location=None, **kwargs):
     s = Stats()
-    return s, [s.get_interval(i, location, **kwargs) for i in ALL_INTERVALS]
+    # There is no semester interval before the first semester has been added.
+    return s, [
+        s.get_interval(i, location, **kwargs)
+        for i in ALL_INTERVALS
+        if i in s.meta.interval_keys
+    ]
 
 
 def get_cache_key(location):
     return "%s-%s" % (settings.STATS_CACHE_KEY, location)
 
 
-class Meta(object):
-    def __init__(self):
-        self.classes = {}
-        self.classes_ordered = []
-        self.classes_i18n = {}
-        self.class_members = {}
-        for name, name_i18n in [
-            ("board member", _("board member")),
-            ("old board member", _("old board member")),
-            ("worker", _("worker")),
-            ("old worker", _("old worker")),
-            ("normal user", _("normal user")),
-        ]:
-            self.classes[name] = {}
-            self.classes_i18n[name] = name_i18n
-            self.class_members[name] = []
-            self.classes_ordered.append(name)
+def snapshot_user(user, rank, num_orders):
+    """`user` as in the top lists of a snapshot."""
+    return {
+        "id": user.id,
+        "username": user.username,
+        "name": display_name(user),
+        "url": user.get_absolute_url(),
+        "motto": user.profile.motto or "",
+        "rank": rank,
+        "num_orders": num_orders,
+    }
+
+
+def build_snapshot(location=None):
+    """Returns the high score of `location` as a JSON string, with only what
+    is shown and what `get_ranks_for_user` needs. The ranks of all users are
+    put in Redis (see `cafesys.baljan.ranks`)."""
+    s, intervals = compute_stats_for_location(location)
+
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "location": location,
+        "computed_at": timezone.now().isoformat(),
+        "intervals": [],
+    }
+    for data in intervals:
+        interval = s.meta.interval_keys[data["key"]]
+        dates = s.get_dates(interval)
+        snapshot["intervals"].append(
+            {
+                "key": data["key"],
+                "name": str(data["name"]),
+                "empty": data["empty"],
+                "dates": None if dates is None else [d.isoformat() for d in dates],
+                "groups": [
+                    {
+                        "title": str(group["title"]),
+                        "staff_classes": staff_classes,
+                        "top_users": [
+                            snapshot_user(user, user.rank, user.num_orders)
+                            for user in group["top_users"]
+                        ],
+                    }
+                    for group, staff_classes in zip(
+                        data["groups"], s.meta.get_staff_classes(interval)
+                    )
+                ],
+            }
+        )
 
-        self.intervals = []
-        self.interval_keys = {}
+    snapshot["ranks"] = ranks.build(
+        location,
+        [
+            (
+                interval["key"],
+                _parse_dates(interval["dates"]),
+                [group["staff_classes"] for group in interval["groups"]],
+            )
+            for interval in snapshot["intervals"]
+        ],
+    )
 
-    def compute_users(self):
-        board_users = User.objects.filter(groups__name=settings.BOARD_GROUP).distinct()
-        for user in board_users:
-            self.classes["board member"][user] = True
+    return json.dumps(snapshot, separators=(",", ":"))
+
+
+def _parse_dates(dates):
+    if dates is None:
+        return None
+    return [date.fromisoformat(d) for d in dates]
+
+
+def load_snapshot(data):
+    """Returns the snapshot in the JSON string `data`, or None if it is not
+    one of the current version."""
+    if not isinstance(data, str):
+        return None
+    try:
+        snapshot = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    return snapshot
+
+
+def get_snapshot(location=None):
+    """The cached snapshot of `location`, which is built if it is missing or
+    of an old version."""
+    if not settings.STATS_CACHE_KEY:
+        return load_snapshot(build_snapshot(location))
+
+    cache_key = get_cache_key(location)
+    snapshot = load_snapshot(cache.get(cache_key))
+    if snapshot is None:
+        # Not built by update_stats yet, e.g. after the cache was flushed.
+        data = build_snapshot(location)
+        cache.set(cache_key, data, settings.STATS_CACHE_TTL)
+        snapshot = load_snapshot(data)
+    return snapshot
+
+
+def is_in_snapshot(interval, user):
+    return any(
+        top["id"] == user.id
+        for group in interval["groups"]
+        for top in group["top_users"]
+    )
 
-        oldie_users = User.objects.filter(groups__name=settings.OLDIE_GROUP).distinct()
-        for user in oldie_users:
-            self.classes["old board member"][user] = True
 
-        worker_users = User.objects.filter(
-            groups__name=settings.WORKER_GROUP
-        ).distinct()
-        for user in worker_users:
-            self.classes["worker"][user] = True
+def get_rank_for_user(interval, user, location=None):
+    """Returns a three-tuple (rank, number of orders, is staff) of `user` in
+    `interval` of a snapshot, without computing any of the high score."""
+    normal, staff = [group["staff_classes"] for group in interval["groups"]]
+    is_staff = user.profile.staff_class in staff
+    rank, score = leaderboard.get_rank(
+        user, staff if is_staff else normal, _parse_dates(interval["dates"]), location
+    )
+    return rank, score, is_staff
+
+
+def get_ranks_for_user(snapshot, user):
+    """Returns a dict of three-tuples (rank, number of orders, is staff) of
+    `user` by interval key, for the intervals of `snapshot` where `user` is
+    not in the top lists."""
+    intervals = [
+        interval
+        for interval in snapshot["intervals"]
+        if not is_in_snapshot(interval, user)
+    ]
+    if not intervals:
+        return {}
+
+    user_ranks = ranks.get_ranks(
+        snapshot["ranks"],
+        [
+            (interval["key"], [group["staff_classes"] for group in interval["groups"]])
+            for interval in intervals
+        ],
+        user,
+    )
+    if user_ranks is None:
+        # The scores are gone from Redis, so they are counted instead.
+        user_ranks = {
+            interval["key"]: get_rank_for_user(interval, user, snapshot["location"])
+            for interval in intervals
+        }
+    return user_ranks
 
-        old_worker_users = (
-            User.objects.annotate(
-                num_shiftsignups=Count("shiftsignup"),
-            )
-            .exclude(
-                num_shiftsignups=0,
-            )
-            .distinct()
-        )
-        for user in old_worker_users:
-            self.classes["old worker"][user] = True
 
-        self.all_users = set(User.objects.all().distinct())
-        for user in self.all_users:
-            self.classes["normal user"][user] = True
+class Meta(object):
+    # Which profiles are staff for an interval, by the names used for the
+    # "staff classes" of the intervals.
+    staff_classes = {
+        "board member": Profile.STAFF_CLASS_STAFF,
+        "old board member": Profile.STAFF_CLASS_STAFF,
+        "worker": Profile.STAFF_CLASS_STAFF,
+        "old worker": Profile.STAFF_CLASS_OLD_WORKER,
+    }
 
-        for user in self.all_users:
-            self.class_members[self.user_class(user)].append(user)
+    def __init__(self):
+        self.intervals = []
+        self.interval_keys = {}
 
     def compute_intervals(self):
         today = date.today()
@@ -267,13 +367,14 @@ class Meta(object):
             self.interval_keys[interval["key"]] = interval
 
     def compute(self):
-        self.compute_users()
         self.compute_intervals()
 
-    def user_class(self, user):
-        for name in self.classes_ordered:
-            if user in self.classes[name]:
-                return name
+    def get_staff_classes(self, interval):
+        """Returns a two-tuple (normal, staff) of the `Profile.staff_class`
+        values in each group of `interval`."""
+        staff = {self.staff_classes[name] for name in interval["staff classes"]}
+        normal = set(leaderboard.STAFF_CLASSES) - staff
+        return sorted(normal), sorted(staff)
 
 
 class Stats(object):
@@ -283,51 +384,22 @@ class Stats(object):
 
     def get_interval(self, interval_key, location=None, limit=15, is_wrapped=False):
         interval = self.meta.interval_keys[interval_key]
-        staff_users = set()
-        for cls_name in interval["staff classes"]:
-            staff_users |= set(self.meta.class_members[cls_name])
-        normal_users = self.meta.all_users - staff_users
+        dates = self.get_dates(interval)
 
         groups = []
-        for title, users in [
-            (_("Normal Users"), normal_users),
-            (_("Staff"), staff_users),
-        ]:
-            top = User.objects.filter(
-                id__in=[u.id for u in users],
-            )
-
-            filter_args = {}
-            if interval["dates"]:
-                dates = list(interval["dates"])
-                filter_args["order__put_at__gte"] = dates[0]
-                filter_args["order__put_at__lte"] = dates[-1] + timedelta(days=1)
-
-            if location is not None:
-                filter_args["order__location"] = location
-
-            if not is_wrapped:
-                filter_args["profile__show_profile"] = (
-                    True  # FIXME: fugly solution will rebuild
-                )
-
-            if filter_args:
-                top = top.filter(**filter_args)
-
-            top = top.annotate(
-                num_orders=Count("order"),
-                rank=Window(expression=DenseRank(), order_by=F("num_orders").desc()),
-            ).order_by("-num_orders")
-
-            if limit is not None:
-                top = top[:limit]
-
-            top = list(top)
-
+        for title, staff_classes in zip(
+            [_("Normal Users"), _("Staff")], self.meta.get_staff_classes(interval)
+        ):
             groups.append(
                 {
                     "title": title,
-                    "top_users": top,
+                    "top_users": leaderboard.get_top_users(
+                        staff_classes,
+                        dates,
+                        location,
+                        limit=limit,
+                        public_only=not is_wrapped,
+                    ),
                 }
             )
 
@@ -345,35 +417,17 @@ class Stats(object):
         location=None,
     ):
         interval = self.meta.interval_keys[interval_key]
+        normal, staff = self.meta.get_staff_classes(interval)
 
-        staff_users = set()
-        for cls_name in interval["staff classes"]:
-            staff_users |= set(self.meta.class_members[cls_name])
-        normal_users = self.meta.all_users - staff_users
-
-        is_staff = user in staff_users
-        filter_set = staff_users if is_staff else normal_users
-
-        filter_args = {}
-        if interval["dates"]:
-            dates = list(interval["dates"])
-            filter_args["put_at__gte"] = dates[0]
-            filter_args["put_at__lte"] = dates[-1] + timedelta(days=1)
-
-        if location is not None:
-            filter_args["location"] = location
-
-        user_score = Order.objects.filter(user=user, **filter_args).count()
-
-        rank = (
-            Order.objects.filter(**filter_args, user__in=filter_set)
-            .values("user")
-            .annotate(num_orders=Count("id"))
-            .filter(num_orders__gt=user_score)
-            .values("num_orders")
-            .distinct()
-            .count()
-            + 1
+        is_staff = user.profile.staff_class in staff
+        rank, user_score = leaderboard.get_rank(
+            user, staff if is_staff else normal, self.get_dates(interval), location
         )
 
         return (rank, user_score, is_staff)
+
+    def get_dates(self, interval):
+        if not interval["dates"]:
+            return None
+        dates = list(interval["dates"])
+        return (dates[0], dates[-1])
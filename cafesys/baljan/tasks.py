@@ -20,10 +20,24 @@ def update_stats():
     from . import stats
 
     for location in stats.ALL_LOCATIONS:
-        data = stats.compute_stats_for_location(location)
+        data = stats.build_snapshot(location)
         cache.set(stats.get_cache_key(location), data, settings.STATS_CACHE_TTL)
 
 
+@shared_task
+def update_order_rollup():
+    from . import rollup
+
+    rollup.refresh()
+
+
+@shared_task
+def render_plot(key):
+    from . import plots
+
+    plots.get_png(key)
+
+
 @shared_task
 def ensure_gmail_watch():
     from . import google
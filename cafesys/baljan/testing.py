@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """Makes views that go over their query budget fail the tests, see
+    `cafesys.baljan.instrumentation`."""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        settings.QUERY_BUDGET_RAISE = True
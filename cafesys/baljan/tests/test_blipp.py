@@ -0,0 +1,364 @@
+import time
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission, User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from cafesys.baljan import blipp, ratelimit
+from cafesys.baljan.models import (
+    BlippConfiguration,
+    Good,
+    GoodCost,
+    Order,
+    OrderGood,
+    Profile,
+    ReaderDecoder,
+)
+
+
+class BlippTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        blipp.configurations.clear()
+        blipp.cards.clear()
+
+        self.good = Good.objects.create(title="Kaffe")
+        self.cost = GoodCost.objects.create(
+            good=self.good, cost=9, from_date=date.today() - timedelta(days=7)
+        )
+        self.config = BlippConfiguration.objects.create(
+            token="blipp-token", good=self.good, location=1
+        )
+
+        self.user = User.objects.create(username="abcde123")
+        self.user.profile.card_id = 1234
+        self.user.profile.balance = 20
+        self.user.profile.save()
+
+    def blipp(self, card_id="1234", token="blipp-token"):
+        return self.client.post(
+            "/do-blipp",
+            {"id": card_id},
+            HTTP_AUTHORIZATION="Token %s" % token,
+        )
+
+    def test_blipp_debits_balance(self):
+        response = self.blipp()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["balance"], 11)
+        self.assertEqual(response.json()["paid"], 9)
+
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.balance, 11)
+
+        order = Order.objects.get(user=self.user)
+        self.assertEqual(order.paid, 9)
+        self.assertEqual(order.location, 1)
+        self.assertTrue(order.accepted)
+        self.assertTrue(OrderGood.objects.filter(order=order, good=self.good).exists())
+
+    def test_blipp_debits_what_is_left(self):
+        self.user.profile.balance = 5
+        self.user.profile.save()
+
+        response = self.blipp()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["balance"], 0)
+        self.assertEqual(Order.objects.get(user=self.user).paid, 5)
+
+    def test_blipp_without_balance(self):
+        self.user.profile.balance = 0
+        self.user.profile.save()
+
+        response = self.blipp()
+
+        self.assertEqual(response.status_code, 402)
+        self.assertFalse(Order.objects.filter(user=self.user).exists())
+
+    def test_blipp_retries_stale_balance(self):
+        paid, balance = blipp._debit(self.user.id, 9, 3)
+
+        self.assertEqual((paid, balance), (9, 11))
+
+    def test_blipp_unknown_card(self):
+        response = self.blipp(card_id="4321")
+
+        self.assertEqual(response.status_code, 404)
+        self.assertIn("signed_rfid", response.json())
+
+    def test_blipp_bad_token(self):
+        response = self.blipp(token="wrong")
+
+        self.assertEqual(response.status_code, 403)
+
+    def test_configuration_is_cached(self):
+        self.assertEqual(blipp.get_configuration("blipp-token"), self.config)
+
+        with self.assertNumQueries(0):
+            config = blipp.get_configuration("blipp-token")
+        self.assertEqual(config.current_cost, 9)
+
+    def test_unknown_tokens_are_not_cached(self):
+        for i in range(3):
+            self.assertIsNone(blipp.get_configuration("unknown-%d" % i))
+        self.assertEqual(blipp.configurations.entries, {})
+
+    def test_configuration_cache_is_invalidated(self):
+        blipp.get_configuration("blipp-token")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cost.cost = 11
+            self.cost.save()
+
+        self.assertEqual(blipp.get_configuration("blipp-token").current_cost, 11)
+
+    def test_blipp_free_coffee(self):
+        group = Group.objects.create(name="Gratis")
+        group.permissions.add(Permission.objects.get(codename="free_coffee_unlimited"))
+        self.user.groups.add(group)
+
+        response = self.blipp()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["paid"], 0)
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.balance, 20)
+
+    def test_blipp_free_coffee_cooldown(self):
+        self.user.user_permissions.add(
+            Permission.objects.get(codename="free_coffee_with_cooldown")
+        )
+
+        self.assertEqual(self.blipp().status_code, 200)
+        self.assertEqual(self.blipp().status_code, 402)
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 1)
+
+    def test_blipp_cooldown_from_orders(self):
+        self.user.user_permissions.add(
+            Permission.objects.get(codename="free_coffee_with_cooldown")
+        )
+        Order.objects.create(
+            user=self.user, put_at=timezone.now(), paid=0, currency="SEK"
+        )
+
+        self.assertEqual(self.blipp().status_code, 402)
+        # The cooldown found in the orders is now in the cache.
+        with self.assertNumQueries(0):
+            self.assertFalse(ratelimit.acquire(blipp.get_cooldown_key(self.user), 60))
+
+    def test_blipp_cooldown_trusts_warm_cache(self):
+        key = blipp.get_cooldown_key(self.user)
+
+        # Once the cache has kept its keys for a whole cooldown, orders made
+        # in the meantime have their keys and the database is not asked.
+        cache.set(settings.RATELIMIT_WARM_KEY, time.time() - 60, None)
+        with self.assertNumQueries(0):
+            self.assertTrue(ratelimit.acquire(key, 60, self.fail))
+            self.assertFalse(ratelimit.acquire(key, 60, self.fail))
+
+    def blipp_batch(self, taps, token="blipp-token"):
+        return self.client.post(
+            "/do-blipp/batch",
+            {"taps": taps},
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token %s" % token,
+        )
+
+    def test_blipp_batch(self):
+        self.cost.from_date = date.today() - timedelta(days=1)
+        self.cost.save()
+        taps = [
+            {"key": "a", "id": "1234", "at": "2000-01-01T08:00:00"},
+            {"key": "b", "id": "4321"},
+            {"key": "c", "id": "1234", "at": "nonsense"},
+            {"key": "d", "id": "1234"},
+            {
+                "key": "e",
+                "id": "1234",
+                "at": (timezone.now() - timedelta(days=1)).isoformat(),
+            },
+        ]
+
+        response = self.blipp_batch(taps)
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual([r["key"] for r in results], ["a", "b", "c", "d", "e"])
+        self.assertEqual([r["status"] for r in results], [400, 404, 400, 200, 500])
+        # Too long ago to be taken, and no price had been set yesterday.
+        self.assertEqual(results[0]["message"], "Blippet är för gammalt")
+        self.assertEqual(results[3]["balance"], 11)
+
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.balance, 11)
+
+    def test_blipp_batch_is_idempotent(self):
+        taps = [{"key": "a", "id": "1234"}]
+
+        self.blipp_batch(taps)
+        response = self.blipp_batch(taps)
+
+        self.assertEqual(response.json()["results"][0]["status"], 200)
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 1)
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.balance, 11)
+
+    def test_blipp_batch_cooldown(self):
+        self.user.user_permissions.add(
+            Permission.objects.get(codename="free_coffee_with_cooldown")
+        )
+        now = timezone.now()
+        taps = [
+            {"key": "a", "id": "1234", "at": now - timedelta(minutes=59, seconds=30)},
+            {"key": "b", "id": "1234", "at": now - timedelta(minutes=60)},
+            {"key": "c", "id": "1234", "at": now - timedelta(minutes=1)},
+        ]
+        for tap in taps:
+            tap["at"] = tap["at"].isoformat()
+
+        results = self.blipp_batch(taps).json()["results"]
+
+        self.assertEqual([r["status"] for r in results], [402, 200, 200])
+
+    def test_blipp_batch_cooldown_blocks_live(self):
+        self.user.user_permissions.add(
+            Permission.objects.get(codename="free_coffee_with_cooldown")
+        )
+        cache.set(settings.RATELIMIT_WARM_KEY, time.time() - 3600, None)
+        tap = {"key": "a", "id": "1234", "at": timezone.now() - timedelta(seconds=10)}
+        tap["at"] = tap["at"].isoformat()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(
+                self.blipp_batch([tap]).json()["results"][0]["status"], 200
+            )
+        self.assertEqual(self.blipp().status_code, 402)
+
+    def test_blipp_batch_bad_token(self):
+        self.assertEqual(self.blipp_batch([], token="wrong").status_code, 403)
+
+    def test_unknown_card_is_rejected_from_the_index(self):
+        self.assertEqual(blipp.get_user(1234), self.user)
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(blipp.get_user(4321))
+
+    def test_card_index_is_invalidated(self):
+        blipp.get_user(1234)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.card_id = 4321
+            self.user.profile.save()
+
+        self.assertIsNone(blipp.get_user(1234))
+        self.assertEqual(blipp.get_user(4321), self.user)
+
+
+def legacy_reader_output(reader_output, radix, short_endianess, long_endianess):
+    """`BlippConfiguration.get_standardised_reader_output` as it used to be."""
+    value = int(reader_output, radix)
+    endian = long_endianess if value.bit_length() / 8 > 4 else short_endianess
+    output_bytes = value.to_bytes((value.bit_length() + 7) // 8, endian)
+    return int.from_bytes(output_bytes, "little")
+
+
+class ReaderDecoderTestCase(SimpleTestCase):
+    def test_same_as_before(self):
+        values = [0, 1, 255, 2**32 - 1, 2**32, 2**40 + 12345, 2**56 + 1]
+        for radix, fmt in ((10, "%d"), (16, "%x")):
+            for short in ("little", "big"):
+                for long in ("little", "big"):
+                    decoder = ReaderDecoder(radix, short, long)
+                    for value in values:
+                        self.assertEqual(
+                            decoder(fmt % value),
+                            legacy_reader_output(fmt % value, radix, short, long),
+                        )
+
+    def test_rejects_garbage(self):
+        decoder = ReaderDecoder(10, "little", "big")
+
+        for reader_output in ("", "12a4", "-1", "1" * 33, str(2**64 - 1)):
+            with self.assertRaises(ValueError):
+                decoder(reader_output)
+
+        self.assertEqual(decoder("0001234\n"), 1234)
+
+
+class EntitlementsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="abcde123")
+        self.group = Group.objects.create(name="Gratis")
+        self.group.permissions.add(
+            Permission.objects.get(codename="free_coffee_with_cooldown"),
+            Permission.objects.get(codename="online_refill"),
+        )
+
+    def assertEntitlements(self, free_coffee, online_refill):
+        profile = Profile.objects.get(user=self.user)
+        self.assertEqual(profile.free_coffee, free_coffee)
+        self.assertEqual(profile.online_refill, online_refill)
+
+    def test_group_membership(self):
+        self.user.groups.add(self.group)
+        self.assertEntitlements(Profile.FREE_COFFEE_WITH_COOLDOWN, True)
+
+        self.group.user_set.remove(self.user)
+        self.assertEntitlements(Profile.FREE_COFFEE_NONE, False)
+
+        self.group.user_set.add(self.user)
+        self.user.groups.clear()
+        self.assertEntitlements(Profile.FREE_COFFEE_NONE, False)
+
+    def test_group_permissions(self):
+        self.user.groups.add(self.group)
+
+        self.group.permissions.add(
+            Permission.objects.get(codename="free_coffee_unlimited")
+        )
+        self.assertEntitlements(Profile.FREE_COFFEE_UNLIMITED, True)
+
+        self.group.permissions.clear()
+        self.assertEntitlements(Profile.FREE_COFFEE_NONE, False)
+
+    def test_clear_from_the_permission(self):
+        self.user.groups.add(self.group)
+        unlimited = Permission.objects.get(codename="free_coffee_unlimited")
+        self.user.user_permissions.add(unlimited)
+        self.assertEntitlements(Profile.FREE_COFFEE_UNLIMITED, True)
+
+        unlimited.user_set.clear()
+        self.assertEntitlements(Profile.FREE_COFFEE_WITH_COOLDOWN, True)
+
+        Permission.objects.get(codename="online_refill").group_set.clear()
+        self.assertEntitlements(Profile.FREE_COFFEE_WITH_COOLDOWN, False)
+
+    def test_group_delete(self):
+        self.user.groups.add(self.group)
+        self.group.delete()
+
+        self.assertEntitlements(Profile.FREE_COFFEE_NONE, False)
+
+    def test_inactive_and_superuser(self):
+        self.user.groups.add(self.group)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEntitlements(Profile.FREE_COFFEE_NONE, False)
+
+        self.user.is_active = True
+        self.user.is_superuser = True
+        self.user.save()
+        self.assertEntitlements(Profile.FREE_COFFEE_UNLIMITED, True)
+        self.assertEqual(
+            Profile.objects.get(user=self.user).has_free_blipp(),
+            (
+                self.user.has_perm("baljan.free_coffee_unlimited")
+                or self.user.has_perm("baljan.free_coffee_with_cooldown"),
+                False,
+            ),
+        )
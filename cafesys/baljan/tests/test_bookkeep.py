@@ -0,0 +1,117 @@
+import csv
+from datetime import date, datetime
+
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from cafesys.baljan import bookkeep, rollup
+from cafesys.baljan.models import BalanceCode, Order, RefillSeries
+
+
+class BookkeepTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Who blipped during 2023, only before, only after, before and after
+        # but not during, and never.
+        self.account("active", 1, [date(2022, 5, 1), date(2023, 5, 1)])
+        self.account("before", 10, [date(2022, 5, 1)])
+        self.account("after", 100, [date(2024, 5, 1)])
+        self.account("gap", 1000, [date(2022, 5, 1), date(2024, 5, 1)])
+        self.account("never", 10000, [])
+        rollup.backfill()
+
+        refill_series = RefillSeries.objects.create(code_count=0)
+        for used_at, value in ((date(2023, 2, 1), 100), (date(2024, 2, 1), 200)):
+            BalanceCode.objects.create(
+                refill_series=refill_series, value=value, used_at=used_at
+            )
+
+    def account(self, username, balance, days):
+        user = User.objects.create(username=username)
+        user.profile.balance = balance
+        user.profile.has_seen_consent = True
+        user.profile.save()
+        for day in days:
+            Order.objects.create(
+                user=user,
+                paid=5,
+                location=0,
+                accepted=True,
+                put_at=timezone.make_aware(datetime.combine(day, datetime.min.time())),
+            )
+        return user
+
+    def test_balances(self):
+        with self.assertNumQueries(1):
+            sums = bookkeep.balances(date(2023, 1, 1), date(2023, 12, 31))
+        self.assertEqual(
+            sums,
+            {
+                "active": 1,
+                "before": 1010,
+                "after": 1100,
+                "gap": 1000,
+                "never": 10000,
+                "total": 11111,
+            },
+        )
+
+        lines = {line.number: line.amount for line in bookkeep.report(2023)}
+        self.assertEqual(lines[1], 100)
+        self.assertEqual(lines[2] + lines[3] + lines[4] - lines[5] + lines[6], lines[7])
+        self.assertEqual(
+            list(bookkeep.never_blipped()), [User.objects.get(username="never").profile]
+        )
+
+    def test_rejected_orders_are_not_blipps(self):
+        user = self.account("rejected", 100000, [])
+        Order.objects.create(
+            user=user,
+            paid=0,
+            location=0,
+            accepted=False,
+            put_at=timezone.make_aware(datetime(2023, 5, 1)),
+        )
+        rollup.backfill()
+
+        sums = bookkeep.balances(date(2023, 1, 1), date(2023, 12, 31))
+        self.assertEqual(sums["active"], 1)
+        self.assertEqual(sums["never"], 110000)
+        self.assertIn(user.profile, bookkeep.never_blipped())
+
+    def test_current_year_lag(self):
+        year = timezone.localdate().year
+        self.assertIn("senaste 6 minuternas", bookkeep.get_bookkeep_data(year))
+        self.assertNotIn("minuternas", bookkeep.get_bookkeep_data(2023))
+
+    def test_past_years_are_cached(self):
+        before = bookkeep.report(2023)
+        self.account("later", 100000, [date(2023, 6, 1)])
+        self.assertEqual(bookkeep.report(2023), before)
+
+        cache.clear()
+        self.assertNotEqual(bookkeep.report(2023), before)
+
+    def test_csv(self):
+        user = self.account("finance", 0, [])
+        user.user_permissions.add(Permission.objects.get(codename="view_order"))
+        self.client.force_login(user)
+
+        response = self.client.get("/bookkeep", {"year": 2023})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            "(2) Kontosumman för de som blippat under året: 1 SEK",
+            response.context["data"],
+        )
+
+        response = self.client.get("/bookkeep", {"year": 2023, "format": "csv"})
+        self.assertEqual(response.status_code, 200)
+        rows = list(
+            csv.reader(b"".join(response.streaming_content).decode().splitlines())
+        )
+        self.assertEqual(rows[0], ["Nummer", "Post", "SEK"])
+        self.assertEqual(rows[2][0], "2")
+        self.assertEqual(rows[2][2], "1")
+        self.assertEqual(rows[-1], ["", "Balans (Insatt-uttaget)", "95"])
@@ -0,0 +1,81 @@
+from datetime import date, datetime, timedelta
+from io import StringIO
+
+from django.contrib.auth.models import Permission, User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from cafesys.baljan import export
+from cafesys.baljan.models import Order
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="abcde123")
+        self.day = date(2024, 3, 4)
+        noon = timezone.make_aware(datetime(2024, 3, 4, 12))
+        # Orders at the same time on both sides of chunk boundaries.
+        for i in range(7):
+            Order.objects.create(
+                user=self.user,
+                paid=i,
+                location=i % 2,
+                put_at=noon + timedelta(minutes=i // 3),
+            )
+        Order.objects.create(user=self.user, paid=99, put_at=noon + timedelta(days=1))
+
+    def test_iterate_in_chunks(self):
+        orders = Order.objects.filter(put_at__date=self.day)
+        for order_by in ("pk", "put_at"):
+            paid = [
+                row[0]
+                for row in export.iterate(orders, ["paid"], order_by, chunk_size=2)
+            ]
+            self.assertEqual(paid, list(range(7)))
+
+    def test_statdump(self):
+        out = StringIO()
+        call_command(
+            "statdump", "2024-03-04", "2024-03-04", "--location", "1", stdout=out
+        )
+
+        self.assertEqual(
+            out.getvalue().splitlines(),
+            [
+                "time,paid,location",
+                "2024-03-04 12:00:00,1,1",
+                "2024-03-04 12:01:00,3,1",
+                "2024-03-04 12:01:00,5,1",
+            ],
+        )
+
+    def test_export_orders(self):
+        staff = User.objects.create(username="staff", is_staff=True)
+        staff.user_permissions.add(
+            Permission.objects.get(
+                content_type__app_label="baljan", codename="view_order"
+            )
+        )
+        staff.profile.has_seen_consent = True
+        staff.profile.save()
+        self.client.force_login(staff)
+
+        response = self.client.get(
+            "/stats/orders.csv", {"start": "2024-03-04", "end": "2024-03-05"}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn(
+            "blipp-2024-03-04-2024-03-05.csv", response["Content-Disposition"]
+        )
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(lines[-1], "2024-03-05 12:00:00,99,0")
+
+        response = self.client.get(
+            "/stats/orders.csv", {"start": "2024-03-05", "end": "2024-03-04"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.streaming)
@@ -0,0 +1,41 @@
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from cafesys.baljan import instrumentation
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        instrumentation.reset_request_stats()
+
+    @override_settings(QUERY_BUDGETS={"do_blipp": 0})
+    def test_over_budget_raises(self):
+        with self.assertRaises(instrumentation.QueryBudgetExceeded):
+            self.client.post(
+                "/do-blipp", {"id": "1234"}, HTTP_AUTHORIZATION="Token nope"
+            )
+
+    @override_settings(REQUEST_STATS_FLUSH_SECONDS=0)
+    def test_request_stats(self):
+        self.client.post("/do-blipp", {"id": "1234"}, HTTP_AUTHORIZATION="Token nope")
+
+        staff = User.objects.create(username="staff", is_staff=True)
+        staff.profile.has_seen_consent = True
+        staff.profile.save()
+        self.client.force_login(staff)
+        response = self.client.get("/stats/requests.json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["do_blipp"]["requests"], 1)
+        self.assertEqual(response.json()["do_blipp"]["budget"], 7)
+
+    def test_request_stats_is_for_staff(self):
+        user = User.objects.create(username="abcde123")
+        user.profile.has_seen_consent = True
+        user.profile.save()
+        self.client.force_login(user)
+
+        response = self.client.get("/stats/requests.json")
+
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("/admin/login", response["Location"])
@@ -0,0 +1,231 @@
+import random
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.test import TestCase
+
+from cafesys.baljan import leaderboard, ranks, stats
+from cafesys.baljan.models import DailyOrderCount, Order, Profile
+from cafesys.baljan.stats import Stats
+
+
+class LeaderboardTestCase(TestCase):
+    def setUp(self):
+        self.today = date.today()
+        self.users = [User.objects.create(username="user%d" % i) for i in range(3)]
+
+    def order(self, user, days_ago=0, location=0, accepted=True):
+        return Order.objects.create(
+            user=user,
+            paid=0,
+            location=location,
+            accepted=accepted,
+            put_at=datetime.combine(
+                self.today - timedelta(days=days_ago), datetime.min.time()
+            )
+            + timedelta(hours=12),
+        )
+
+    def counts(self):
+        return {
+            (count.date, count.location, count.user_id): count.count
+            for count in DailyOrderCount.objects.all()
+        }
+
+    def test_orders_are_counted(self):
+        first = self.order(self.users[0])
+        self.order(self.users[0])
+        self.order(self.users[0], location=1)
+        self.order(self.users[1], days_ago=1)
+        self.order(self.users[2], accepted=False)
+
+        expected = {
+            (self.today, 0, self.users[0].id): 2,
+            (self.today, 1, self.users[0].id): 1,
+            (self.today - timedelta(days=1), 0, self.users[1].id): 1,
+        }
+        self.assertEqual(self.counts(), expected)
+
+        first.delete()
+        expected[(self.today, 0, self.users[0].id)] = 1
+        self.assertEqual(self.counts(), expected)
+
+        order = Order.objects.get(user=self.users[1])
+        order.accepted = False
+        order.save()
+        del expected[(self.today - timedelta(days=1), 0, self.users[1].id)]
+        self.assertEqual(self.counts(), expected)
+
+    def test_rebuild_matches_counts(self):
+        for days_ago in range(3):
+            for user in self.users[days_ago:]:
+                self.order(user, days_ago=days_ago, location=days_ago % 2)
+
+        counted = self.counts()
+        leaderboard.rebuild()
+
+        self.assertEqual(self.counts(), counted)
+
+    def test_staff_classes(self):
+        worker, other, normal = self.users
+        worker.groups.add(Group.objects.create(name=settings.WORKER_GROUP))
+
+        def staff_class(user):
+            return Profile.objects.get(user=user).staff_class
+
+        self.assertEqual(staff_class(worker), Profile.STAFF_CLASS_STAFF)
+        self.assertEqual(staff_class(normal), Profile.STAFF_CLASS_NONE)
+
+        worker.groups.clear()
+        self.assertEqual(staff_class(worker), Profile.STAFF_CLASS_NONE)
+
+        group = Group.objects.get(name=settings.WORKER_GROUP)
+        group.user_set.add(other)
+        self.assertEqual(staff_class(other), Profile.STAFF_CLASS_STAFF)
+
+        group.delete()
+        self.assertEqual(staff_class(other), Profile.STAFF_CLASS_NONE)
+
+    def test_top_users_and_rank(self):
+        for user, orders in zip(self.users, (3, 1, 3)):
+            for _ in range(orders):
+                self.order(user)
+        self.order(self.users[1], days_ago=30)
+
+        dates = (self.today, self.today)
+        top = leaderboard.get_top_users(
+            leaderboard.STAFF_CLASSES, dates, public_only=False
+        )
+
+        self.assertEqual(
+            sorted((user.num_orders, user.rank) for user in top),
+            [(1, 2), (3, 1), (3, 1)],
+        )
+        self.assertEqual(
+            leaderboard.get_rank(self.users[1], leaderboard.STAFF_CLASSES, dates),
+            (2, 1),
+        )
+        self.assertEqual(
+            leaderboard.get_rank(self.users[1], leaderboard.STAFF_CLASSES),
+            (2, 2),
+        )
+
+    def test_high_score_queries(self):
+        for user in self.users:
+            self.order(user)
+
+        all_stats = Stats()
+        with self.assertNumQueries(2):
+            interval = all_stats.get_interval("today")
+
+        self.assertEqual(len(interval["groups"][0]["top_users"]), 3)
+
+    def test_snapshot(self):
+        cache.clear()
+        self.users[1].profile.show_profile = False
+        self.users[1].profile.save()
+        for user, orders in zip(self.users, (2, 1, 1)):
+            for _ in range(orders):
+                self.order(user)
+
+        snapshot = stats.get_snapshot()
+        today = snapshot["intervals"][0]
+        self.assertEqual(today["key"], "today")
+        self.assertEqual(
+            [(top["username"], top["rank"]) for top in today["groups"][0]["top_users"]],
+            [("user0", 1), ("user2", 2)],
+        )
+
+        self.assertEqual(stats.get_rank_for_user(today, self.users[1]), (2, 1, False))
+        with self.assertNumQueries(0):
+            self.assertEqual(stats.get_snapshot(), snapshot)
+
+        cache.set(stats.get_cache_key(None), '{"version":0}')
+        self.assertEqual(stats.get_snapshot()["version"], stats.SNAPSHOT_VERSION)
+
+    def test_high_score_shows_own_rank(self):
+        cache.clear()
+        self.users[0].profile.show_profile = False
+        self.users[0].profile.has_seen_consent = True
+        self.users[0].profile.save()
+        self.order(self.users[0])
+        self.order(self.users[1])
+        self.order(self.users[1])
+
+        # As built by update_stats.
+        stats.get_snapshot()
+        self.client.force_login(self.users[0])
+        response = self.client.get("/high-score")
+
+        self.assertEqual(response.status_code, 200)
+        today = response.context["stats"][0]
+        self.assertEqual(
+            [(top["username"], top["rank"]) for top in today["groups"][0]["top_users"]],
+            [("user1", 1), ("user0", 2)],
+        )
+
+    def test_ranks_match_counted_ranks(self):
+        cache.clear()
+        generator = random.Random(1)
+        users = [User.objects.create(username="ranked%d" % i) for i in range(30)]
+        Profile.objects.filter(user__in=users[:10]).update(
+            staff_class=Profile.STAFF_CLASS_STAFF
+        )
+        for user in users[:25]:
+            for _ in range(generator.randrange(1, 6)):
+                self.order(
+                    user,
+                    days_ago=generator.randrange(10),
+                    location=generator.randrange(2),
+                )
+
+        groups = [
+            [Profile.STAFF_CLASS_NONE, Profile.STAFF_CLASS_OLD_WORKER],
+            [Profile.STAFF_CLASS_STAFF],
+        ]
+        intervals = [
+            ("today", (self.today, self.today)),
+            ("week", (self.today - timedelta(days=6), self.today)),
+            ("total", None),
+        ]
+        for location in (None, 0, 1):
+            generation = ranks.build(
+                location, [(key, dates, groups) for key, dates in intervals]
+            )
+            for user in users:
+                user = User.objects.get(pk=user.pk)
+                is_staff = user.profile.staff_class == Profile.STAFF_CLASS_STAFF
+                found = ranks.get_ranks(
+                    generation, [(key, groups) for key, _ in intervals], user
+                )
+                for key, dates in intervals:
+                    counted = leaderboard.get_rank(
+                        user, groups[int(is_staff)], dates, location
+                    )
+                    self.assertEqual(found[key], counted + (is_staff,))
+
+        ranks.remove(generation)
+        self.assertIsNone(ranks.get_ranks(generation, [], users[0]))
+
+    def test_high_score_ranks_without_counting(self):
+        cache.clear()
+        for user, orders in zip(self.users, (3, 2, 1)):
+            for _ in range(orders):
+                self.order(user)
+        latecomer = User.objects.create(username="latecomer")
+        self.order(latecomer, days_ago=400)
+
+        snapshot = stats.get_snapshot()
+        latecomer = User.objects.select_related("profile").get(pk=latecomer.pk)
+
+        with self.assertNumQueries(0):
+            user_ranks = stats.get_ranks_for_user(snapshot, latecomer)
+        self.assertEqual(user_ranks["today"], (4, 0, False))
+        self.assertNotIn("total", user_ranks)
+
+        ranks.remove(snapshot["ranks"])
+        self.assertEqual(
+            stats.get_ranks_for_user(snapshot, latecomer)["today"], (4, 0, False)
+        )
@@ -0,0 +1,166 @@
+import itertools
+import random
+import time
+from datetime import date
+from io import StringIO
+
+import numpy as np
+from django.contrib.auth.models import Permission, User
+from django.core.management import call_command
+from django.test import TestCase
+
+from cafesys.baljan.models import Semester, ShiftSignup, WorkableShift
+from cafesys.baljan.workdist import matching
+
+
+class LinearSumAssignmentTestCase(TestCase):
+    def test_same_as_brute_force(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            n, m = rng.randint(1, 5), rng.randint(1, 5)
+            costs = np.array([[rng.randrange(10) for _ in range(m)] for _ in range(n)])
+
+            rows, columns = matching.linear_sum_assignment(costs)
+            self.assertEqual(len(rows), min(n, m))
+            self.assertEqual(len(set(rows)), len(rows))
+            self.assertEqual(len(set(columns)), len(columns))
+
+            if n <= m:
+                best = min(
+                    sum(costs[i, p[i]] for i in range(n))
+                    for p in itertools.permutations(range(m), n)
+                )
+            else:
+                best = min(
+                    sum(costs[p[j], j] for j in range(m))
+                    for p in itertools.permutations(range(n), m)
+                )
+            self.assertEqual(costs[rows, columns].sum(), best)
+
+    def test_hundreds_of_workers(self):
+        # 300 workers listing 10 of 150 combinations each, two places in each.
+        rng = random.Random(0)
+        costs = np.full((300, 300), 1000.0)
+        for row in range(300):
+            for priority, label in enumerate(rng.sample(range(150), 10)):
+                costs[row, [2 * label, 2 * label + 1]] = priority
+
+        start = time.perf_counter()
+        rows, columns = matching.linear_sum_assignment(costs)
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertEqual(len(rows), 300)
+
+
+class MatchingTestCase(TestCase):
+    def setUp(self):
+        # A week of four worker shifts a day, in five combinations of four.
+        self.semester = Semester.objects.create(
+            name="HT2019", start=date(2019, 8, 19), end=date(2019, 8, 23)
+        )
+        self.combinations = {
+            combination.label: combination
+            for combination in self.semester.shiftcombination_set.all()
+        }
+        self.a, self.b, self.c, self.d, self.e, self.f = [
+            User.objects.create(username=name) for name in "abcdef"
+        ]
+
+        self.prefer(self.a, "1", "2")
+        self.prefer(self.b, "3", "1")
+        self.prefer(self.c, "2", "1")
+        self.prefer(self.d, "1")
+        self.prefer(self.f, "3")
+
+        # e already has one of the places of combination 3.
+        self.prefer(self.e, "3")
+        ShiftSignup.objects.create(
+            user=self.e, shift=self.combinations["3"].shifts.first()
+        )
+
+    def prefer(self, user, *labels):
+        for priority, label in enumerate(labels):
+            WorkableShift.objects.create(
+                user=user, semester=self.semester, combination=label, priority=priority
+            )
+
+    def assignment(self, result):
+        return {(m.user_id, m.combination) for m in result.matches}
+
+    def test_match(self):
+        result = matching.match(self.semester)
+
+        # Everyone gets a combination, since b takes the second place of 1
+        # and a moves to 2, rather than b taking the last place of 3 from f.
+        self.assertEqual(
+            self.assignment(result),
+            {
+                (self.a.id, "2"),
+                (self.b.id, "1"),
+                (self.c.id, "2"),
+                (self.d.id, "1"),
+                (self.f.id, "3"),
+            },
+        )
+        self.assertEqual(result.cost, 2)
+        self.assertEqual(result.unmatched, [])
+
+    def test_unmatched(self):
+        g = User.objects.create(username="g")
+        self.prefer(g, "3")
+
+        result = matching.match(self.semester)
+        self.assertEqual(len(result.matches), 5)
+        self.assertEqual(len(result.unmatched), 1)
+        self.assertIn(result.unmatched[0], {self.f.id, g.id})
+
+    def test_save(self):
+        result = matching.match(self.semester)
+        with self.captureOnCommitCallbacks(execute=True):
+            signups = matching.save(self.semester, result.matches)
+
+        self.assertEqual(len(signups), 5 * 4)
+        self.assertEqual(
+            set(
+                ShiftSignup.objects.filter(user=self.b).values_list("shift", flat=True)
+            ),
+            set(self.combinations["1"].shifts.values_list("id", flat=True)),
+        )
+
+        # Everyone that was matched is now signed up.
+        self.assertEqual(matching.match(self.semester).matches, [])
+
+    def test_command(self):
+        out = StringIO()
+        call_command("match_shift_combinations", "HT2019", stdout=out)
+        self.assertIn("Matched 5 workers with a total priority of 2", out.getvalue())
+        self.assertEqual(ShiftSignup.objects.count(), 1)
+
+        call_command("match_shift_combinations", "HT2019", save=True, stdout=out)
+        self.assertEqual(ShiftSignup.objects.count(), 1 + 5 * 4)
+
+    def test_view_previews_before_saving(self):
+        staff = User.objects.create(username="staff")
+        staff.user_permissions.add(
+            Permission.objects.get(codename="manage_job_openings")
+        )
+        staff.profile.has_seen_consent = True
+        staff.profile.save()
+        self.client.force_login(staff)
+
+        response = self.client.get("/shift-matching/HT2019")
+        self.assertEqual(response.status_code, 200)
+        digest = response.context["digest"]
+        self.assertEqual(len(response.context["matches"]), 5)
+        self.assertEqual(ShiftSignup.objects.count(), 1)
+
+        # The proposal changes when a preference does.
+        self.prefer(User.objects.create(username="g"), "4")
+        response = self.client.post("/shift-matching/HT2019", {"digest": digest})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ShiftSignup.objects.count(), 1)
+
+        response = self.client.post(
+            "/shift-matching/HT2019", {"digest": response.context["digest"]}
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(ShiftSignup.objects.count(), 1 + 6 * 4)
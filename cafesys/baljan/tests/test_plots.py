@@ -0,0 +1,94 @@
+from datetime import datetime
+from unittest import mock
+
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from cafesys.baljan import rollup
+from cafesys.baljan.models import Order
+
+
+class PlotTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="staff")
+        self.user.user_permissions.add(Permission.objects.get(codename="view_order"))
+        self.user.profile.has_seen_consent = True
+        self.user.profile.save()
+        self.client.force_login(self.user)
+
+        self.order(4, 10, 5)
+        self.order(5, 12, 40)
+
+    def order(self, day, hour, minute):
+        Order.objects.create(
+            user=self.user,
+            paid=5,
+            location=0,
+            accepted=True,
+            put_at=timezone.make_aware(datetime(2024, 3, day, hour, minute)),
+        )
+        rollup.backfill()
+
+    def page(self, **params):
+        with mock.patch("cafesys.baljan.plots.render_plot.delay") as delay:
+            response = self.client.get("/stats/heatmap", params)
+        self.assertEqual(response.status_code, 200)
+        return response.context["image_url"], delay
+
+    def test_plot_is_drawn_once_for_the_same_data(self):
+        url, delay = self.page()
+        key = url.rsplit("/", 1)[1].removesuffix(".png")
+        delay.assert_called_once_with(key)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertTrue(response.content.startswith(b"\x89PNG"))
+        self.assertEqual(response["ETag"], '"%s"' % key)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"%s"' % key)
+        self.assertEqual(response.status_code, 304)
+
+        # The same again is already drawn.
+        same_url, delay = self.page()
+        self.assertEqual(same_url, url)
+        delay.assert_not_called()
+
+        # Another filter, or new data, is another plot.
+        self.assertNotEqual(self.page(put_at__gt="2024-03-05")[0], url)
+        self.order(6, 9, 0)
+        self.assertNotEqual(self.page()[0], url)
+
+    def test_unknown_plot(self):
+        response = self.client.get("/stats/plot/%s.png" % ("0" * 32))
+        self.assertEqual(response.status_code, 404)
+
+    def test_heatmap_json(self):
+        self.order(4, 10, 14)
+        self.order(9, 10, 0)  # A Saturday.
+
+        response = self.client.get("/stats/heatmap.json")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+
+        self.assertEqual(data["weekdays"][0], "Måndag")
+        self.assertEqual(data["times"][:2], ["08:00", "08:15"])
+        self.assertEqual(data["times"][-1], "16:45")
+        self.assertEqual(len(data["counts"]), 5)
+        self.assertEqual(data["counts"][0][data["times"].index("10:00")], 2)
+        self.assertEqual(data["counts"][1][data["times"].index("12:30")], 1)
+        self.assertEqual(sum(map(sum, data["counts"])), 3)
+
+        # The orders on the day of put_at__gt are included.
+        response = self.client.get("/stats/heatmap.json", {"put_at__gt": "2024-03-05"})
+        self.assertEqual(sum(map(sum, response.json()["counts"])), 1)
+        response = self.client.get("/stats/heatmap.json", {"put_at__gt": "2024-03-06"})
+        self.assertEqual(sum(map(sum, response.json()["counts"])), 0)
+
+        # What was paid is filtered on the orders themselves.
+        for params, count in (({"paid": 5}, 3), ({"paid__gt": 5}, 0)):
+            response = self.client.get("/stats/heatmap.json", params)
+            self.assertEqual(sum(map(sum, response.json()["counts"])), count)
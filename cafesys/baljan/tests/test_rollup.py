@@ -0,0 +1,163 @@
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import TestCase
+from django.utils import timezone
+from redis.exceptions import RedisError
+
+from cafesys.baljan import rollup
+from cafesys.baljan.models import Order, OrderRollup, Profile
+
+
+class RollupTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.today = date.today()
+        self.users = [User.objects.create(username="user%d" % i) for i in range(2)]
+        Profile.objects.filter(user=self.users[1]).update(
+            staff_class=Profile.STAFF_CLASS_STAFF
+        )
+
+    def order(self, user, days_ago=0, hour=12, minute=0, paid=9, location=0):
+        put_at = datetime.combine(
+            self.today - timedelta(days=days_ago), datetime.min.time()
+        ) + timedelta(hours=hour, minutes=minute)
+        return Order.objects.create(
+            user=user,
+            paid=paid,
+            location=location,
+            put_at=timezone.make_aware(put_at),
+        )
+
+    def rollup(self):
+        return {
+            (
+                row.date,
+                row.hour,
+                row.quarter,
+                row.location,
+                row.staff_class,
+            ): (row.count, row.paid, row.users)
+            for row in OrderRollup.objects.all()
+        }
+
+    def test_refresh(self):
+        self.order(self.users[0], minute=5)
+        self.order(self.users[0], minute=14)
+        self.order(self.users[0], minute=20, paid=0)
+        self.order(self.users[1], days_ago=1, hour=8, minute=59, location=1)
+
+        self.assertTrue(rollup.refresh())
+
+        yesterday = self.today - timedelta(days=1)
+        expected = {
+            (self.today, 12, 0, 0, Profile.STAFF_CLASS_NONE): (2, 18, 1),
+            (self.today, 12, 15, 0, Profile.STAFF_CLASS_NONE): (1, 0, 1),
+            (yesterday, 8, 45, 1, Profile.STAFF_CLASS_STAFF): (1, 9, 1),
+        }
+        self.assertEqual(self.rollup(), expected)
+
+        self.order(self.users[1], minute=1)
+        rollup.refresh()
+
+        expected[(self.today, 12, 0, 0, Profile.STAFF_CLASS_STAFF)] = (1, 9, 1)
+        self.assertEqual(self.rollup(), expected)
+
+    def test_changed_and_deleted_orders(self):
+        first = self.order(self.users[0])
+        second = self.order(self.users[1], days_ago=3)
+        with self.settings(ORDER_ROLLUP_GRACE_SECONDS=0):
+            rollup.refresh()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+            second.put_at -= timedelta(days=1)
+            second.save()
+        rollup.refresh()
+
+        self.assertEqual(
+            self.rollup(),
+            {
+                (self.today - timedelta(days=4), 12, 0, 0, Profile.STAFF_CLASS_STAFF): (
+                    1,
+                    9,
+                    1,
+                ),
+            },
+        )
+
+    def test_marked_days_survive_failures(self):
+        order = self.order(self.users[0])
+        rollup.refresh()
+
+        with mock.patch(
+            "cafesys.baljan.rollup.get_redis_connection",
+            side_effect=RedisError("down"),
+        ):
+            # Saving is not failed by Redis being down.
+            with self.assertLogs("cafesys.baljan.rollup", "ERROR"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    order.save()
+
+        order.put_at -= timedelta(days=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            order.save()
+        with mock.patch(
+            "cafesys.baljan.rollup._replace", side_effect=DatabaseError("down")
+        ):
+            with self.assertRaises(DatabaseError):
+                rollup.refresh()
+
+        # The days marked before the failure are still counted again.
+        rollup.refresh()
+        self.assertEqual(
+            set(self.rollup()),
+            {(self.today - timedelta(days=1), 12, 0, 0, Profile.STAFF_CLASS_NONE)},
+        )
+
+    def test_backfill_matches_refresh(self):
+        for days_ago in range(3):
+            for minute in range(0, 60, 7):
+                self.order(self.users[minute % 2], days_ago=days_ago, minute=minute)
+
+        rollup.refresh()
+        refreshed = self.rollup()
+        call_command("backfill_order_rollup", stdout=StringIO())
+
+        self.assertEqual(self.rollup(), refreshed)
+
+    def test_stats_read_the_rollup(self):
+        # The heatmap is of weekdays only, so on a Wednesday.
+        days_ago = 7 + (self.today.weekday() - 2) % 7
+        self.order(self.users[0], days_ago=days_ago)
+        self.order(self.users[1], days_ago=days_ago)
+        # Reading does not refresh, the update_order_rollup task does.
+        self.assertFalse(rollup.rows().exists())
+        rollup.refresh()
+
+        staff = User.objects.create(username="staff", is_staff=True)
+        staff.user_permissions.add(
+            Permission.objects.get(
+                content_type__app_label="baljan", codename="view_order"
+            )
+        )
+        staff.profile.has_seen_consent = True
+        staff.profile.save()
+        self.client.force_login(staff)
+
+        for path in ("/stats/heatmap", "/stats/blipp", "/stats/active-users"):
+            self.assertEqual(self.client.get(path).status_code, 200)
+
+        out = StringIO()
+        call_command("csvdumpmonth", stdout=out)
+
+        month = self.today - timedelta(days=days_ago)
+        self.assertEqual(
+            out.getvalue().splitlines(),
+            ["month,%d" % month.year, "%d,2" % month.month],
+        )
@@ -0,0 +1,68 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from cafesys.baljan.models import Semester, WorkableShift
+
+
+class SemesterShiftsTestCase(TestCase):
+    def setUp(self):
+        # Five weeks of four worker shifts a day, in 25 combinations.
+        self.semester = Semester.objects.create(
+            name="HT2019", start=date(2019, 8, 19), end=date(2019, 9, 20)
+        )
+        self.labels = sorted(
+            self.semester.shiftcombination_set.values_list("label", flat=True)
+        )
+        self.user = User.objects.create(username="worker")
+        self.user.profile.has_seen_consent = True
+        self.user.profile.save()
+        self.client.force_login(self.user)
+
+    def save(self, priorities):
+        data = {}
+        for label in self.labels:
+            if label in priorities:
+                data["workable-" + label] = "on"
+                data["priority-" + label] = priorities[label]
+            else:
+                data["priority-" + label] = 0
+        return self.client.post(
+            "/semester-shifts/HT2019",
+            data,
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+
+    def preferences(self):
+        return dict(
+            WorkableShift.objects.filter(user=self.user).values_list(
+                "combination", "priority"
+            )
+        )
+
+    def test_saves_preferences_in_bulk(self):
+        first, second, third = self.labels[:3]
+
+        self.save({first: 0, second: 1})
+        self.assertEqual(self.preferences(), {first: 0, second: 1})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.save({second: 0, third: 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.preferences(), {second: 0, third: 1})
+
+        # Not a query per combination.
+        self.assertLess(len(queries), len(self.labels))
+
+    def test_page_does_not_query_per_combination(self):
+        self.save({self.labels[0]: 0})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/semester-shifts/HT2019")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["shift_numbers"], [1, 2, 3, 4])
+        self.assertEqual(len(response.context["workable_shifts"]), 1)
+        self.assertLess(len(queries), len(self.labels))
@@ -0,0 +1,91 @@
+import json
+from datetime import date, datetime
+
+from django.contrib.auth.models import Permission, User
+from django.test import TestCase
+from django.utils import timezone
+
+from cafesys.baljan import rollup, series
+from cafesys.baljan.models import BalanceCode, Order, RefillSeries
+
+
+class SeriesTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="finance")
+        self.user.user_permissions.add(Permission.objects.get(codename="view_order"))
+        self.user.profile.has_seen_consent = True
+        self.user.profile.save()
+
+        # Monday and Tuesday of one week, the Monday after and a day of the
+        # month after.
+        self.order(date(2024, 2, 26), 5)
+        self.order(date(2024, 2, 26), 7, location=1)
+        self.order(date(2024, 2, 27), 9)
+        self.order(date(2024, 3, 4), 11, location=1)
+        rollup.backfill()
+
+        refill_series = RefillSeries.objects.create(code_count=0)
+        for used_at, value in (
+            (date(2024, 2, 27), 100),
+            (date(2024, 3, 4), 200),
+            (None, 400),
+        ):
+            BalanceCode.objects.create(
+                refill_series=refill_series, value=value, used_at=used_at
+            )
+
+    def order(self, day, paid, location=0):
+        Order.objects.create(
+            user=self.user,
+            paid=paid,
+            location=location,
+            accepted=True,
+            put_at=timezone.make_aware(datetime.combine(day, datetime.min.time())),
+        )
+
+    def test_running_totals(self):
+        self.assertEqual(
+            list(series.orders()),
+            [
+                (date(2024, 2, 26), 12, 12),
+                (date(2024, 2, 27), 9, 21),
+                (date(2024, 3, 4), 11, 32),
+            ],
+        )
+        self.assertEqual(
+            list(series.orders("week")),
+            [(date(2024, 2, 26), 21, 21), (date(2024, 3, 4), 11, 32)],
+        )
+        self.assertEqual(
+            list(series.orders("month", locations=[1])),
+            [(date(2024, 2, 1), 7, 7), (date(2024, 3, 1), 11, 18)],
+        )
+        self.assertEqual(
+            list(series.orders(start=date(2024, 2, 27), end=date(2024, 2, 27))),
+            [(date(2024, 2, 27), 9, 9)],
+        )
+        self.assertEqual(
+            list(series.refills("week")),
+            [(date(2024, 2, 26), 100, 100), (date(2024, 3, 4), 200, 300)],
+        )
+
+    def test_view_streams_json(self):
+        self.client.force_login(self.user)
+
+        response = self.client.get(
+            "/stats/series.json", {"granularity": "week", "location": [0]}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            json.loads(b"".join(response.streaming_content)),
+            {
+                "granularity": "week",
+                "orders": [["2024-02-26", 14, 14]],
+                "refills": [["2024-02-26", 100, 100], ["2024-03-04", 200, 300]],
+            },
+        )
+
+        response = self.client.get("/stats/series.json", {"granularity": "year"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("granularity", response.json()["errors"])
@@ -0,0 +1,77 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from django.test import SimpleTestCase
+
+import cafesys
+
+# Libraries that take long to import and are only needed by a few views, which
+# import them when they are first used.
+HEAVY_LIBRARIES = {"matplotlib", "numpy", "pandas", "scipy", "seaborn", "stripe"}
+
+# What a web or Celery worker imports before handling anything.
+STARTUP = """
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+import cafesys.wsgi
+from cafesys.celery import app
+app.loader.import_default_modules()
+"""
+
+
+def parse_importtime(output):
+    """The modules of `python -X importtime` output as (depth, name), in the
+    order their imports finished."""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        name = line.rsplit("|", 1)[1]
+        if name.strip() == "imported package":
+            continue
+        modules.append(((len(name) - len(name.lstrip()) - 1) // 2, name.strip()))
+    return modules
+
+
+def is_heavy(module):
+    return module.split(".")[0] in HEAVY_LIBRARIES
+
+
+def import_chain(modules, index):
+    """The modules that led to the import of the module at `index`, the first
+    one last."""
+    depth, name = modules[index]
+    chain = [name]
+    for other_depth, other_name in modules[index + 1 :]:
+        if other_depth < depth:
+            chain.append(other_name)
+            depth = other_depth
+    return chain
+
+
+class StartupImportsTestCase(SimpleTestCase):
+    def test_heavy_libraries_are_not_imported_at_startup(self):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", STARTUP],
+            cwd=Path(cafesys.__file__).parent.parent,
+            env=os.environ,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+
+        modules = parse_importtime(result.stderr)
+        self.assertTrue(any(name == "cafesys.baljan.views" for _, name in modules))
+
+        # Where each of the libraries was first imported from.
+        imported = []
+        for i, (_, name) in enumerate(modules):
+            if is_heavy(name):
+                chain = import_chain(modules, i)
+                if not any(is_heavy(importer) for importer in chain[1:]):
+                    imported.append(" <- ".join(chain))
+        self.assertEqual(imported, [])
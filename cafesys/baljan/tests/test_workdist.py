@@ -1,7 +1,15 @@
 import math
+import random
+from contextlib import redirect_stdout
+from io import StringIO
 
 from django.test import TestCase
 
+from cafesys.baljan.management.commands.benchmark_workdist import (
+    LegacyShiftAssigner,
+    assignment,
+    synthetic_shifts,
+)
 from cafesys.baljan.workdist.available_shift import AvailableShift
 from cafesys.baljan.workdist.shift_assigner import ShiftAssigner
 
@@ -21,6 +29,19 @@ class WorkdistTestCase(TestCase):
 
         self.assertShiftAssignmentIsReasonable(assigner)
 
+    def test_same_as_legacy_assigner(self):
+        for years, disabled, seed in [(1, 0.0, 0), (1, 0.3, 1), (2, 0.05, 2)]:
+            shifts = synthetic_shifts(years, random.Random(seed), disabled)
+            assigners = [LegacyShiftAssigner(), ShiftAssigner()]
+            for assigner in assigners:
+                assigner.all_shifts = list(shifts)
+                with redirect_stdout(StringIO()):
+                    assigner.assign()
+
+            legacy, indexed = assigners
+            self.assertEqual(assignment(indexed), assignment(legacy))
+            self.assertShiftAssignmentIsReasonable(indexed)
+
     def assertShiftAssignmentIsReasonable(self, assigner):
         self.assertPairDoesNotWorkTwiceOnSameDay(assigner.shift_combinations)
         self.assertMinimalAmountInExamPeriod(assigner.shift_combinations)
@@ -34,7 +55,7 @@ class WorkdistTestCase(TestCase):
             dates = []
             for shift in combination.shifts:
                 self.assertNotIn(shift.date, dates)
-                dates += shift.date
+                dates.append(shift.date)
 
     # Minimalt antal på tenta-p
     def assertMinimalAmountInExamPeriod(self, shift_combinations):
@@ -110,20 +131,44 @@ def generate_shifts(instance, num_dates_list, karall=True, sth=True, prefix="Dat
 
             if karall:
                 instance.all_shifts.append(
-                    AvailableShift(date, "Kårallen", "Morning", exam_period)
+                    AvailableShift(
+                        date,
+                        "Kårallen",
+                        "Morning",
+                        exam_period,
+                        len(instance.all_shifts),
+                    )
                 )
 
             if sth:
                 instance.all_shifts.append(
-                    AvailableShift(date, "Studenthus Valla", "Morning", exam_period)
+                    AvailableShift(
+                        date,
+                        "Studenthus Valla",
+                        "Morning",
+                        exam_period,
+                        len(instance.all_shifts),
+                    )
                 )
 
             if karall:
                 instance.all_shifts.append(
-                    AvailableShift(date, "Kårallen", "Afternoon", exam_period)
+                    AvailableShift(
+                        date,
+                        "Kårallen",
+                        "Afternoon",
+                        exam_period,
+                        len(instance.all_shifts),
+                    )
                 )
 
             if sth:
                 instance.all_shifts.append(
-                    AvailableShift(date, "Studenthus Valla", "Afternoon", exam_period)
+                    AvailableShift(
+                        date,
+                        "Studenthus Valla",
+                        "Afternoon",
+                        exam_period,
+                        len(instance.all_shifts),
+                    )
                 )
@@ -1,8 +1,10 @@
 from datetime import date
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
-from cafesys.baljan.models import Semester
+from cafesys.baljan.models import Semester, Shift, ShiftCombination
 from cafesys.baljan.workdist.workdist_adapter import WorkdistAdapter
 
 
@@ -19,3 +21,41 @@ class WorkdistAdapterTestCase(TestCase):
         adapter.load_from_db()
         adapter.assign_shifts()
         adapter.store_in_db()
+
+    def test_semester_is_created_in_bulk(self):
+        semester = Semester(
+            start=date(year=2019, month=8, day=19),
+            end=date(year=2019, month=12, day=20),
+            name="HT2019",
+        )
+        with CaptureQueriesContext(connection) as queries:
+            semester.save()
+        self.assertLessEqual(len(queries), 12)
+
+        # 90 weekdays, three spans and two locations.
+        self.assertEqual(semester.shift_set.count(), 90 * 3 * 2)
+        worker_shifts = semester.shift_set.exclude(span=1)
+        self.assertEqual(
+            set(worker_shifts.values_list("id", flat=True)),
+            set(
+                ShiftCombination.shifts.through.objects.filter(
+                    shiftcombination__semester=semester
+                ).values_list("shift", flat=True)
+            ),
+        )
+        self.assertFalse(
+            Shift.objects.filter(
+                semester=semester, span=1, shiftcombination__isnull=False
+            ).exists()
+        )
+
+        # Again, as when shifts are updated.
+        with CaptureQueriesContext(connection) as queries:
+            WorkdistAdapter.recreate_shift_combinations(semester)
+        self.assertLessEqual(len(queries), 10)
+        self.assertEqual(
+            ShiftCombination.shifts.through.objects.filter(
+                shiftcombination__semester=semester
+            ).count(),
+            worker_shifts.count(),
+        )
@@ -0,0 +1,510 @@
+import gzip
+import json
+import random
+import warnings
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db.models import (
+    Count,
+    DurationField,
+    Exists,
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Window,
+)
+from django.db.models.functions import Lag, TruncDate
+from django.test import TestCase
+from django.utils import timezone
+
+from cafesys.baljan import leaderboard, stats, wrapped, wrapped_columnar
+from cafesys.baljan.models import Order, Semester, Wrapped
+
+
+class WrappedTestCase(TestCase):
+    def setUp(self):
+        self.semester = Semester.objects.create(
+            name="VT2025", start=date(2025, 1, 6), end=date(2025, 1, 19)
+        )
+        self.a, self.b, self.c, self.w = [
+            User.objects.create(username=name) for name in ("a", "b", "c", "w")
+        ]
+        self.w.groups.add(Group.objects.create(name=settings.WORKER_GROUP))
+
+        self.order(self.a, 6, 9, 0)
+        self.order(self.a, 6, 9, 30)
+        self.order(self.b, 6, 10, 0)
+        self.order(self.w, 6, 10, 0)
+
+        self.order(self.a, 7, 12, 0)
+        self.order(self.b, 7, 8, 0)
+        # Rejected, so not the shortest delta of b.
+        self.order(self.b, 7, 8, 1, accepted=False)
+        self.order(self.b, 7, 8, 5)
+        self.order(self.b, 7, 9, 0)
+        self.order(self.c, 7, 12, 0)
+
+        self.order(self.a, 8, 12, 0, location=1)
+        self.order(self.c, 8, 12, 1, accepted=False)
+
+    def order(self, user, day, hour, minute, location=0, accepted=True):
+        return Order.objects.create(
+            user=user,
+            paid=0,
+            location=location,
+            accepted=accepted,
+            put_at=timezone.make_aware(datetime(2025, 1, day, hour, minute)),
+        )
+
+    def test_metrics(self):
+        data = wrapped.compute(self.semester)
+        self.assertEqual(set(data), {self.a.id, self.b.id, self.c.id, self.w.id})
+
+        self.assertEqual(
+            data[self.a.id],
+            {
+                "is_staff": False,
+                "overall_placement": 0,
+                "n_orders": 4,
+                "caffeine_mg": 968,
+                "most_purchases": {"count": 2, "dates": [date(2025, 1, 6)]},
+                "best_placement": {
+                    "date": date(2025, 1, 6),
+                    "count": 2,
+                    "place": 0,
+                    "shared": 0,
+                    "other_dates": [date(2025, 1, 8)],
+                },
+                "longest_streak": {
+                    "start": date(2025, 1, 6),
+                    "end": date(2025, 1, 8),
+                    "duration": 3,
+                },
+                "shortest_delta": timedelta(minutes=30),
+                "fav_cafe": {"id": 0, "n_orders": 3},
+                "week_avg": 1.8,
+            },
+        )
+
+        b = data[self.b.id]
+        self.assertEqual(b["overall_placement"], 1)
+        self.assertEqual(b["shortest_delta"], timedelta(minutes=5))
+        self.assertEqual(b["best_placement"]["date"], date(2025, 1, 7))
+        self.assertEqual(b["best_placement"]["other_dates"], [])
+        self.assertEqual(b["longest_streak"]["duration"], 2)
+
+        c = data[self.c.id]
+        self.assertEqual(c["overall_placement"], 2)
+        self.assertEqual(c["best_placement"]["place"], 1)
+        self.assertEqual(c["best_placement"]["shared"], 1)
+        self.assertIsNone(c["shortest_delta"])
+
+        w = data[self.w.id]
+        self.assertTrue(w["is_staff"])
+        self.assertEqual(w["overall_placement"], 0)
+        self.assertEqual(w["best_placement"]["place"], 0)
+
+    def test_columnar_gives_the_same_result(self):
+        self.assertEqual(
+            wrapped_columnar.compute(self.semester), wrapped.compute(self.semester)
+        )
+
+    def test_processes_give_the_same_result(self):
+        expected = wrapped.compute(self.semester)
+        with mock.patch.object(wrapped, "BATCH_SIZE", 1):
+            self.assertEqual(wrapped.compute(self.semester, processes=2), expected)
+
+    def test_command_replaces_wrapped(self):
+        call_command("generate_wrapped", "VT2025", stdout=StringIO())
+        self.assertEqual(Wrapped.objects.count(), 4)
+
+        self.order(self.c, 9, 12, 0)
+        out = StringIO()
+        call_command("generate_wrapped", "VT2025", user="c", stdout=out)
+
+        self.assertIn("daily counts:", out.getvalue())
+        self.assertEqual(Wrapped.objects.count(), 4)
+        self.assertEqual(Wrapped.objects.get(user=self.c).data["n_orders"], 2)
+        self.assertEqual(Wrapped.objects.get(user=self.a).data["n_orders"], 4)
+
+    def test_view_serves_the_payload(self):
+        cache.clear()
+        call_command("generate_wrapped", "VT2025", stdout=StringIO())
+        self.a.profile.has_seen_consent = True
+        self.a.profile.save()
+        self.client.force_login(self.a)
+
+        response = self.client.get("/wrapped", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        data = json.loads(gzip.decompress(response.content))
+        self.assertEqual(data["n_orders"], 4)
+        self.assertEqual(data["longest_streak"]["start"], "2025-01-06")
+
+        etag = response["ETag"]
+        with self.assertNumQueries(0):
+            wrapped.get_payload(self.a)
+        response = self.client.get("/wrapped", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get("/wrapped")
+        self.assertNotIn("Content-Encoding", response)
+        self.assertEqual(json.loads(response.content), data)
+
+        # Generating again replaces what is cached.
+        self.order(self.a, 9, 12, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("generate_wrapped", "VT2025", stdout=StringIO())
+        response = self.client.get("/wrapped", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["n_orders"], 5)
+
+    def test_payload_follows_data(self):
+        cache.clear()
+        obj = Wrapped.objects.create(
+            user=self.a, semester=self.semester, data={"n_orders": 1}
+        )
+        self.assertEqual(wrapped.get_payload(self.a), wrapped.serialize(obj.data))
+
+        obj.data = {"n_orders": 2}
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.save(update_fields=["data"])
+        content, _ = wrapped.get_payload(self.a)
+        self.assertEqual(json.loads(gzip.decompress(content)), {"n_orders": 2})
+
+        # What was written around the model, without a payload, is not served.
+        Wrapped.objects.filter(pk=obj.pk).update(payload=b"", payload_hash="")
+        cache.clear()
+        self.assertIsNone(wrapped.get_payload(self.a))
+
+
+class ColumnarWrappedTestCase(TestCase):
+    def setUp(self):
+        self.semester = Semester.objects.create(
+            name="HT2025", start=date(2025, 9, 1), end=date(2025, 9, 28)
+        )
+        staff_group = Group.objects.create(name=settings.WORKER_GROUP)
+
+        rng = random.Random(2025)
+        users = [User.objects.create(username="user%d" % i) for i in range(40)]
+        for user in users[:8]:
+            user.groups.add(staff_group)
+
+        orders = []
+        for day in range(1, 29):
+            for user in users:
+                # Few orders for many, so that there are ties.
+                for _ in range(rng.choice([0, 0, 0, 1, 1, 2, 3])):
+                    orders.append(
+                        Order(
+                            user=user,
+                            paid=0,
+                            location=rng.choice([0, 0, 1]),
+                            accepted=rng.random() > 0.05,
+                            put_at=timezone.make_aware(
+                                datetime(2025, 9, day, rng.randrange(7, 23))
+                                + timedelta(seconds=rng.randrange(3600))
+                            ),
+                        )
+                    )
+        Order.objects.bulk_create(orders)
+        leaderboard.rebuild()
+
+    def test_same_as_queries(self):
+        expected = wrapped.compute(self.semester)
+        self.assertEqual(len(expected), 40)
+        self.assertEqual(wrapped_columnar.compute(self.semester), expected)
+
+
+class LegacyWrappedTestCase(TestCase):
+    def setUp(self):
+        # The old command placed users on the top list of the current
+        # semester, so this one is current. Every order is accepted and made
+        # before its last day, which the old command did not read.
+        today = date.today()
+        self.semester = Semester.objects.create(
+            name="HT%d" % today.year,
+            start=today - timedelta(days=28),
+            end=today + timedelta(days=7),
+        )
+        staff_group = Group.objects.create(name=settings.WORKER_GROUP)
+
+        rng = random.Random(2024)
+        users = [User.objects.create(username="user%d" % i) for i in range(12)]
+        for user in users[:4]:
+            user.groups.add(staff_group)
+
+        orders = []
+        for i, user in enumerate(users):
+            # Everybody has a different total, and most orders at one place,
+            # as the old command broke those ties as the database pleased.
+            days = sorted(rng.choices(range(14), k=4 + 3 * i))
+            for n, day in enumerate(days):
+                orders.append(
+                    Order(
+                        user=user,
+                        paid=0,
+                        location=(i + (n % 3 == 2)) % 2,
+                        accepted=True,
+                        put_at=timezone.make_aware(
+                            datetime.combine(
+                                self.semester.start + timedelta(days=day),
+                                datetime.min.time(),
+                            )
+                            + timedelta(
+                                hours=rng.randrange(7, 20),
+                                seconds=rng.randrange(3600),
+                            )
+                        ),
+                    )
+                )
+        # Somebody whose best day is not at the top.
+        orders.append(
+            Order(
+                user=User.objects.create(username="once"),
+                paid=0,
+                location=0,
+                accepted=True,
+                put_at=timezone.make_aware(
+                    datetime.combine(self.semester.start, datetime.min.time())
+                    + timedelta(hours=23)
+                ),
+            )
+        )
+        Order.objects.bulk_create(orders)
+        leaderboard.rebuild()
+
+    def test_same_as_legacy(self):
+        with warnings.catch_warnings():
+            # The old command filtered on naive dates.
+            warnings.simplefilter("ignore", RuntimeWarning)
+            expected = legacy_wrapped(self.semester)
+        self.assertEqual(len(expected), 13)
+
+        self.assertEqual(wrapped.compute(self.semester), expected)
+        self.assertEqual(wrapped_columnar.compute(self.semester), expected)
+
+
+def legacy_wrapped(semester):
+    """The Wrapped data of `semester` by user id, as the generate_wrapped
+    command computed it one user at a time before cafesys.baljan.wrapped.
+    Only the reading of options, printing and saving are left out, and the
+    dates of the most purchases are sorted as the database did not."""
+    a = (semester.end - semester.start).days
+    semester_length = a - ((a // 7) * 2)
+
+    users = (
+        User.objects.filter(
+            order__put_at__gte=semester.start,
+            order__put_at__lte=semester.end + timedelta(1),
+        )
+        .annotate(num_orders=Count("order"))
+        .exclude(num_orders=0)
+    )
+
+    staff_groups = User.objects.filter(
+        groups__name__in=[
+            settings.WORKER_GROUP,
+            settings.BOARD_GROUP,
+            settings.OLDIE_GROUP,
+        ]
+    ).distinct()
+
+    all_orders_of_sem = Order.objects.filter(
+        put_at__gte=semester.start, put_at__lte=semester.end
+    )
+
+    stats_by_date = dict()
+    scoreboard_data = (
+        all_orders_of_sem.annotate(date=TruncDate("put_at"))
+        .values("date", "user")
+        .annotate(
+            count=Count("date"),
+            is_staff=Exists(staff_groups.filter(id=OuterRef("user__id"))),
+        )
+        .values("date", "user", "count", "is_staff")
+        .order_by("date", "-count")
+    )
+
+    top = stats.compute_stats(interval="this_semester", limit=None, is_wrapped=True)[
+        "groups"
+    ]
+
+    assert len(top[0]["top_users"]) + len(top[1]["top_users"]) == len(users)
+
+    for entry in scoreboard_data:
+        d = entry["date"]
+        w = entry["is_staff"]
+        if d not in stats_by_date:
+            branches = dict(
+                regular=dict(by_user=dict(), by_count=dict(), top=[]),
+                worker=dict(by_user=dict(), by_count=dict(), top=[]),
+            )
+
+            stats_by_date[d] = branches
+
+        target = stats_by_date[d]["worker"] if w else stats_by_date[d]["regular"]
+
+        if len(target["top"]) < 15:
+            target["top"].append(entry["user"])
+
+        target["by_user"][entry["user"]] = entry["count"]
+
+        if entry["count"] not in target["by_count"]:
+            target["by_count"][entry["count"]] = []
+
+        target["by_count"][entry["count"]].append(entry["user"])
+
+    result = {}
+    for user in users:
+        is_staff = staff_groups.filter(id=user.id).exists()
+
+        wrapped_data = dict(
+            is_staff=is_staff,
+            overall_placement=(top[1 if is_staff else 0]["top_users"].index(user)),
+        )
+
+        user_orders = all_orders_of_sem.filter(user=user)
+
+        wrapped_data["n_orders"] = user_orders.count()
+        wrapped_data["caffeine_mg"] = round(2.2 * 110 * user_orders.count())
+
+        most_purchases_by_date = (
+            user_orders.annotate(date=TruncDate("put_at"))
+            .values("date")
+            .annotate(count=Count("date"))
+            .values("date", "count")
+            .order_by("-count")
+        )
+
+        most_purchases = dict(count=most_purchases_by_date[0]["count"], dates=[])
+
+        for day in most_purchases_by_date:
+            if day["count"] is not most_purchases["count"]:
+                break
+
+            most_purchases["dates"].append(day["date"])
+
+        most_purchases["dates"].sort()
+        wrapped_data["most_purchases"] = most_purchases
+
+        p = dict(date=None, count=None, place=None, shared=None, other_dates=[])
+
+        for day, data in stats_by_date.items():
+            target = data["worker"] if is_staff else data["regular"]
+
+            if user.id not in target["by_user"]:
+                continue
+
+            count = target["by_user"][user.id]
+
+            other_dates = []
+
+            bigger_counts = list(filter(lambda x: x > count, target["by_count"].keys()))
+
+            place = len(bigger_counts)
+            if p["place"] is not None:
+                if p["place"] < place:
+                    continue
+                elif p["place"] == place:
+                    if p["count"] < count:
+                        p["other_dates"].append(p["date"])
+                        p["date"] = day
+                        p["count"] = count
+                    else:
+                        p["other_dates"].append(day)
+                    continue
+
+            shared = len(target["by_count"][count])
+
+            p = dict(
+                date=day,
+                count=count,
+                place=place,
+                shared=shared - 1,
+                other_dates=other_dates,
+            )
+
+        wrapped_data["best_placement"] = p
+
+        items = list(stats_by_date.items())
+        streak = dict(start=None, end=None, duration=0)
+        start, end, duration = None, None, 0
+
+        i = 0
+        while i < len(items):
+            day, data = items[i]
+
+            on_scoreboard = user.id in data["worker" if is_staff else "regular"]["top"]
+
+            if on_scoreboard:
+                start = day
+                j = i
+
+                while j < len(items):
+                    on_scoreboard = (
+                        user.id
+                        in items[j][1]["worker" if is_staff else "regular"]["top"]
+                    )
+
+                    if not on_scoreboard:
+                        break
+
+                    end = items[j][0]
+                    j += 1
+
+                duration = j - i
+
+                if duration > streak["duration"]:
+                    streak = dict(start=start, end=end, duration=duration)
+
+                i = j
+
+            i += 1
+
+        wrapped_data["longest_streak"] = streak
+
+        wrapped_data["shortest_delta"] = (
+            None
+            if len(user_orders) == 1
+            else (
+                user_orders.annotate(
+                    prev_put_at=Window(
+                        expression=Lag("put_at"), order_by=F("put_at").asc()
+                    )
+                )
+                .values("put_at", "prev_put_at")
+                .exclude(prev_put_at__isnull=True)
+                .annotate(
+                    delta=ExpressionWrapper(
+                        F("put_at") - F("prev_put_at"), output_field=DurationField()
+                    )
+                )
+                .order_by("delta")
+                .first()["delta"]
+            )
+        )
+
+        fav_cafe_data = (
+            user_orders.values("location")
+            .annotate(count=Count("location"))
+            .values("location", "count")
+            .order_by("-count")
+            .first()
+        )
+        wrapped_data["fav_cafe"] = dict(
+            id=fav_cafe_data["location"],
+            n_orders=fav_cafe_data["count"],
+        )
+
+        wrapped_data["week_avg"] = round(5 * len(user_orders) / semester_length, 1)
+
+        result[user.id] = wrapped_data
+
+    return result
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from django.urls import path
 
-from . import views
+from . import payments, plots, views
 
 from slack_bolt.adapter.django import SlackRequestHandler
 from .slack import app
@@ -50,6 +50,11 @@ urlpatterns = (
         name="job_opening_projector",
     ),
     path("job-opening/<slug:semester_name>", views.job_opening, name="job_opening"),
+    path(
+        "shift-matching/<slug:semester_name>",
+        views.shift_matching,
+        name="shift_matching",
+    ),
     path(
         "call-duty/<int:year>/<int:week>", views.call_duty_week, name="call_duty_week"
     ),
@@ -80,22 +85,25 @@ urlpatterns = (
     path("incoming-sms", views.incoming_sms),
     path("consent", views.consent, name="consent"),
     path("do-blipp", views.do_blipp),
+    path("do-blipp/batch", views.do_blipp_batch),
     # Google
     path("google/pubsub", views.Google.pubsub),
     path("handle-interactivity", views.slack_events_handler),
     path("integrity", views.integrity, name="integrity"),
-    path("stripe/events", views.Stripe.events),
+    path("stripe/events", payments.Stripe.events),
     path(
-        "stripe/checkout/create", views.Stripe.create_checkout, name="checkout-create"
+        "stripe/checkout/create",
+        payments.Stripe.create_checkout,
+        name="checkout-create",
     ),
     path(
         "stripe/checkout/success",
-        views.Stripe.success_checkout,
+        payments.Stripe.success_checkout,
         name="checkout-success",
     ),
     path(
         "stripe/checkout/cancel",
-        views.Stripe.cancel_checkout,
+        payments.Stripe.cancel_checkout,
         name="checkout-cancel",
     ),
     # FIXME: These three above should be under like /webhooks/{google,slack,stripe} for cleanliness
@@ -103,13 +111,22 @@ urlpatterns = (
         "semester-shifts/<slug:sem_name>", views.semester_shifts, name="semester_shifts"
     ),
     path("styrelsen", views.styrelsen, name="styrelsen"),
-    path("stats/heatmap", views.stats_order_heatmap, name="stats_order_heatmap"),
-    path("stats/blipp", views.stats_blipp, name="stats_blipp"),
+    path("stats/heatmap", plots.stats_order_heatmap, name="stats_order_heatmap"),
+    path(
+        "stats/heatmap.json",
+        plots.stats_order_heatmap_json,
+        name="stats_order_heatmap_json",
+    ),
+    path("stats/blipp", plots.stats_blipp, name="stats_blipp"),
     path(
         "stats/active-users",
-        views.stats_active_blipp_users,
+        plots.stats_active_blipp_users,
         name="stats_active_blipp_users",
     ),
+    path("stats/plot/<str:key>.png", plots.plot_image, name="stats_plot"),
+    path("stats/requests.json", views.stats_requests, name="stats_requests"),
+    path("stats/series.json", views.stats_series, name="stats_series"),
     path("bookkeep", views.bookkeep_view, name="bookkeep"),
+    path("stats/orders.csv", views.export_orders, name="export_orders"),
     path("wrapped", views.wrapped_data, name="wrapped"),
 )
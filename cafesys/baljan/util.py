@@ -8,6 +8,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.template import defaultfilters
+from django.utils import timezone
 from html.entities import codepoint2name
 from itertools import chain, repeat
 
@@ -132,6 +133,14 @@ def date_range(start_date, end_date):
         yield start_date + timedelta(n)
 
 
+def local_date(dt):
+    """The date of `dt` in the current time zone. Naive datetimes are taken
+    to already be in it."""
+    if timezone.is_aware(dt):
+        return timezone.localdate(dt)
+    return dt.date()
+
+
 def overlap(x, y):
     return not (x[1] < y[0] or y[1] < x[0])
 
@@ -1,31 +1,29 @@
 # -*- coding: utf-8 -*-
 import base64
+import gzip
+import re
 import uuid
 import json
+import functools
 import itertools
-import copy
-from datetime import date, datetime, time, timedelta
-from io import BytesIO
+from datetime import date, datetime, time
 from logging import getLogger
 from icalendar import Calendar, Event
 
 from django.conf import settings
 from django.contrib import auth, messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import Group, User
 from django.core.exceptions import BadRequest
-from django.core.cache import cache
 from django.core.mail import EmailMultiAlternatives
 from django.core.serializers import serialize
 from django.core.signing import TimestampSigner, SignatureExpired, BadSignature
 from django.urls import reverse
 from django.db import transaction
-from django.db.models import Sum, Count, IntegerField, Case, When, Value, Subquery, F
+from django.db.models import Count, Value, Subquery
 from django.db.models.functions import (
-    ExtractHour,
-    ExtractMinute,
-    ExtractIsoWeekDay,
     Cast,
 )
 from django.http import (
@@ -36,6 +34,11 @@ from django.http import (
     HttpRequest,
 )
 from django.shortcuts import render, redirect, get_object_or_404
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
 from django.utils.translation import gettext as _
 from django.views.generic import ListView
 from django.views.generic.dates import WeekArchiveView
@@ -48,8 +51,6 @@ from django.contrib.auth.views import LoginView
 from django.utils.http import url_has_allowed_host_and_scheme
 
 
-import django_filters
-
 from cafesys.baljan import google, phone, slack
 from cafesys.baljan.gdpr import (
     AUTOMATIC_LIU_DETAILS,
@@ -60,22 +61,26 @@ from cafesys.baljan.gdpr import (
     ACTION_PROFILE_SAVED,
     revoke_automatic_fullname,
 )
-from cafesys.baljan.models import MutedConsent, BlippConfiguration
+from cafesys.baljan.models import MutedConsent
 from cafesys.baljan.pseudogroups import is_worker
 from cafesys.baljan.templatetags.baljan_extras import display_name
-from cafesys.baljan.models import Order, OrderGood
 from cafesys.baljan.workdist.workdist_adapter import WorkdistAdapter
 from . import credits as creditsmodule
 from . import (
+    blipp,
+    export,
     forms,
     ical,
+    instrumentation,
     models,
     planning,
     pseudogroups,
     search,
+    series,
     stats,
     trades,
     bookkeep,
+    wrapped,
 )
 from .forms import OrderForm
 from .util import (
@@ -90,21 +95,18 @@ from .util import (
     year_and_week,
 )
 import pytz
-import seaborn as sns
-from pandas import DataFrame
-import matplotlib.pyplot as plt
 
 from cafesys.baljan.gdpr import get_policies
 
-import stripe
-from stripe import SignatureVerificationError
-
 logger = getLogger(__name__)
 
 rfidSigner = TimestampSigner(
     salt="rfid"
 )  # TODO: separate key? Maybe not neccecary, but why not.
 
+# As in `django.middleware.gzip`.
+ACCEPTS_GZIP = re.compile(r"\bgzip\b")
+
 
 # This is to allow logins from other hosts
 class CustomAdminLoginView(LoginView):
@@ -386,6 +388,44 @@ def delete_signup(request, pk, redir):
     return redirect_prepend_root(redir)
 
 
+@permission_required("baljan.manage_job_openings")
+def shift_matching(request, semester_name):
+    # Not imported with the views, as it brings NumPy with it.
+    from cafesys.baljan.workdist import matching
+
+    tpl = {}
+    tpl["semester"] = sem = get_object_or_404(
+        models.Semester, name__exact=semester_name
+    )
+
+    result = matching.match(sem)
+    if request.method == "POST":
+        if request.POST.get("digest") == matching.digest(result):
+            signups = matching.save(sem, result.matches)
+            messages.add_message(
+                request,
+                messages.SUCCESS,
+                "%d jobbare skrevs upp på %d pass."
+                % (len(result.matches), len(signups)),
+            )
+            return redirect("shift_matching", semester_name=sem.name)
+
+        messages.add_message(
+            request,
+            messages.WARNING,
+            "Förslaget har ändrats sedan det visades. Granska det nya förslaget.",
+        )
+
+    users = User.objects.in_bulk(
+        [m.user_id for m in result.matches] + list(result.unmatched)
+    )
+    tpl["matches"] = [(m, users[m.user_id]) for m in result.matches]
+    tpl["unmatched"] = [users[user_id] for user_id in result.unmatched]
+    tpl["cost"] = result.cost
+    tpl["digest"] = matching.digest(result)
+    return render(request, "baljan/shift_matching.html", tpl)
+
+
 @permission_required("baljan.delete_oncallduty")
 def delete_callduty(request, pk, redir):
     models.OnCallDuty.objects.get(pk=int(pk)).delete()
@@ -1062,26 +1102,17 @@ def high_score(request, location=None):
 
     tpl = {}
 
-    if settings.STATS_CACHE_KEY:
-        all_stats, fetched_stats = cache.get(stats.get_cache_key(location)) or []
-    else:
-        all_stats, fetched_stats = stats.compute_stats_for_location(
-            location,
-        )
+    snapshot = stats.get_snapshot(location)
+    fetched_stats = snapshot["intervals"]
 
     if request.user.is_authenticated:
+        user_ranks = stats.get_ranks_for_user(snapshot, request.user)
         for inter in fetched_stats:
-            if all(
-                [request.user not in group["top_users"] for group in inter["groups"]]
-            ):
-                rank, score, is_staff = all_stats.get_rank_for_user(
-                    inter["key"], request.user, location
+            if inter["key"] in user_ranks:
+                rank, score, is_staff = user_ranks[inter["key"]]
+                inter["groups"][int(is_staff)]["top_users"].append(
+                    stats.snapshot_user(request.user, rank, score)
                 )
-                clone = copy.copy(request.user)
-
-                clone.num_orders = score
-                clone.rank = rank
-                inter["groups"][int(is_staff)]["top_users"].append(clone)
 
     tpl["stats"] = fetched_stats
     tpl["all_empty"] = all([x["empty"] for x in fetched_stats])
@@ -1182,6 +1213,7 @@ def consent(request):
 
 
 def with_cors_headers(f):
+    @functools.wraps(f)
     def add_cors_headers(*args, **kwargs):
         resp = f(*args, **kwargs)
         resp["Access-Control-Allow-Origin"] = "*"
@@ -1194,7 +1226,6 @@ def with_cors_headers(f):
 
 @csrf_exempt
 @with_cors_headers
-@transaction.atomic
 def do_blipp(request):
     if request.method == "OPTIONS":
         return HttpResponse(status=200)
@@ -1211,12 +1242,8 @@ def do_blipp(request):
         rfid_int = config.get_standardised_reader_output(rfid)
     except ValueError:
         return _json_error(400, "Felaktigt användar-id")
-    user = None
 
-    try:
-        user = User.objects.select_related("profile").get(profile__card_id=rfid_int)
-    except User.DoesNotExist:
-        pass
+    user = blipp.get_user(rfid_int)
 
     if user is None:
         # FIXME: We should try to find the card id in an external database here, but this requires
@@ -1229,84 +1256,52 @@ def do_blipp(request):
             signed_rfid=signed_rfid,
         )
 
-    # We will always have a user at this point
-    price = config.good.current_cost().cost
-    is_coffee_free, has_cooldown = user.profile.has_free_blipp()
+    try:
+        result = blipp.perform_blipp(config, user)
+    except blipp.BlippError as e:
+        return _json_error(e.status_code, e.message, **e.extra)
 
-    if has_cooldown:
-        try:
-            latest_order = models.Order.objects.filter(accepted=True, user=user).latest(
-                "put_at"
-            )
-            order_cooldown_date = latest_order.put_at + timedelta(
-                seconds=settings.WORKER_COOLDOWN_SECONDS
-            )
-            current_time = datetime.now()
+    user_balance, message = blipp.describe(result)
 
-            # https://stackoverflow.com/questions/60003764/typeerror-cant-compare-offset-naive-and-offset-aware-datetimes
-            can_order_again = current_time.timestamp() > order_cooldown_date.timestamp()
+    return JsonResponse(
+        {
+            "message": message,
+            "balance": user_balance,
+            "paid": 0 if result.is_free else config.current_cost,
+            "theme_override": config.theme_override,
+        }
+    )
 
-            if can_order_again is False:
-                possible_responses = [
-                    "Jisses, tänk på hjärtat!",
-                    "Oj, den slank ner snabbt!",
-                    "Varannan vatten hörru!",
-                    "Nån ska högt i topplistan!",
-                ]
 
-                return _json_error(
-                    402,
-                    possible_responses[current_time.second % len(possible_responses)],
-                    help_text="Vänta en stund innan du blippar igen",
-                )
-        except models.Order.DoesNotExist:  # FIXME: Not the best solution
-            pass
+@csrf_exempt
+@with_cors_headers
+def do_blipp_batch(request):
+    """Takes blipps that a reader has buffered, as a JSON object with a list
+    of `taps`. See `blipp.perform_blipp_batch`."""
+    if request.method == "OPTIONS":
+        return HttpResponse(status=200)
 
-    tz = pytz.timezone(settings.TIME_ZONE)
+    if request.method != "POST":
+        return _json_error(405, "Endast POST")
 
-    if is_coffee_free:
-        price = 0
-    else:
-        balance = user.profile.balance
+    config = _get_blipp_configuration(request)
+    if config is None:
+        return _json_error(403, "Felaktigt token")
 
-        if balance <= 0:
-            return _json_error(402, "Du har för lite pengar för att blippa")
+    try:
+        taps = json.loads(request.body)["taps"]
+    except (ValueError, TypeError, KeyError):
+        return _json_error(400, "Felaktig förfrågan")
 
-        new_balance = max(balance - price, 0)
-        user.profile.balance = new_balance
-        user.profile.save()
+    if not isinstance(taps, list):
+        return _json_error(400, "Felaktig förfrågan")
 
-    order = Order()
-    order.location = config.location
-    order.made = datetime.now(tz)
-    order.put_at = datetime.now(tz)
-    order.user = user
-    order.paid = price if is_coffee_free else balance - new_balance
-    order.currency = "SEK"
-    order.accepted = True
-    order.save()
-
-    order_good = OrderGood()
-    order_good.order = order
-    order_good.good = config.good
-    order_good.count = 1
-    order_good.save()
-
-    if is_coffee_free:
-        user_balance = "unlimited"
-        message = "Du har <b>∞ kr</b> kvar att blippa för"
-    else:
-        user_balance = user.profile.balance
-        message = "Du har <b>%s kr</b> kvar att blippa för" % user_balance
+    if len(taps) > settings.BLIPP_BATCH_MAX_TAPS:
+        return _json_error(
+            400, "Högst %d blipp åt gången" % settings.BLIPP_BATCH_MAX_TAPS
+        )
 
-    return JsonResponse(
-        {
-            "message": message,
-            "balance": user_balance,
-            "paid": price,
-            "theme_override": config.theme_override,
-        }
-    )
+    return JsonResponse({"results": blipp.perform_blipp_batch(config, taps)})
 
 
 def integrity(request):
@@ -1322,14 +1317,7 @@ def _get_blipp_configuration(request):
         authorization = request.headers["authorization"].split()
         if len(authorization) == 2:
             if authorization[0].lower() == "token":
-                token = authorization[1]
-
-                try:
-                    return BlippConfiguration.objects.select_related("good").get(
-                        token=token
-                    )
-                except BlippConfiguration.DoesNotExist:
-                    return None
+                return blipp.get_configuration(authorization[1])
 
     return None
 
@@ -1343,7 +1331,11 @@ def semester_shifts(request, sem_name):
     # Get all shifts for the semester
     sem = get_object_or_404(models.Semester, name__exact=sem_name)
 
-    pairs = sem.shiftcombination_set.order_by("label")
+    pairs = (
+        sem.shiftcombination_set.annotate(shift_count=Count("shifts"))
+        .prefetch_related("shifts__shiftsignup_set")
+        .order_by("label")
+    )
 
     if not pairs:
         raise Http404(
@@ -1358,6 +1350,12 @@ def semester_shifts(request, sem_name):
         workable_shifts_form = forms.WorkableShiftsForm(request.POST, pairs=pairs)
 
         if workable_shifts_form.is_valid():
+            existing = {
+                ws.combination: ws
+                for ws in models.WorkableShift.objects.filter(user=user, semester=sem)
+            }
+            to_save = []
+            to_delete = []
             for pair in pairs:
                 combination_id = pair.label
 
@@ -1368,24 +1366,34 @@ def semester_shifts(request, sem_name):
                     "priority-" + combination_id
                 ]
 
-                try:
-                    db_combination = models.WorkableShift.objects.get(
-                        user=user, semester=sem, combination=combination_id
-                    )
-
-                    if not is_workable:
-                        db_combination.delete()
-                    elif priority != db_combination.priority:
-                        db_combination.priority = priority
-                        db_combination.save()
-                except models.WorkableShift.DoesNotExist:
+                db_combination = existing.get(combination_id)
+                if db_combination is None:
                     if is_workable:
-                        models.WorkableShift(
-                            user=user,
-                            semester=sem,
-                            combination=combination_id,
-                            priority=priority,
-                        ).save()
+                        to_save.append(
+                            models.WorkableShift(
+                                user=user,
+                                semester=sem,
+                                combination=combination_id,
+                                priority=priority,
+                            )
+                        )
+                elif not is_workable:
+                    to_delete.append(db_combination.pk)
+                elif priority != db_combination.priority:
+                    db_combination.priority = priority
+                    to_save.append(db_combination)
+
+            with transaction.atomic():
+                if to_delete:
+                    models.WorkableShift.objects.filter(pk__in=to_delete).delete()
+                if to_save:
+                    # Another autosave may have created a row since it was read.
+                    models.WorkableShift.objects.bulk_create(
+                        to_save,
+                        update_conflicts=True,
+                        unique_fields=["user", "semester", "combination"],
+                        update_fields=["priority"],
+                    )
 
         if is_ajax(request):
             return HttpResponse(json.dumps({"OK": True}))
@@ -1414,7 +1422,7 @@ def semester_shifts(request, sem_name):
     )
 
     # Calculate the maximum number of shifts for any given shift combination.
-    max_shifts = max(map(lambda x: x.shifts.count(), pairs))
+    max_shifts = max(pair.shift_count for pair in pairs)
     shift_numbers = list(range(1, max_shifts + 1))
 
     tz = pytz.timezone(settings.TIME_ZONE)
@@ -1432,180 +1440,84 @@ def semester_shifts(request, sem_name):
     return render(request, "baljan/semester_shifts.html", tpl)
 
 
-class OrderFilter(django_filters.FilterSet):
-    put_at__gt = django_filters.DateFilter(field_name="put_at", lookup_expr="gt")
-    put_at__lt = django_filters.DateFilter(field_name="put_at", lookup_expr="lt")
-    paid = django_filters.NumberFilter()
-    paid__gt = django_filters.NumberFilter(field_name="paid", lookup_expr="gt")
-    paid__lt = django_filters.NumberFilter(field_name="paid", lookup_expr="lt")
-
-    class Meta:
-        model = models.Order
-        fields = []
+@require_GET
+@staff_member_required
+def stats_requests(request):
+    return JsonResponse(instrumentation.get_request_stats())
 
 
-@require_GET
-@permission_required("baljan.view_order")
-def stats_order_heatmap(request):
-    f = OrderFilter(request.GET, queryset=models.Order.objects.all())
-
-    orders = (
-        f.qs.filter(accepted=True)
-        .annotate(
-            weekday=ExtractIsoWeekDay("put_at"),
-            hour=ExtractHour("put_at"),
-            minute=ExtractMinute("put_at"),
-        )
-        .annotate(
-            quarter=Case(
-                When(minute__gte=0, minute__lt=15, then=Value(0)),
-                When(minute__gte=15, minute__lt=30, then=Value(15)),
-                When(minute__gte=30, minute__lt=45, then=Value(30)),
-                When(minute__gte=45, then=Value(45)),
-                output_field=IntegerField(),
-            )
-        )
-        .filter(weekday__lt=6, hour__gte=8, hour__lte=16)
-        .values("weekday", "hour", "quarter")
-        .annotate(count=Count("id"))
-        .order_by("weekday", "hour", "quarter")
+class BookkeepForm(django_forms.Form):
+    year = django_forms.IntegerField(
+        label="År",
+        required=True,
     )
 
-    data = DataFrame()
-    weekdays = ["Måndag", "Tisdag", "Onsdag", "Torsdag", "Fredag"]
-    for timepoint in orders:
-        data.at[
-            weekdays[timepoint["weekday"] - 1],
-            time(timepoint["hour"], timepoint["quarter"]),
-        ] = int(timepoint["count"])
-
-    sns.set_theme()
-    plt.figure(figsize=(16, 9))
-    plot = sns.heatmap(data, cbar=False, cmap="YlGnBu")
-    plot.figure.autofmt_xdate()
-
-    buffer = BytesIO()
-    plot.get_figure().savefig(buffer, format="png")
-    buffer.seek(0)
-    # return FileResponse(buffer, filename='heatmap.png')
-    tpl = {
-        "image_data": f"data:image/png;base64,{base64.b64encode(buffer.read()).decode()}",
-        "filter": f,
-    }
-    return render(request, "baljan/stat_plot.html", tpl)
 
+class OrderExportForm(django_forms.Form):
+    start = django_forms.DateField(label="Från och med", required=True)
+    end = django_forms.DateField(label="Till och med", required=True)
+    location = django_forms.TypedMultipleChoiceField(
+        label="Plats",
+        choices=models.Located.LOCATION_CHOICES,
+        coerce=int,
+        required=False,
+        help_text="Alla om ingen är vald",
+    )
 
-@require_GET
-@permission_required("baljan.view_order")
-def stats_blipp(request):
-    try:
-        from_year = int(request.GET.get("from_year", 2022))  # TODO: improve filtering
-    except ValueError:
-        raise Http404("Året finns inte")
+    def clean(self):
+        cleaned_data = super().clean()
+        start, end = cleaned_data.get("start"), cleaned_data.get("end")
+        if start and end and end < start:
+            raise django_forms.ValidationError("Slutdatumet är före startdatumet")
+        return cleaned_data
 
-    balance_codes = (
-        models.BalanceCode.objects.filter(
-            used_at__isnull=False, used_at__year__gte=from_year
-        )
-        .values("used_at")
-        .annotate(count=Sum("value"))
-        .order_by("used_at")
-    )
-    orders = (
-        models.Order.objects.filter(
-            accepted=True, paid__gt=0, put_at__year__gte=from_year
-        )
-        .extra({"day": "date(put_at)"})
-        .values("day")
-        .annotate(count=Sum("paid"))
-        .order_by("day")
-    )
 
-    bc_cumsum = 0
-    bc_cumsums = []
-    bc_dates = []
-    for data in balance_codes:
-        bc_dates.append(data["used_at"])
-        bc_cumsum = bc_cumsum + data["count"]
-        bc_cumsums.append(bc_cumsum)
-
-    order_cumsum = 0
-    order_cumsums = []
-    order_dates = []
-    for data in orders:
-        order_dates.append(data["day"])
-        order_cumsum = order_cumsum + data["count"]
-        order_cumsums.append(order_cumsum)
-
-    bc_data = DataFrame(index=bc_dates, data={"count": bc_cumsums})
-    order_data = DataFrame(index=order_dates, data={"count": order_cumsums})
-
-    sns.set_theme()
-    plt.figure(figsize=(16, 9))
-    plot = sns.relplot(
-        data={
-            "Kaffekort använda": bc_data.loc[:, "count"],
-            "Blippat för": order_data.loc[:, "count"],
-        },
-        kind="line",
+class SeriesForm(django_forms.Form):
+    granularity = django_forms.ChoiceField(
+        choices=[(granularity, granularity) for granularity in series.GRANULARITIES],
+        required=False,
+    )
+    start = django_forms.DateField(required=False)
+    end = django_forms.DateField(required=False)
+    location = django_forms.TypedMultipleChoiceField(
+        choices=models.Located.LOCATION_CHOICES,
+        coerce=int,
+        required=False,
     )
-    plot.figure.autofmt_xdate()
-    plot.set_axis_labels("", "SEK")
-    buffer = BytesIO()
-    plot.savefig(buffer, format="png")
-    buffer.seek(0)
-    # return FileResponse(buffer, filename='blippstats.png')
-    tpl = {
-        "image_data": f"data:image/png;base64,{base64.b64encode(buffer.read()).decode()}"
-    }
-    return render(request, "baljan/stat_plot.html", tpl)
 
 
 @require_GET
 @permission_required("baljan.view_order")
-def stats_active_blipp_users(request):
-    f = OrderFilter(request.GET, queryset=models.Order.objects.all())
-
-    orders = (
-        f.qs.filter(accepted=True)
-        .annotate(week=F("put_at__week"), year=F("put_at__year"))
-        .order_by("year", "week")
-        .values("week", "year")
-        .annotate(num_users=Count("user_id", distinct=True))
-        .annotate(num_purchases=Count("id"))
+def stats_series(request):
+    form = SeriesForm(request.GET)
+    if not form.is_valid():
+        return _json_error(400, "Ogiltigt filter", errors=form.errors)
+
+    granularity = form.cleaned_data["granularity"] or "day"
+    start, end = form.cleaned_data["start"], form.cleaned_data["end"]
+    return series.response(
+        {
+            "orders": series.orders(
+                granularity, start, end, form.cleaned_data["location"]
+            ),
+            "refills": series.refills(granularity, start, end),
+        },
+        granularity=granularity,
     )
 
-    orders_data = []
-    for data in orders:
-        orders_data.append(
-            {
-                "when": f"{data['week']}-{data['year']} ({round(data['num_purchases'] / data['num_users'], 1)})",
-                "num_users": data["num_users"],
-                "num_purchases": data["num_purchases"],
-                "avg_purchases": data["num_purchases"] / data["num_users"],
-            }
-        )
-    order_data = DataFrame(data=orders_data)
-
-    sns.set_theme()
-    plt.figure(figsize=(16, 9))
-    plot = sns.catplot(data=order_data, y="when", x="num_users", kind="bar")
-    plot.set_axis_labels("Antal användare", "När (Antal köp per användare)")
-    buffer = BytesIO()
-    plot.savefig(buffer, format="png")
-    buffer.seek(0)
-    # return FileResponse(buffer, filename='blippstats.png')
-    tpl = {
-        "image_data": f"data:image/png;base64,{base64.b64encode(buffer.read()).decode()}",
-        "filter": f,
-    }
-    return render(request, "baljan/stat_plot.html", tpl)
-
 
-class BookkeepForm(django_forms.Form):
-    year = django_forms.IntegerField(
-        label="År",
-        required=True,
+@require_GET
+@permission_required("baljan.view_order")
+def export_orders(request):
+    form = OrderExportForm(request.GET or None)
+    if not form.is_valid():
+        return render(request, "baljan/export_orders.html", {"form": form})
+
+    start, end = form.cleaned_data["start"], form.cleaned_data["end"]
+    return export.response(
+        export.orders(start, end, form.cleaned_data["location"] or None),
+        "blipp-%s-%s.csv" % (start, end),
+        header=export.headers(export.ORDER_COLUMNS),
     )
 
 
@@ -1618,9 +1530,15 @@ def bookkeep_view(request):
     past_year = False
     if form.is_valid():
         year = form.cleaned_data["year"]
-        present = datetime.now()
-        past_year = datetime(year + 1, 1, 1) < present
-        data = bookkeep.get_bookkeep_data(year)
+        past_year = bookkeep.is_past(year)
+        lines = bookkeep.report(year)
+        if request.GET.get("format") == "csv":
+            return export.response(
+                bookkeep.as_rows(lines),
+                "bokforing-%d.csv" % year,
+                header=["Nummer", "Post", "SEK"],
+            )
+        data = bookkeep.as_text(year, lines)
 
     return render(
         request,
@@ -1634,147 +1552,29 @@ def wrapped_data(request: HttpRequest):
     if request.user is None or request.user.is_anonymous:
         return HttpResponse(status=401)
 
-    wrapped = models.Wrapped.objects.filter(user=request.user).first()
+    payload = wrapped.get_payload(request.user)
 
-    if wrapped is None:
+    if payload is None:
         raise BadRequest(_("Found no Wrapped data for user"))
 
-    return JsonResponse(wrapped.data)
-
-
-class Stripe:
-    @login_required
-    def create_checkout(request: HttpRequest):
-        if request.method != "POST":
-            return redirect(reverse("credits"))
-
-        product_id = request.POST.get("product_id", None)
-        if product_id is None:
-            raise BadRequest(_("Product ID was not provided"))
+    content, content_hash = payload
+    # Weak, as the same JSON is served gzipped or not.
+    etag = 'W/"%s"' % content_hash
 
-        product = models.Product.objects.filter(product_id__exact=product_id).first()
-        if product is None:
-            raise BadRequest(_("Product does not exist"))
-
-        args = {}
-
-        if request.user.email:
-            args["customer_email"] = request.user.email
-
-        checkout_session = stripe.checkout.Session.create(
-            line_items=[
-                {
-                    "price": product.price_id,
-                    "quantity": 1,
-                },
-            ],
-            mode="payment",
-            success_url=request.build_absolute_uri(
-                reverse("checkout-success"),
-            )
-            + "?session_id={CHECKOUT_SESSION_ID}",
-            cancel_url=request.build_absolute_uri(
-                reverse("checkout-cancel"),
-            ),
-            client_reference_id=request.user.id,
-            metadata={"product_id": product.id},
-            consent_collection={"terms_of_service": "required"},
-            custom_text={
-                "terms_of_service_acceptance": {
-                    "message": "Jag godkänner [regler och villkor för internetköp](https://www.baljan.org/static/internetkopspolicy.pdf)",
-                },
-            },
-            **args,
-        )
-
-        return redirect(to=checkout_session.url, permanent=False)
-
-    @login_required
-    def success_checkout(request: HttpRequest):
-        if request.method != "GET":
-            return HttpResponse(status=405)
-        if "session_id" not in request.GET:
-            return HttpResponse(status=400)
-
-        session_id = request.GET["session_id"]
-
-        credits_redirect = redirect(reverse("credits"))
-
-        if checkout := stripe.checkout.Session.retrieve(session_id):
-            messages.add_message(
-                request,
-                messages.SUCCESS,
-                _(
-                    "Thank you for your purchase! You've refilled your card with %(amount)d %(currency)s"
-                )
-                % {
-                    "amount": checkout.amount_total / 100,
-                    "currency": checkout.currency.upper(),
-                },
-            )
-
-        return credits_redirect
-
-    @login_required
-    def cancel_checkout(request: HttpRequest):
-        messages.add_message(
-            request,
-            messages.ERROR,
-            _("Your purchase was cancelled."),
-            extra_tags="danger",
-        )
-
-        # TODO: maybe we need to cancel the paymentintent here, but maybe not.
-        # They get cancelled within 24 hours
-        # https://stackoverflow.com/questions/70264115/stripe-cancel-url-does-not-cancel-the-payment-so-stripe-does-not-send-a-cancels
-
-        return redirect(reverse("credits"))
-
-    @csrf_exempt
-    def events(request: HttpRequest):
-        payload = request.body
-        sig_header = request.META["HTTP_STRIPE_SIGNATURE"]
-        event = None
-
-        try:
-            event = stripe.Webhook.construct_event(
-                payload, sig_header, settings.STRIPE_ENDPOINT_SECRET
-            )
-        except ValueError:
-            return HttpResponse(status=400)
-        except SignatureVerificationError:
-            return HttpResponse(status=400)
-
-        if event.type == "checkout.session.completed":
-            checkout_session = event.data.object
-
-            purchase = models.Purchase.objects.create(
-                product_id=checkout_session["metadata"]["product_id"],
-                user_id=checkout_session["client_reference_id"],
-                session_id=checkout_session["id"],
-                value=checkout_session["amount_total"] / 100,
-                currency=checkout_session["currency"].upper(),
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if ACCEPTS_GZIP.search(request.headers.get("Accept-Encoding", "")):
+            response = HttpResponse(content, content_type="application/json")
+            response["Content-Encoding"] = "gzip"
+        else:
+            response = HttpResponse(
+                gzip.decompress(content), content_type="application/json"
             )
 
-            creditsmodule.digital_refill(purchase)
-        elif event.type == "product.updated":
-            prev = event.data.previous_attributes
-            obj = event.data.object
-
-            if product := models.Product.objects.filter(product_id=obj["id"]).first():
-                updated_fields = {
-                    field.name
-                    for field in models.Product._meta.get_fields()
-                    if field.concrete
-                }
-                matching = prev.keys() & updated_fields
-
-                for key in matching:
-                    setattr(product, key, obj[key])
-
-                product.save()
-
-        return HttpResponse(status=200)
+    response["ETag"] = etag
+    patch_vary_headers(response, ["Accept-Encoding"])
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 class Google:
@@ -6,8 +6,11 @@ class AvailableShift:
         self.exam_period = exam_period
         self.database_id = database_id
 
+    def kind(self):
+        return (self.location, self.span)
+
     def is_same_kind(self, o):
-        return self.location == o.location and self.span == o.span
+        return self.kind() == o.kind()
 
     def __eq__(self, o):
         return (
@@ -0,0 +1,213 @@
+"""
+Matches workers to shift combinations by the preferences they have given.
+
+Workers list the combinations they can work, in order of preference, as
+`WorkableShift`s. `match` gives every worker at most one combination, and
+every combination at most `WORKERS_PER_COMBINATION` workers, so that as many
+workers as possible get a combination and, of those matchings, the sum of
+the priorities of the combinations they get is the least. This is an
+assignment problem, of workers to places in combinations, solved with the
+Hungarian algorithm: by SciPy if it is installed, or else by
+`linear_sum_assignment` below, which does the same with NumPy.
+
+Combinations that already have workers signed up have fewer places, and
+workers that are already signed up for a shift in the semester are left out.
+"""
+
+from collections import namedtuple
+from hashlib import sha256
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+
+from cafesys.baljan.models import (
+    Shift,
+    ShiftCombination,
+    ShiftSignup,
+    WorkableShift,
+    signup_notice_save,
+    update_staff_classes,
+)
+
+try:
+    from scipy.optimize import linear_sum_assignment as scipy_linear_sum_assignment
+except ImportError:
+    scipy_linear_sum_assignment = None
+
+# Combinations are worked in pairs.
+WORKERS_PER_COMBINATION = 2
+
+Match = namedtuple("Match", ["user_id", "combination", "priority"])
+
+Result = namedtuple("Result", ["matches", "cost", "unmatched"])
+
+
+def linear_sum_assignment(costs):
+    """Returns the rows and columns of an assignment of every row (or of
+    every column, if there are fewer) with the least sum of `costs`, like
+    `scipy.optimize.linear_sum_assignment`."""
+    costs = np.asarray(costs, dtype=float)
+    if costs.shape[0] > costs.shape[1]:
+        columns, rows = linear_sum_assignment(costs.T)
+        order = np.argsort(rows)
+        return rows[order], columns[order]
+
+    n, m = costs.shape
+    # The potentials of rows and columns, and the row of every column, with
+    # column 0 a virtual one that the row being assigned starts from.
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    row_of = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+
+    for i in range(1, n + 1):
+        row_of[0] = i
+        column = 0
+        least = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+
+        # Grow a tree of tight edges from row i until it reaches a free column.
+        while True:
+            used[column] = True
+            row = row_of[column]
+            reduced = costs[row - 1] - u[row] - v[1:]
+            better = ~used[1:] & (reduced < least[1:])
+            least[1:][better] = reduced[better]
+            way[1:][better] = column
+
+            candidates = np.where(used[1:], np.inf, least[1:])
+            next_column = int(np.argmin(candidates)) + 1
+            delta = candidates[next_column - 1]
+
+            u[row_of[used]] += delta
+            v[used] -= delta
+            least[~used] -= delta
+
+            column = next_column
+            if row_of[column] == 0:
+                break
+
+        # Flip the path the tree was grown along.
+        while column:
+            previous = way[column]
+            row_of[column] = row_of[previous]
+            column = previous
+
+    columns = np.flatnonzero(row_of[1:]) + 1
+    rows = row_of[columns] - 1
+    order = np.argsort(rows)
+    return rows[order], columns[order] - 1
+
+
+def solve(costs):
+    if scipy_linear_sum_assignment is not None:
+        return scipy_linear_sum_assignment(costs)
+    return linear_sum_assignment(costs)
+
+
+def match(semester):
+    """Returns a `Result` with the best `Match`es of workers to the
+    combinations of `semester`, their total priority and the ids of the
+    workers that could not be given any of the combinations they listed."""
+    combinations = dict(
+        semester.shiftcombination_set.values_list("label", "id").order_by("label")
+    )
+    signed_up = set(
+        ShiftSignup.objects.filter(shift__semester=semester).values_list(
+            "user", flat=True
+        )
+    )
+
+    # Places are taken by workers signed up for any shift of a combination.
+    taken = {}
+    for combination_id, user_id in (
+        ShiftCombination.shifts.through.objects.filter(
+            shiftcombination__semester=semester,
+            shift__shiftsignup__isnull=False,
+        )
+        .values_list("shiftcombination", "shift__shiftsignup__user")
+        .distinct()
+    ):
+        taken[combination_id] = taken.get(combination_id, 0) + 1
+
+    places = [
+        label
+        for label, combination_id in combinations.items()
+        for _ in range(max(WORKERS_PER_COMBINATION - taken.get(combination_id, 0), 0))
+    ]
+
+    preferences = {}
+    for user_id, label, priority in WorkableShift.objects.filter(
+        semester=semester
+    ).values_list("user", "combination", "priority"):
+        if label in combinations and user_id not in signed_up:
+            preferences.setdefault(user_id, {})[label] = priority
+
+    workers = sorted(preferences)
+    if not workers or not places:
+        return Result([], 0, workers)
+
+    # A place that a worker has not listed costs more than all priorities
+    # together, so that as many workers as possible get a combination first.
+    priorities = [p for worker in preferences.values() for p in worker.values()]
+    unlisted = sum(max(priority, 0) + 1 for priority in priorities) + 1
+    costs = np.full((len(workers), len(places)), float(unlisted))
+    place_columns = {}
+    for column, label in enumerate(places):
+        place_columns.setdefault(label, []).append(column)
+    for row, user_id in enumerate(workers):
+        for label, priority in preferences[user_id].items():
+            costs[row, place_columns[label]] = priority
+
+    matches = []
+    matched = set()
+    for row, column in zip(*solve(costs)):
+        if costs[row, column] < unlisted:
+            user_id = workers[row]
+            label = places[column]
+            matches.append(Match(user_id, label, preferences[user_id][label]))
+            matched.add(user_id)
+
+    matches.sort(key=lambda m: (m.combination, m.user_id))
+    return Result(
+        matches,
+        sum(m.priority for m in matches),
+        [user_id for user_id in workers if user_id not in matched],
+    )
+
+
+def digest(result):
+    """A short hash of the matches of `result`, to see whether a preview is
+    still what would be saved."""
+    content = ";".join("%d:%s" % (m.user_id, m.combination) for m in result.matches)
+    return sha256(content.encode()).hexdigest()[:16]
+
+
+@transaction.atomic
+def save(semester, matches):
+    """Signs the workers of `matches` up for every shift of the combination
+    they were matched to. Returns the sign-ups."""
+    shifts = {}
+    for shift in Shift.objects.filter(
+        shiftcombination__semester=semester,
+        shiftcombination__label__in={match.combination for match in matches},
+    ).annotate(combination_label=F("shiftcombination__label")):
+        shifts.setdefault(shift.combination_label, []).append(shift)
+    users = User.objects.in_bulk({match.user_id for match in matches})
+
+    signups = ShiftSignup.objects.bulk_create(
+        [
+            ShiftSignup(user=users[match.user_id], shift=shift)
+            for match in matches
+            for shift in shifts.get(match.combination, [])
+        ]
+    )
+
+    # What the signals of single sign-ups do.
+    update_staff_classes({match.user_id for match in matches})
+    for signup in signups:
+        signup_notice_save(signup)
+
+    return signups
@@ -1,3 +1,5 @@
+import heapq
+import itertools
 import math
 
 from cafesys.baljan.workdist.temporary_shift_combination import (
@@ -6,79 +8,127 @@ from cafesys.baljan.workdist.temporary_shift_combination import (
 
 
 class ShiftAssigner:
+    """Assigns every shift to the combination that has the fewest shifts (and
+    exam period shifts, for exam period shifts), preferring combinations
+    without a shift of the same kind, then the one that was assigned a shift
+    the longest ago.
+
+    The combinations are kept in heaps by when they were last assigned a
+    shift, one for every number of shifts, number of exam period shifts and
+    kind of shift they lack, so that the best combination is the top of a
+    heap instead of a search through all of them. Entries are not removed
+    from the heaps when a combination is assigned a shift, they are skipped
+    when they reach the top instead.
+    """
+
     def __init__(self, shifts_per_combination=4):
         self.all_shifts = []
         self.shift_combinations = []
         self.shifts_per_combination = shifts_per_combination
 
-    def assign_to_best_combination(self, shift):
-        # Always assign to combinations with the fewest number of shifts already assigned
-        used_combinations = self.select_from_smallest_number_of(
-            self.shift_combinations, lambda x: len(x.shifts)
-        )
-
-        if shift.exam_period:
-            # Don't assign more than one exam period shift before every combination has at least one
-            used_combinations = (
-                self.select_combinations_with_smallest_number_of_exam_period_shifts(
-                    used_combinations
-                )
-            )
+    def assign(self):
+        num_combinations = math.ceil(len(self.all_shifts) / self.shifts_per_combination)
 
-        self.assign_to_best_combination_in_list(shift, used_combinations)
+        for i in range(num_combinations):
+            self.shift_combinations.append(TemporaryShiftCombination(i))
 
-    def assign_to_best_combination_in_list(self, shift, combinations):
-        # 1. Try to assign with exact match
-        for comb in combinations:
-            if not comb.contains_shift_of_kind(shift):
-                self.assign_shift_to_combination(shift, comb)
-                return
+        self.kinds = {shift.kind() for shift in self.all_shifts}
+        # Combinations that were assigned a shift longer ago are first.
+        self.clock = itertools.count()
+        self.recency = {}
+        # By (number of shifts, kind lacked), and by (number of shifts,
+        # number of exam period shifts, kind lacked).
+        self.lacking = {}
+        self.lacking_exam = {}
+        # The number of combinations by number of shifts, and by (number of
+        # shifts, number of exam period shifts).
+        self.counts = {}
+        self.exam_counts = {}
+        self.fewest = 0
+
+        for comb in self.shift_combinations:
+            self.index_combination(comb)
 
-        # 2. Try to assign with other day
-        for comb in combinations:
-            if not comb.contains_shift_at_same_day(shift):
-                self.assign_shift_to_combination(shift, comb)
-                print("Assigned sub-optimal shift (" + str(id(comb)) + ")")
-                return
+        for shift in self.all_shifts:
+            self.assign_to_best_combination(shift)
 
-        # 3. Indicate failure (should never happen)
-        raise Exception(
-            "Impossible to assign shifts without assigning two shifts at the same day"
-        )
+        self.shift_combinations.sort(key=self.recency.__getitem__)
 
-    def assign_shift_to_combination(self, shift, comb):
-        # Move combination to end of list to get an even distribution of dates
-        self.shift_combinations.remove(comb)
-        self.shift_combinations.append(comb)
+    def index_combination(self, comb):
+        stamp = next(self.clock)
+        self.recency[comb] = stamp
 
-        comb.shifts.append(shift)
+        shifts, exam = len(comb.shifts), comb.number_of_shifts_in_exam_period()
+        self.counts[shifts] = self.counts.get(shifts, 0) + 1
+        self.exam_counts[shifts, exam] = self.exam_counts.get((shifts, exam), 0) + 1
+        for kind in self.kinds - comb.kinds:
+            heapq.heappush(self.lacking.setdefault((shifts, kind), []), (stamp, comb))
+            heapq.heappush(
+                self.lacking_exam.setdefault((shifts, exam, kind), []), (stamp, comb)
+            )
 
-    def select_combinations_with_smallest_number_of_exam_period_shifts(
-        self, combinations
-    ):
-        return self.select_from_smallest_number_of(
-            combinations, lambda x: x.number_of_shifts_in_exam_period()
-        )
+    def unindex_combination(self, comb):
+        shifts, exam = len(comb.shifts), comb.number_of_shifts_in_exam_period()
+        self.counts[shifts] -= 1
+        self.exam_counts[shifts, exam] -= 1
+        # Its entries in the heaps are stale as soon as it has a new stamp.
+        del self.recency[comb]
 
-    def select_from_smallest_number_of(self, collection, f):
-        segments = {}
-        for item in collection:
-            num = f(item)
+    def first_in(self, heap):
+        while heap and self.recency.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][1] if heap else None
 
-            segment = segments.get(num)
-            if segment is None:
-                segment = []
-                segments[num] = segment
+    def assign_to_best_combination(self, shift):
+        # Always assign to combinations with the fewest number of shifts already assigned
+        while not self.counts.get(self.fewest):
+            self.fewest += 1
 
-            segment.append(item)
+        if shift.exam_period:
+            # Don't assign more than one exam period shift before every combination has at least one
+            exam = min(
+                exam
+                for (shifts, exam), count in self.exam_counts.items()
+                if shifts == self.fewest and count
+            )
+            heap = self.lacking_exam.get((self.fewest, exam, shift.kind()), [])
+        else:
+            exam = None
+            heap = self.lacking.get((self.fewest, shift.kind()), [])
 
-        return segments[min(segments.keys())]
+        # 1. Try to assign with exact match
+        comb = self.first_in(heap)
+        if comb is None:
+            # 2. Try to assign with other day
+            comb = self.first_without_date(shift, exam)
+            if comb is not None:
+                print("Assigned sub-optimal shift (" + str(id(comb)) + ")")
 
-    def assign(self):
-        num_combinations = math.ceil(len(self.all_shifts) / self.shifts_per_combination)
+        if comb is None:
+            # 3. Indicate failure (should never happen)
+            raise Exception(
+                "Impossible to assign shifts without assigning two shifts at the same day"
+            )
 
-        for i in range(num_combinations):
-            self.shift_combinations.append(TemporaryShiftCombination(i))
+        self.assign_shift_to_combination(shift, comb)
+
+    def first_without_date(self, shift, exam):
+        combinations = sorted(
+            (
+                comb
+                for comb in self.recency
+                if len(comb.shifts) == self.fewest
+                and (exam is None or comb.number_of_shifts_in_exam_period() == exam)
+            ),
+            key=self.recency.__getitem__,
+        )
+        for comb in combinations:
+            if not comb.contains_shift_at_same_day(shift):
+                return comb
+        return None
 
-        for shift in self.all_shifts:
-            self.assign_to_best_combination(shift)
+    def assign_shift_to_combination(self, shift, comb):
+        # Move combination to the end to get an even distribution of dates
+        self.unindex_combination(comb)
+        comb.add_shift(shift)
+        self.index_combination(comb)
@@ -13,24 +13,20 @@ def semester_post_save(sender, instance, created, **kwargs):
         # need to handle.
         return
 
-    # Create one shift for every weekday
+    # Create one shift for every weekday, span and location, in one query
+    # for the ones that already exist and one for the rest.
     sem = instance
     weekend = (5, 6)
-    created_count = 0
-    for day in sem.date_range():
-        if day.weekday() in weekend:
-            continue
-
-        for early_or_lunch_or_late in (0, 1, 2):
-            for location, name in Located.LOCATION_CHOICES:
-                obj, created = Shift.objects.get_or_create(
-                    semester=sem,
-                    span=early_or_lunch_or_late,
-                    when=day,
-                    location=location,
-                )
-                if created:
-                    created_count += 1
+    existing = set(sem.shift_set.values_list("when", "span", "location"))
+    shifts = [
+        Shift(semester=sem, when=day, span=early_or_lunch_or_late, location=location)
+        for day in sem.date_range()
+        if day.weekday() not in weekend
+        for early_or_lunch_or_late in (0, 1, 2)
+        for location, name in Located.LOCATION_CHOICES
+        if (day, early_or_lunch_or_late, location) not in existing
+    ]
+    created_count = len(Shift.objects.bulk_create(shifts, batch_size=1000))
     logger.info(
         "%s: %d shifts added, signups=%s"
         % (sem.name, created_count, sem.signup_possible)
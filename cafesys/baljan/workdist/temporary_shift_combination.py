@@ -2,23 +2,26 @@ class TemporaryShiftCombination:
     def __init__(self, index):
         self.index = index
         self.shifts = []
+        # Of the shifts, to not have to go through them.
+        self.kinds = set()
+        self.dates = set()
+        self.exam_period_shifts = 0
+
+    def add_shift(self, shift):
+        self.shifts.append(shift)
+        self.kinds.add(shift.kind())
+        self.dates.add(shift.date)
+        if shift.exam_period:
+            self.exam_period_shifts += 1
 
     def number_of_shifts_in_exam_period(self):
-        return len([x for x in self.shifts if x.exam_period])
+        return self.exam_period_shifts
 
     def contains_shift_of_kind(self, other_shift):
-        for shift in self.shifts:
-            if shift.is_same_kind(other_shift):
-                return True
-
-        return False
+        return other_shift.kind() in self.kinds
 
     def contains_shift_at_same_day(self, other_shift):
-        for shift in self.shifts:
-            if shift.date == other_shift.date:
-                return True
-
-        return False
+        return other_shift.date in self.dates
 
     def __str__(self):
         return (
@@ -1,6 +1,6 @@
 import math
 
-from cafesys.baljan.models import Shift, ShiftCombination
+from cafesys.baljan.models import ShiftCombination
 from django.db import transaction
 
 from cafesys.baljan.workdist.available_shift import AvailableShift
@@ -39,8 +39,21 @@ class WorkdistAdapter:
 
         self.semester.shiftcombination_set.all().delete()
 
-        for combination in combinations:
-            self.add_combination_to_db(combination)
+        # The shifts are added to the combinations after the combinations
+        # have been created, all at once, by their ids.
+        stored = ShiftCombination.objects.bulk_create(
+            [self.combination_to_model(combination) for combination in combinations]
+        )
+        ShiftCombination.shifts.through.objects.bulk_create(
+            [
+                ShiftCombination.shifts.through(
+                    shiftcombination_id=model.id, shift_id=shift.database_id
+                )
+                for combination, model in zip(combinations, stored)
+                for shift in combination.shifts
+            ],
+            batch_size=1000,
+        )
 
     def add_shift_from_db(self, model_shift):
         if model_shift.span == 1:
@@ -61,18 +74,8 @@ class WorkdistAdapter:
 
         self.assigner.all_shifts.append(shift)
 
-    def add_combination_to_db(self, tmp_comb):
-        shifts = []
-        for shift in tmp_comb.shifts:
-            shifts.append(Shift.objects.get(id=shift.database_id))
-
-        comb = ShiftCombination(
+    def combination_to_model(self, tmp_comb):
+        return ShiftCombination(
             semester=self.semester,
             label=str(tmp_comb.index + 1).zfill(self.comb_label_len),
         )
-
-        # We must save the ShiftCombination before we can assign the shifts
-        comb.save()
-
-        comb.shifts.set(shifts)
-        comb.save()
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Wrapped, a summary of the semester of everybody who had coffee during it.
+
+`compute` computes Wrapped for all users of a semester at once. Instead of a
+handful of queries for every user, everything is read by three queries over
+the whole semester, with window functions partitioned by day and group (or by
+user) doing the ranking in the database:
+
+* the orders of every user and day, with their placement in the top list of
+  the day (from `DailyOrderCount`),
+* the orders of every user by location,
+* the time between consecutive orders of every user.
+
+Each of them is streamed sorted by user, so that the metrics of a user are
+computed in one pass over the rows of that user, optionally in a pool of
+processes. The result is written with one upsert per batch of users.
+
+What is served to a user is written too, as gzipped JSON with a hash of its
+content, so that `get_payload` only has to read it, from the cache if it can.
+"""
+
+import gzip
+import hashlib
+import json
+import multiprocessing
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from datetime import time as day_start
+from logging import getLogger
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import (
+    Case,
+    Count,
+    F,
+    Sum,
+    Value,
+    When,
+    Window,
+)
+from django.db.models.functions import DenseRank, Lag, RowNumber
+from django.utils import timezone
+
+from .models import DailyOrderCount, Order, Profile, Wrapped
+
+logger = getLogger(__name__)
+
+# How many users a day is on the top list for.
+TOP_LIST_LENGTH = 15
+
+# How many users are written, or given to a process, at a time.
+BATCH_SIZE = 500
+
+# Milligrams of caffeine per order.
+CAFFEINE_MG = 2.2 * 110
+
+IS_STAFF = Case(
+    When(user__profile__staff_class=Profile.STAFF_CLASS_STAFF, then=Value(True)),
+    default=Value(False),
+)
+
+
+@contextmanager
+def timed(timings, phase):
+    """Puts the seconds the block takes in `timings` under `phase`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = time.perf_counter() - start
+
+
+def semester_weekdays(semester):
+    days = (semester.end - semester.start).days
+    return days - (days // 7) * 2
+
+
+def semester_range(semester):
+    """The first and the first after the last moment of `semester`."""
+    return (
+        timezone.make_aware(datetime.combine(semester.start, day_start())),
+        timezone.make_aware(
+            datetime.combine(semester.end + timedelta(days=1), day_start())
+        ),
+    )
+
+
+def _daily_counts(semester):
+    """The orders of every user and day, sorted by user and day, with
+    placement (from 0) and the number of other users with as many orders in
+    the same group that day, and whether the user is on the top list. Returns
+    a two-tuple (days by user id, whether users are staff by user id), with
+    every day a tuple (date, index of the date among the days with orders,
+    count, placement, others with the same count, is on the top list)."""
+    same_group = [F("date"), F("is_staff")]
+    rows = (
+        DailyOrderCount.objects.filter(date__range=(semester.start, semester.end))
+        .values("date", "user", is_staff=IS_STAFF)
+        .annotate(count=Sum("count"))
+        .annotate(
+            place=Window(
+                DenseRank(), partition_by=same_group, order_by=F("count").desc()
+            ),
+            position=Window(
+                RowNumber(),
+                partition_by=same_group,
+                order_by=[F("count").desc(), F("user").asc()],
+            ),
+            shared=Window(Count("user"), partition_by=same_group + [F("count")]),
+        )
+        .order_by("user", "date")
+    )
+
+    days = defaultdict(list)
+    is_staff = {}
+    for row in rows.iterator():
+        is_staff[row["user"]] = row["is_staff"]
+        days[row["user"]].append(
+            [
+                row["date"],
+                None,
+                row["count"],
+                row["place"] - 1,
+                row["shared"] - 1,
+                row["position"] <= TOP_LIST_LENGTH,
+            ]
+        )
+
+    # A streak is days in a row with any orders at all.
+    dates = sorted({day[0] for user_days in days.values() for day in user_days})
+    date_index = {day: i for i, day in enumerate(dates)}
+    for user_days in days.values():
+        for day in user_days:
+            day[1] = date_index[day[0]]
+
+    return days, is_staff
+
+
+def _favourite_locations(semester):
+    rows = (
+        DailyOrderCount.objects.filter(date__range=(semester.start, semester.end))
+        .values("user", "location")
+        .annotate(count=Sum("count"))
+        .order_by("user", "-count", "location")
+    )
+
+    favourites = {}
+    for row in rows.iterator():
+        favourites.setdefault(row["user"], (row["location"], row["count"]))
+    return favourites
+
+
+def _shortest_deltas(semester):
+    start, end = semester_range(semester)
+    rows = (
+        Order.objects.filter(
+            accepted=True, put_at__gte=start, put_at__lt=end, user__isnull=False
+        )
+        .annotate(
+            previous=Window(
+                Lag("put_at"), partition_by=[F("user")], order_by=F("put_at").asc()
+            )
+        )
+        .values_list("user", "put_at", "previous")
+    )
+
+    deltas = {}
+    for user_id, put_at, previous in rows.iterator():
+        if previous is None:
+            continue
+        delta = put_at - previous
+        if user_id not in deltas or delta < deltas[user_id]:
+            deltas[user_id] = delta
+    return deltas
+
+
+def _best_placement(days):
+    best = dict(date=None, count=None, place=None, shared=None, other_dates=[])
+
+    for day, _, count, place, shared, _ in days:
+        if best["place"] is not None:
+            if best["place"] < place:
+                continue
+            elif best["place"] == place:
+                # The day with the most orders at the best placement is the
+                # one shown.
+                if best["count"] < count:
+                    best["other_dates"].append(best["date"])
+                    best["date"] = day
+                    best["count"] = count
+                else:
+                    best["other_dates"].append(day)
+                continue
+
+        best = dict(date=day, count=count, place=place, shared=shared, other_dates=[])
+
+    return best
+
+
+def _longest_streak(days):
+    """The most days in a row with orders that the user was on the top list.
+    Days without any orders at all do not end a streak."""
+    streak = dict(start=None, end=None, duration=0)
+    start = None
+
+    for i, (day, index, _, _, _, on_top_list) in enumerate(days):
+        follows = i > 0 and index == days[i - 1][1] + 1
+        if not on_top_list:
+            start = None
+            continue
+        if start is None or not follows:
+            start = i
+
+        # A single day is a streak too, the frontend handles it.
+        duration = i - start + 1
+        if duration > streak["duration"]:
+            streak = dict(start=days[start][0], end=day, duration=duration)
+
+    return streak
+
+
+def metrics(user_data):
+    """The Wrapped data of one user, from what `collect` has read. Takes a
+    single argument to be usable with `Executor.map`."""
+    days, is_staff, placement, favourite, shortest_delta, weekdays = user_data
+
+    n_orders = sum(day[2] for day in days)
+    most = max(day[2] for day in days)
+    location, location_count = favourite
+
+    return dict(
+        is_staff=is_staff,
+        overall_placement=placement,
+        n_orders=n_orders,
+        caffeine_mg=round(CAFFEINE_MG * n_orders),
+        most_purchases=dict(
+            count=most,
+            dates=[day[0] for day in days if day[2] == most],
+        ),
+        best_placement=_best_placement(days),
+        longest_streak=_longest_streak(days),
+        # Only one blipp.
+        shortest_delta=None if n_orders == 1 else shortest_delta,
+        fav_cafe=dict(id=location, n_orders=location_count),
+        week_avg=round(5 * n_orders / weekdays, 1) if weekdays else 0.0,
+    )
+
+
+def collect(semester, timings):
+    """Reads everything needed for the Wrapped of `semester`. Returns a dict
+    of what `metrics` takes by user id."""
+    with timed(timings, "daily counts"):
+        days, is_staff = _daily_counts(semester)
+    with timed(timings, "locations"):
+        favourites = _favourite_locations(semester)
+    with timed(timings, "deltas"):
+        deltas = _shortest_deltas(semester)
+
+    weekdays = semester_weekdays(semester)
+
+    # The placement over the whole semester, from 0, among the users in the
+    # same group.
+    totals = sorted(
+        (is_staff[user_id], -sum(day[2] for day in user_days), user_id)
+        for user_id, user_days in days.items()
+    )
+    placements = {}
+    for group in (False, True):
+        in_group = [user_id for staff, _, user_id in totals if staff == group]
+        placements.update((user_id, i) for i, user_id in enumerate(in_group))
+
+    return {
+        user_id: (
+            user_days,
+            is_staff[user_id],
+            placements[user_id],
+            favourites[user_id],
+            deltas.get(user_id),
+            weekdays,
+        )
+        for user_id, user_days in days.items()
+    }
+
+
+def compute(semester, user_ids=None, processes=None, timings=None):
+    """Returns the Wrapped data of `semester` by user id, for `user_ids` or
+    for everybody who had coffee. With `processes` the metrics are computed
+    in a pool of that many processes."""
+    if timings is None:
+        timings = {}
+
+    users = collect(semester, timings)
+    if user_ids is not None:
+        users = {user_id: users[user_id] for user_id in user_ids if user_id in users}
+
+    with timed(timings, "metrics"):
+        if processes and len(users) > BATCH_SIZE:
+            # Forked, so that the processes need not set up Django. They do
+            # not use the database.
+            context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(processes, mp_context=context) as executor:
+                data = executor.map(metrics, users.values(), chunksize=BATCH_SIZE)
+                result = dict(zip(users, data))
+        else:
+            result = {user_id: metrics(value) for user_id, value in users.items()}
+
+    return result
+
+
+def serialize(data):
+    """Returns a two-tuple (`data` as gzipped JSON, SHA-256 of the JSON)."""
+    content = json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":"))
+    content = content.encode()
+    return gzip.compress(content, mtime=0), hashlib.sha256(content).hexdigest()
+
+
+def _wrapped(semester, user_id, data):
+    payload, payload_hash = serialize(data)
+    return Wrapped(
+        user_id=user_id,
+        semester=semester,
+        data=data,
+        payload=payload,
+        payload_hash=payload_hash,
+    )
+
+
+def save(semester, data, timings=None):
+    """Writes the Wrapped `data` of `semester` by user id, replacing the
+    Wrapped users already had."""
+    if timings is None:
+        timings = {}
+
+    with timed(timings, "write"), transaction.atomic():
+        Wrapped.objects.bulk_create(
+            (
+                _wrapped(semester, user_id, user_data)
+                for user_id, user_data in data.items()
+            ),
+            batch_size=BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=["user", "semester"],
+            update_fields=["data", "payload", "payload_hash"],
+        )
+        user_ids = list(data)
+        transaction.on_commit(
+            lambda: cache.delete_many([_cache_key(user_id) for user_id in user_ids])
+        )
+
+
+def _cache_key(user_id):
+    return "%s.%s" % (settings.WRAPPED_CACHE_KEY, user_id)
+
+
+def get_payload(user):
+    """Returns a two-tuple (gzipped JSON, SHA-256 of the JSON) of the Wrapped
+    of the latest semester of `user`, or None if there is none."""
+    key = _cache_key(user.id)
+    payload = cache.get(key)
+    if payload is None:
+        row = (
+            Wrapped.objects.filter(user=user)
+            .order_by("-semester__start")
+            .values_list("payload", "payload_hash")
+            .first()
+        )
+        # Users without Wrapped are cached too, as an empty tuple, and so are
+        # those whose Wrapped has no payload, which there is nothing to serve of.
+        payload = () if row is None or not row[0] else (bytes(row[0]), row[1])
+        cache.set(key, payload, settings.WRAPPED_CACHE_TTL)
+
+    return payload or None
+
+
+def wrapped_changed(sender, instance=None, **kwargs):
+    if instance is not None and instance.user_id is not None:
+        cache.delete(_cache_key(instance.user_id))
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Wrapped computed from the orders of a semester as NumPy arrays.
+
+`compute` gives the same result as `cafesys.baljan.wrapped.compute`, but
+reads the accepted orders of the semester once, as columns of user, time,
+date and location, and computes the metrics of all users at once with sorts
+and group-by operations on the arrays: every daily count, placement, streak
+and gap is an element of an array ordered by user, and what is per user is
+reduced over the slices of each user.
+"""
+
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from datetime import timezone as dt_timezone
+
+import numpy as np
+from django.db.models.functions import TruncDate
+
+from . import export, wrapped
+from .models import Order, Profile
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# The gap of users without two orders.
+NO_GAP = np.iinfo(np.int64).max
+
+Orders = namedtuple("Orders", ["user", "time", "day", "location"])
+
+
+def load(semester):
+    """The accepted orders of `semester` as `Orders` of arrays: user ids,
+    microseconds since the epoch, local days since the epoch and locations."""
+    start, end = wrapped.semester_range(semester)
+    queryset = Order.objects.filter(
+        accepted=True, put_at__gte=start, put_at__lt=end, user__isnull=False
+    ).annotate(date=TruncDate("put_at"))
+
+    columns = ([], [], [], [])
+    for row in export.iterate(
+        queryset, ["user", "put_at", "date", "location"], "put_at"
+    ):
+        for column, value in zip(columns, row):
+            column.append(value)
+    users, put_ats, dates, locations = columns
+
+    return Orders(
+        user=np.array(users, dtype=np.int64),
+        time=np.array(
+            [(put_at - EPOCH) // timedelta(microseconds=1) for put_at in put_ats],
+            dtype=np.int64,
+        ),
+        day=np.array(dates, dtype="datetime64[D]").astype(np.int64),
+        location=np.array(locations, dtype=np.int64),
+    )
+
+
+def _date(day):
+    return date.fromordinal(EPOCH_ORDINAL + int(day))
+
+
+def _starts(keys):
+    """Whether each element of the sorted `keys` is the first of its key."""
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = keys[1:] != keys[:-1]
+    return starts
+
+
+def _by_user(values, value_users, n_users):
+    """Splits `values`, sorted by the user indices `value_users`, into one
+    array per user."""
+    return np.split(values, np.searchsorted(value_users, np.arange(1, n_users)))
+
+
+def _placements(entry_day, entry_staff, entry_user, counts):
+    """The placement (from 0) in the top list of the day, the position in it
+    and the number of other users with as many orders that day, of every
+    daily count."""
+    n = len(counts)
+    order = np.lexsort((entry_user, -counts, entry_staff, entry_day))
+    day, staff, count = entry_day[order], entry_staff[order], counts[order]
+
+    new_list = np.ones(n, dtype=bool)
+    new_list[1:] = (day[1:] != day[:-1]) | (staff[1:] != staff[:-1])
+    new_count = new_list.copy()
+    new_count[1:] |= count[1:] != count[:-1]
+
+    positions = np.arange(n)
+    list_start = np.maximum.accumulate(np.where(new_list, positions, 0))
+    count_id = np.cumsum(new_count) - 1
+
+    place, position, shared = (np.empty(n, dtype=np.int64) for _ in range(3))
+    place[order] = count_id - count_id[list_start]
+    position[order] = positions - list_start
+    shared[order] = np.bincount(count_id)[count_id] - 1
+    return place, position, shared
+
+
+def _best_placements(entry_user, place, counts, shared, user_start, n_users):
+    """For every user the index of the daily count shown as the best
+    placement, its `shared` and the indices of the other days at the same
+    placement, in the order `wrapped._best_placement` finds them."""
+    best_place = np.minimum.reduceat(place, user_start)
+    days = np.flatnonzero(place == best_place[entry_user])
+    users, count = entry_user[days], counts[days]
+    m = len(days)
+
+    # A day is a record if it has more orders than the days before it at the
+    # same placement. The last record is shown, and every other day is added
+    # to the other dates when it is found, or a record when it is beaten.
+    first = _starts(users)
+    offset = users * (counts.max() + 1)
+    running = np.maximum.accumulate(count + offset) - offset
+    previous = np.empty(m, dtype=np.int64)
+    previous[1:] = running[:-1]
+    previous[first] = -1
+    records = np.flatnonzero(count > previous)
+
+    added = np.arange(m)
+    added[records] = m
+    beaten = users[records[1:]] == users[records[:-1]]
+    added[records[:-1][beaten]] = records[1:][beaten]
+
+    shown = added == m
+    others = np.flatnonzero(~shown)
+    others = others[np.lexsort((added[others], users[others]))]
+
+    return (
+        days[shown],
+        shared[days[first]],
+        _by_user(days[others], users[others], n_users),
+    )
+
+
+def _longest_streaks(entry_user, entry_day, on_top, user_start, n_users):
+    """For every user the indices of the first and the last daily count of
+    the earliest longest streak on the top list, or -1 for none."""
+    day_index = np.searchsorted(np.unique(entry_day), entry_day)
+    continues = np.zeros(len(on_top), dtype=bool)
+    continues[1:] = on_top[:-1] & (day_index[1:] == day_index[:-1] + 1)
+    continues[user_start] = False
+    run_start = on_top & ~continues
+
+    top = np.flatnonzero(on_top)
+    first = np.full(n_users, -1)
+    last = np.full(n_users, -1)
+    if not len(top):
+        return first, last
+
+    run_id = np.cumsum(run_start)[top] - 1
+    lengths = np.bincount(run_id)
+    run_first = top[run_start[top]]
+    run_last = top[np.append(run_id[1:] != run_id[:-1], True)]
+    run_user = entry_user[run_first]
+
+    longest = np.lexsort((np.arange(len(lengths)), -lengths, run_user))
+    longest = longest[_starts(run_user[longest])]
+    first[run_user[longest]] = run_first[longest]
+    last[run_user[longest]] = run_last[longest]
+    return first, last
+
+
+def _shortest_gaps(orders, users):
+    """The shortest time in microseconds between two orders of every user in
+    `users`, or `NO_GAP`."""
+    order = np.lexsort((orders.time, orders.user))
+    user, time = orders.user[order], orders.time[order]
+    same = user[1:] == user[:-1]
+    gap_users = user[1:][same]
+    gaps = (time[1:] - time[:-1])[same]
+
+    shortest = np.full(len(users), NO_GAP)
+    index = np.searchsorted(users, gap_users)
+    known = index < len(users)
+    known[known] = users[index[known]] == gap_users[known]
+    np.minimum.at(shortest, index[known], gaps[known])
+    return shortest
+
+
+def metrics(orders, staff, weekdays):
+    """The Wrapped data of every user with orders in `orders` by user id.
+    `staff` are the ids of users in the staff top lists."""
+    users, user_index = np.unique(orders.user, return_inverse=True)
+    n_users = len(users)
+    if not n_users:
+        return {}
+    is_staff = np.isin(users, np.fromiter(staff, dtype=np.int64))
+
+    # The number of orders of every user and day, sorted by user and day.
+    days = orders.day
+    first_day = days.min()
+    span = days.max() - first_day + 1
+    keys, counts = np.unique(user_index * span + (days - first_day), return_counts=True)
+    entry_user = keys // span
+    entry_day = keys % span + first_day
+    user_start = np.flatnonzero(_starts(entry_user))
+
+    place, position, shared = _placements(
+        entry_day, is_staff[entry_user], entry_user, counts
+    )
+    on_top = position < wrapped.TOP_LIST_LENGTH
+
+    n_orders = np.add.reduceat(counts, user_start)
+    most = np.maximum.reduceat(counts, user_start)
+    most_days = np.flatnonzero(counts == most[entry_user])
+    most_days = _by_user(most_days, entry_user[most_days], n_users)
+
+    locations = orders.location
+    n_locations = locations.max() + 1
+    by_location = np.bincount(
+        user_index * n_locations + locations, minlength=n_users * n_locations
+    ).reshape(n_users, n_locations)
+    favourite = by_location.argmax(axis=1)
+
+    overall = np.lexsort((np.arange(n_users), -n_orders, is_staff))
+    placement = np.empty(n_users, dtype=np.int64)
+    placement[overall] = np.arange(n_users) - np.where(
+        is_staff[overall], n_users - is_staff.sum(), 0
+    )
+
+    best, best_shared, best_others = _best_placements(
+        entry_user, place, counts, shared, user_start, n_users
+    )
+    streak_first, streak_last = _longest_streaks(
+        entry_user, entry_day, on_top, user_start, n_users
+    )
+    gaps = _shortest_gaps(orders, users)
+
+    result = {}
+    for i, user_id in enumerate(users.tolist()):
+        n = int(n_orders[i])
+        if streak_first[i] < 0:
+            streak = dict(start=None, end=None, duration=0)
+        else:
+            streak = dict(
+                start=_date(entry_day[streak_first[i]]),
+                end=_date(entry_day[streak_last[i]]),
+                duration=int(streak_last[i] - streak_first[i] + 1),
+            )
+
+        result[user_id] = dict(
+            is_staff=bool(is_staff[i]),
+            overall_placement=int(placement[i]),
+            n_orders=n,
+            caffeine_mg=round(wrapped.CAFFEINE_MG * n),
+            most_purchases=dict(
+                count=int(most[i]),
+                dates=[_date(entry_day[day]) for day in most_days[i]],
+            ),
+            best_placement=dict(
+                date=_date(entry_day[best[i]]),
+                count=int(counts[best[i]]),
+                place=int(place[best[i]]),
+                shared=int(best_shared[i]),
+                other_dates=[_date(entry_day[day]) for day in best_others[i]],
+            ),
+            longest_streak=streak,
+            # Only one blipp.
+            shortest_delta=(
+                None
+                if n == 1 or gaps[i] == NO_GAP
+                else timedelta(microseconds=int(gaps[i]))
+            ),
+            fav_cafe=dict(
+                id=int(favourite[i]), n_orders=int(by_location[i, favourite[i]])
+            ),
+            week_avg=round(5 * n / weekdays, 1) if weekdays else 0.0,
+        )
+
+    return result
+
+
+def compute(semester, user_ids=None, timings=None):
+    """Like `cafesys.baljan.wrapped.compute`."""
+    if timings is None:
+        timings = {}
+
+    with wrapped.timed(timings, "load"):
+        orders = load(semester)
+        staff = set(
+            Profile.objects.filter(staff_class=Profile.STAFF_CLASS_STAFF).values_list(
+                "user", flat=True
+            )
+        )
+
+    with wrapped.timed(timings, "metrics"):
+        result = metrics(orders, staff, wrapped.semester_weekdays(semester))
+
+    if user_ids is not None:
+        result = {user_id: result[user_id] for user_id in user_ids if user_id in result}
+    return result
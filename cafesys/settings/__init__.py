@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 import dj_database_url
 import os
-import stripe
 import warnings
 from django.contrib.messages import constants as message_constants
 
@@ -50,7 +49,7 @@ else:
 
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        "BACKEND": "cafesys.baljan.instrumentation.InstrumentedRedisCache",
         "LOCATION": CACHE_BACKEND,
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
@@ -132,6 +131,8 @@ TEMPLATES = [
 # CRISPY_TEMPLATE_PACK = 'uni_form'
 
 MIDDLEWARE = [
+    # First, so that it sees the queries of the other middleware as well
+    "cafesys.baljan.instrumentation.RequestStatsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
@@ -149,6 +150,8 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = "cafesys.urls"
 
+TEST_RUNNER = "cafesys.baljan.testing.TestRunner"
+
 INSTALLED_APPS = [
     # Project
     # Must come before admin app to override login template
@@ -265,6 +268,12 @@ SERVER_EMAIL = "cafesys@baljan.org"
 
 WORKER_COOLDOWN_SECONDS = 60  # 1 minute cooldown
 
+# The most blipps a reader may send in one batch
+BLIPP_BATCH_MAX_TAPS = 500
+# How long ago a blipp in a batch may have been made. Older ones are turned
+# away, so that a reader cannot change days that are already accounted for.
+BLIPP_BATCH_MAX_AGE = 2 * 24 * 60 * 60  # seconds
+
 BOARD_GROUP = "styrelsen"
 WORKER_GROUP = "jobbare"
 NEW_WORKER_GROUP = "_nya-jobbare"
@@ -276,14 +285,66 @@ DEBUG_TOOLBAR_CONFIG = {
     "INTERCEPT_REDIRECTS": False,
 }
 
+BLIPP_CONFIGURATION_VERSION_KEY = "baljan.blipp.configuration-version"
+BLIPP_COOLDOWN_KEY = "baljan.blipp.cooldown"
+# Never expires, so that cafesys.baljan.ratelimit can tell an emptied cache
+RATELIMIT_WARM_KEY = "baljan.ratelimit.warm-since"
+BLIPP_CARD_INDEX_VERSION_KEY = "baljan.blipp.card-index-version"
+# Keep every card id in memory to turn away unknown cards without a query
+BLIPP_CARD_INDEX = env.bool("DJANGO_BLIPP_CARD_INDEX", default=True)
+
+# Where the request stats of cafesys.baljan.instrumentation are kept, None to
+# only log them
+REQUEST_STATS_KEY = "baljan.request-stats"
+REQUEST_STATS_FLUSH_SECONDS = 10
+# The most queries a request to a view may make, by url name (or function
+# name for views without one). Going over it is logged, and fails the tests.
+QUERY_BUDGETS = {
+    # On a cold cache, with the upsert of the daily order count
+    "do_blipp": 7,
+    "high_score": 10,
+    "wrapped": 4,
+}
+QUERY_BUDGET_RAISE = False
+
 STATS_CACHE_KEY = "baljan.stats"
 # How long the stats data live in the cache
 STATS_CACHE_TTL = 24 * 60 * 60  # seconds
+# Where cafesys.baljan.ranks keeps the scores of all users
+RANKS_KEY = "baljan.ranks"
+
+# Where cafesys.baljan.rollup keeps its watermark and the days to count again
+ORDER_ROLLUP_KEY = "baljan.order-rollup"
+# Orders this new may belong to transactions that are not committed yet, so
+# their days are counted again until they are older
+ORDER_ROLLUP_GRACE_SECONDS = 60
+# How often the rollup is refreshed, and so how far behind the statistics are
+ORDER_ROLLUP_INTERVAL = 5 * 60  # seconds
+
+# Where the Wrapped served to every user is cached, and for how long
+WRAPPED_CACHE_KEY = "baljan.wrapped"
+WRAPPED_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+
+# Where cafesys.baljan.plots keeps the plots it has drawn, and for how long
+PLOT_CACHE_KEY = "baljan.plots"
+PLOT_CACHE_TTL = 24 * 60 * 60  # seconds
+
+# Where cafesys.baljan.bookkeep keeps the reports of past years, and for how
+# long. They hold the current balances, so they are not kept for longer.
+BOOKKEEP_CACHE_KEY = "baljan.bookkeep"
+BOOKKEEP_CACHE_TTL = 24 * 60 * 60  # seconds
 
 CELERY_BROKER_URL = CACHE_BACKEND
 CELERY_TASK_SERIALIZER = "json"
 CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
+# Installed by the scheduler next to the periodic tasks set up in the admin
+CELERY_BEAT_SCHEDULE = {
+    "update-order-rollup": {
+        "task": "cafesys.baljan.tasks.update_order_rollup",
+        "schedule": ORDER_ROLLUP_INTERVAL,
+    },
+}
 
 SECURE_PROXY_SSL_HEADER = ("HTTP_X_FORWARDED_PROTO", "https")
 # SECURE_SSL_REDIRECT = False
@@ -322,7 +383,7 @@ GOOGLE_SERVICE_ACCOUNT_INFO = {
     "token_uri": GOOGLE_TOKEN_URI,
 }
 
-stripe.api_key = env.str("STRIPE_API_KEY", default="")
+STRIPE_API_KEY = env.str("STRIPE_API_KEY", default="")
 STRIPE_ENDPOINT_SECRET = env.str("STRIPE_ENDPOINT_SECRET", default="")
 
 BALANCE_WARNING_LIMIT = 1500